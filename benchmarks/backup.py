@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Runs a whole backup of a synthetic guild, offline, and measures it.
+
+The guild, its channels, messages and members are fakes with the
+attributes that the bot reads. Their number is configurable, and the
+`history()` of the channels is paginated like the Discord API, with an
+optional latency per page and rate limit. The backup runs through the
+`!backup all` command, with the archive uploaded to a local directory,
+and the throughput, peak RSS and time spent in each phase are printed as
+JSON:
+
+    python benchmarks/backup.py --channels 10 --messages 10000 \\
+        --members 5000 > before.json
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+
+import bot  # noqa: E402
+from serializer import (_Attachment, _Embed, _Emoji, _Message,  # noqa: E402
+                        _Named, _Reaction, _Reference)
+
+# The fakes are timed with the original sleep; the fixed delays of the bot
+#   (e.g., before a backup starts) are skipped.
+_sleep = asyncio.sleep
+_EPOCH = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+class _RateLimiter:
+    """Allows at most `rate` requests per second (any number if 0)."""
+
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.requests = 0
+        self._next = 0
+
+    async def request(self):
+        self.requests += 1
+        if self.rate:
+            now = time.perf_counter()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1 / self.rate
+            if wait > 0:
+                await _sleep(wait)
+        if self.latency:
+            await _sleep(self.latency)
+
+
+class _FakeMessage(_Message):
+    """A message of `serializer.py`, with attachments, embeds, references,
+    custom emoji reactions and mentions of other members."""
+
+    def __init__(self, n, id, channel, members):
+        author = members[n % len(members)]
+        super().__init__(n, author, channel, channel.guild)
+        self.id = id
+        self.created_at = discord.utils.snowflake_time(id)
+        if n % 4 == 0:
+            self.mentions = [members[(n * 7) % len(members)]]
+        if n % 11 == 0:
+            self.reactions = [
+                _Reaction('👍', False, 3),
+                _Reaction(_Emoji(n % 50), True, 1)
+            ]
+        if n % 13 == 0:
+            self.attachments = [_Attachment(id, f'image_{n}.png')]
+        if n % 17 == 0:
+            self.embeds = [_Embed(n)]
+        if n % 9 == 0 and n:
+            self.reference = _Reference(id - (1 << 22), channel.id,
+                                        channel.guild.id)
+
+
+class _TextChannel:
+
+    def __init__(self, id, name, guild, num_messages, limiter):
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.mention = f'<#{id}>'
+        self.num_messages = num_messages
+        self._limiter = limiter
+        # A message every 10 minutes, in the snowflake order of the API.
+        self._first_id = discord.utils.time_snowflake(_EPOCH) + id % 4096
+        self.last_message_id = None
+        if num_messages:
+            self.last_message_id = self._message_id(num_messages - 1)
+
+    def _message_id(self, n):
+        return self._first_id + n * (600000 << 22)
+
+    async def history(self,
+                      limit=None,
+                      after=None,
+                      before=None,
+                      oldest_first=None):
+        """Yields the messages in pages of 100, like the API does."""
+        ids = range(self.num_messages)
+        if after is not None:
+            ids = [n for n in ids if self._message_id(n) > after.id]
+        if before is not None:
+            ids = [n for n in ids if self._message_id(n) < before.id]
+        if not oldest_first:
+            ids = list(reversed(ids))
+        if limit is not None:
+            ids = ids[:limit]
+        for i, n in enumerate(ids):
+            if i % 100 == 0:
+                await self._limiter.request()
+            yield _FakeMessage(n, self._message_id(n), self,
+                               self.guild.members)
+
+
+class _Member:
+
+    def __init__(self, n, guild, roles):
+        self.id = 500000 + n
+        self.name = f'member{n}'
+        self.display_name = f'Member {n}'
+        self.discriminator = f'{n % 10000:04d}'
+        self.mention = f'<@{self.id}>'
+        self.bot = n % 50 == 0
+        self.system = False
+        self.pending = False
+        self.activities = []
+        self.joined_at = _EPOCH + timedelta(hours=n)
+        self.mutual_guilds = [guild]
+        self.roles = [roles[0]] + roles[1:][n % 3:n % 3 + 2]
+        self.guild_permissions = discord.Permissions(
+            sum(x.permissions.value for x in self.roles))
+
+
+class _Role:
+
+    def __init__(self, n, guild):
+        self.id = 700000 + n
+        self.name = '@everyone' if n == 0 else f'role{n}'
+        self.guild = guild
+        self.members = []
+        self.created_at = _EPOCH
+        self.color = discord.Colour(n * 1000)
+        self.permissions = discord.Permissions(1 << n)
+        self.position = n
+        self.hoist = False
+        self.mentionable = True
+        self.managed = False
+        self.tags = None
+
+
+class _Guild:
+
+    def __init__(self, num_channels, num_messages, num_members, limiter):
+        self.id = 1000
+        self.name = 'Benchmark Guild'
+        self.description = 'A synthetic guild.'
+        self.created_at = _EPOCH
+        self.icon = None
+        self.member_count = num_members
+        self.preferred_locale = discord.Locale.american_english
+        self.nsfw_level = discord.NSFWLevel.default
+        self.mfa_level = discord.MFALevel.disabled
+        self.verification_level = discord.VerificationLevel.none
+        self.explicit_content_filter = discord.ContentFilter.disabled
+        self.default_notifications = discord.NotificationLevel.all_messages
+        self.system_channel_flags = discord.SystemChannelFlags()
+        self.afk_channel = None
+        self.voice_client = None
+        self.emojis = []
+        self.stickers = []
+        self.roles = [_Role(n, self) for n in range(6)]
+        self.default_role = self.roles[0]
+        self.members = [
+            _Member(n, self, self.roles) for n in range(num_members)
+        ]
+        self.owner = self.members[0]
+        self.text_channels = [
+            _TextChannel(2000 + n, f'channel-{n}', self, num_messages,
+                         limiter) for n in range(num_channels)
+        ]
+        self.channels = self.text_channels
+        self.system_channel = self.text_channels[0]
+        self._limiter = limiter
+
+    def get_channel(self, channel_id):
+        for channel in self.text_channels:
+            if channel.id == channel_id:
+                return channel
+        return None
+
+    async def fetch_members(self, limit=None):
+        for i, member in enumerate(self.members):
+            if i % 1000 == 0:
+                await self._limiter.request()
+            yield member
+
+
+class _StatusMessage:
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class _Destination(_Named):
+    """The channel that the backup reports to."""
+
+    def __init__(self, channel_id, name):
+        super().__init__(channel_id, name)
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        self.sent.append(content or embed)
+        return _StatusMessage()
+
+
+class _Context:
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.author = _Named(1, 'benchmark')
+        self.channel = _Destination(3000, 'backups')
+        self.sent = self.channel.sent
+        self.send = self.channel.send
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).resolve().parents[1],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run_backup(discord_bot, guild):
+    ctx = _Context(guild)
+    await discord_bot.get_command('backup').callback(ctx, 'all')
+    # The backup runs in the background, as a job of the scheduler.
+    while len(asyncio.all_tasks()) > 1:
+        await _sleep(0.01)
+    return ctx
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--messages',
+                        type=int,
+                        default=10000,
+                        help='per channel')
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--page-latency',
+                        type=float,
+                        default=0,
+                        help='seconds per API request')
+    parser.add_argument('--rate-limit',
+                        type=float,
+                        default=0,
+                        help='API requests per second (0: no limit)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--slices',
+                        type=int,
+                        default=1,
+                        help='concurrent ranges per channel')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='worker processes that compress the archive')
+    parser.add_argument('--export-format', default='json')
+    parser.add_argument('--member-format', default='verbose')
+    parser.add_argument('--compression', default=bot.DEFAULT_COMPRESSION)
+    args = parser.parse_args()
+
+    state_dir = tempfile.TemporaryDirectory()
+    os.chdir(state_dir.name)  # The bot writes `logs.log` to the cwd.
+    os.environ.update({
+        'STATE_DIR': state_dir.name,
+        'EXPORT_FORMAT': args.export_format,
+        'MEMBER_FORMAT': args.member_format,
+        'COMPRESSION': args.compression,
+        'BACKUP_CONCURRENCY': str(args.concurrency),
+        'CHANNEL_SLICES': str(args.slices),
+        'WORKER_PROCESSES': str(args.workers),
+        'UPLOAD_DESTINATIONS': 'local',
+        'UPLOAD_DIR': os.path.join(state_dir.name, 'uploads')
+    })
+    sys.argv = [sys.argv[0]]
+
+    limiter = _RateLimiter(args.rate_limit, args.page_latency)
+    guild = _Guild(args.channels, args.messages, args.members, limiter)
+
+    async def fast_sleep(delay, *args, **kwargs):
+        await _sleep(0)
+
+    pool = bot._get_worker_pool()
+    if pool:
+        # The workers are started once, when the bot starts.
+        concurrent.futures.wait(
+            [pool.submit(int) for _ in range(args.workers)])
+
+    captured = {}
+    with mock.patch.object(commands.Bot, 'run',
+                           lambda self, token: captured.update(bot=self)):
+        bot.main()
+    # The results are printed to stdout as JSON, so the logs of the bot go
+    #   to stderr instead.
+    bot.logger.configure(handlers=[{
+        'sink': sys.stderr,
+        'format': '{extra[server_id]} {extra[user_id]} {message}'
+    }])
+
+    with mock.patch('asyncio.sleep', fast_sleep):
+        start = time.perf_counter()
+        ctx = asyncio.run(_run_backup(captured['bot'], guild))
+        elapsed = time.perf_counter() - start
+
+    uploads = list(Path(os.environ['UPLOAD_DIR']).glob('*.zip'))
+    if not uploads:
+        sys.exit(f'The backup failed: {ctx.sent[-1]}')
+    num_messages = args.channels * args.messages
+
+    def phase(name):
+        # The archive is written while the channels are fetched; `upload` is
+        #   the time left after the last channel.
+        value = bot.METRICS.get('discord_backup_phase_seconds', phase=name)
+        return round(value[1], 3) if value else None
+
+    print(
+        json.dumps({
+            'commit': _commit(),
+            'config': vars(args),
+            'messages': num_messages,
+            'members': args.members,
+            'requests': limiter.requests,
+            'seconds': round(elapsed, 3),
+            'messages_per_sec': round(num_messages / elapsed),
+            'fetch_messages_per_sec': round(num_messages /
+                                            phase('channels')),
+            'peak_rss_mb': round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                1),
+            'archive_bytes': uploads[0].stat().st_size,
+            'phases': {
+                'guild': phase('guild'),
+                'members': phase('members'),
+                'fetch': phase('channels'),
+                'archive': phase('archive'),
+                'upload': phase('upload')
+            }
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Measures the ratio and throughput of each archive compression codec.
+
+The input is the NDJSON export of synthetic messages (see `serializer.py`),
+compressed with `bot._ArchiveWriter` like a channel entry of a backup.
+
+    python benchmarks/compression.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bot  # noqa: E402
+from serializer import _Message, _Named  # noqa: E402
+
+CODECS = [
+    'store', 'deflate:1', 'deflate:3', 'deflate:6', 'deflate:9', 'bzip2:1',
+    'bzip2:9', 'lzma'
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--codecs', nargs='+', default=CODECS)
+    args = parser.parse_args()
+
+    author = _Named(1, 'author')
+    channel = _Named(2, 'general')
+    guild = _Named(3, 'guild')
+    with tempfile.NamedTemporaryFile(suffix='.ndjson') as f:
+        for n in range(args.messages):
+            x = bot.serialize_message(_Message(n, author, channel, guild))
+            x['created_at'] = str(x['created_at'])
+            f.write(json.dumps(x).encode('utf-8') + b'\n')
+        f.flush()
+        size = os.path.getsize(f.name)
+
+        results = []
+        for codec in args.codecs:
+            start = time.perf_counter()
+            archive = bot._ArchiveWriter(codec)
+            archive.write_file('channels/0.ndjson', f.name)
+            data_obj = archive.close()
+            elapsed = time.perf_counter() - start
+            compressed_size = data_obj.seek(0, os.SEEK_END)
+            data_obj.close()
+            results.append({
+                'codec': codec,
+                'ratio': round(size / compressed_size, 2),
+                'mb_per_sec': round(size / elapsed / 1e6, 2)
+            })
+
+    print(json.dumps({'input_bytes': size, 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
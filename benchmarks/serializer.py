@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Measures the throughput of `bot.serialize_message`.
+
+The previous implementation, which looked up and dispatched on every
+attribute of every message, is kept below as the baseline. Both are run on
+the same synthetic messages, and their outputs are checked to be identical.
+
+    python benchmarks/serializer.py --messages 100000
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bot  # noqa: E402
+
+# As in the bot: the attachments and stickers are not downloaded while the
+#   messages are serialized.
+GET_DATA = False
+
+
+class _Named:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class _Flags:
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    @property
+    def crossposted(self):
+        return bool(self.value & 1)
+
+    @property
+    def suppress_embeds(self):
+        return bool(self.value & 4)
+
+
+class _Reaction:
+    __slots__ = ('emoji', 'me', 'count')
+
+    def __init__(self, emoji, me, count):
+        self.emoji = emoji
+        self.me = me
+        self.count = count
+
+    def is_custom_emoji(self):
+        return not isinstance(self.emoji, str)
+
+
+class _Attachment:
+
+    def __init__(self, id, filename):
+        self.id = id
+        self.filename = filename
+        self.url = f'https://cdn.discordapp.com/attachments/{id}/{filename}'
+
+
+class _Embed:
+
+    def __init__(self, n):
+        self.n = n
+
+    def to_dict(self):
+        return {
+            'type': 'rich',
+            'title': f'Embed {self.n}',
+            'description': 'An embed, e.g. from a link preview.',
+            'url': f'https://example.com/{self.n}'
+        }
+
+
+class _Reference:
+
+    def __init__(self, message_id, channel_id, guild_id):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.cached_message = None
+
+
+class _Emoji:
+
+    def __init__(self, n):
+        self.id = 900000 + n
+        self.name = f'emoji_{n}'
+        self.animated = False
+        self.managed = False
+
+
+class _Sticker:
+
+    def __init__(self, n):
+        self.id = 800000 + n
+        self.name = f'sticker_{n}'
+        self.url = f'https://media.discordapp.net/stickers/{self.id}.png'
+
+
+class _Message:
+    __slots__ = ('id', 'content', 'author', 'channel', 'guild', 'created_at',
+                 'edited_at', 'mentions', 'reactions', 'flags', 'tts',
+                 'pinned', 'nonce', 'webhook_id', 'attachments', 'embeds',
+                 'stickers', 'reference', 'components', 'application',
+                 'activity', 'mention_everyone', 'role_mentions', 'call',
+                 'interaction', 'position')
+
+    def __init__(self, n, author, channel, guild):
+        self.id = 1 << 40 | n
+        self.content = f'Message number {n}, mentioning nobody in particular.'
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.created_at = datetime(2021, 1, 1,
+                                   tzinfo=timezone.utc) + timedelta(minutes=n)
+        self.edited_at = None
+        self.mentions = [author] if n % 7 == 0 else []
+        self.reactions = [_Reaction('👍', False, 3)] if n % 5 == 0 else []
+        self.flags = _Flags(0)
+        self.tts = False
+        self.pinned = False
+        self.nonce = None
+        self.webhook_id = None
+        self.attachments = []
+        self.embeds = []
+        self.stickers = []
+        self.reference = None
+        self.components = []
+        self.application = None
+        self.activity = None
+        self.mention_everyone = False
+        self.role_mentions = []
+        self.call = None
+        self.interaction = None
+        self.position = None
+
+    @property
+    def clean_content(self):
+        return self.content
+
+    @property
+    def system_content(self):
+        return self.content
+
+    @property
+    def jump_url(self):
+        return (f'https://discord.com/channels/{self.guild.id}/'
+                f'{self.channel.id}/{self.id}')
+
+    @property
+    def raw_mentions(self):
+        return [x.id for x in self.mentions]
+
+    @property
+    def raw_channel_mentions(self):
+        return []
+
+    @property
+    def raw_role_mentions(self):
+        return []
+
+    @property
+    def channel_mentions(self):
+        return []
+
+    @property
+    def type(self):
+        return _Named(0, 'default')
+
+    def delete(self):
+        pass
+
+    def edit(self):
+        pass
+
+    def pin(self):
+        pass
+
+    def reply(self):
+        pass
+
+    def add_reaction(self):
+        pass
+
+    def to_reference(self):
+        pass
+
+
+def run_legacy(messages):
+    # The serialization of `backup_channel`, as it was before the plans
+    #   (only the history is iterated synchronously).
+    regular_types = [
+        'activity', 'application', 'clean_content', 'content', 'id',
+        'jump_url', 'mention_everyone', 'pinned', 'system_content', 'tts',
+        'webhook_id', 'raw_channel_mentions', 'raw_mentions',
+        'raw_role_mentions', 'created_at'
+    ]  # as it is
+    cls_methods = [
+        'clear_reaction', 'delete', 'pin', 'reply', 'publish',
+        'to_message_reference_dict', 'is_system', 'to_reference', 'unpin',
+        'ack', 'edit', 'add_reaction', 'remove_reaction', 'clear_reactions'
+    ]  # ignore these attrs
+    ignore = ['call', 'nonce'
+              ]  # "call" is deprecated, "nonce" is almost always None
+
+    public_attrs = []
+    history = []
+
+    for x in messages:
+        d = {}
+        if not public_attrs:
+            public_attrs = [
+                x for x in dir(x)
+                if not x.startswith('_') and x not in cls_methods + ignore
+            ]
+
+        for attr in public_attrs:
+            val = getattr(x, attr)
+            if attr in regular_types:
+                val_content = val
+            elif attr in ['author', 'channel', 'guild']:
+                # .name, .id (more details can be accessed through each key
+                #   in the global dict)
+                val_content = {'id': val.id, 'name': val.name}
+            elif attr == 'edited_at':
+                val_content = str(val)
+            elif attr in ['channel_mentions', 'mentions', 'role_mentions']:
+                # iterable; .name and .id
+                val_content = [{'id': v.id, 'name': v.name} for v in val]
+            elif attr == 'attachments':
+                # iterable; .id, .filename, .url --> can be saved to bytes
+                #   object with .read()
+                val_content = []
+                for v in val:
+                    if GET_DATA:
+                        attachments_data = v.read()
+                    else:
+                        attachments_data = None
+                    val_content.append({
+                        'id': v.id,
+                        'filename': v.filename,
+                        'url': v.url,
+                        'data': attachments_data
+                    })
+            elif attr == 'embeds':
+                # iterable; access .to_dict()
+                val_content = [v.to_dict() for v in val]
+            elif attr == 'reference':
+                # .message_id, .channel_id, .guild_id,
+                #   cached_message.system_content: optional
+                if val:
+                    val_content = {
+                        attr: {
+                            'message_id': val.message_id,
+                            'channel_id': val.channel_id,
+                            'guild_id': val.guild_id
+                        }
+                    }
+                    if val.cached_message:
+                        val_content.update({
+                            'cached_message':
+                            val.cached_message.system_content
+                        })
+                    else:
+                        val_content.update(
+                            {'cached_message': val.cached_message})
+                else:
+                    val_content = None
+            elif attr == 'reactions':
+                # iterable; .emoji, .is_custom_emoji, .me, .count. If
+                #   custom_emoji: [v.emoji.id, v.emoji.name,
+                #   v.emoji.animated, v.emoji.animated, v.emoji.managed]
+                val_content = []
+                for v in val:
+                    if not hasattr(v, 'is_custom_emoji'):
+                        # For compatibility with discord.py <= 1.7.3
+                        is_custom_emoji = None
+                    else:
+                        is_custom_emoji = v.is_custom_emoji()
+
+                    _d = {
+                        'is_custom_emoji': is_custom_emoji,
+                        'me': v.me,
+                        'count': v.count
+                    }
+                    if isinstance(v.emoji, str):
+                        _d.update({'emoji': v.emoji})
+                    else:
+                        if hasattr(v.emoji, 'managed'):
+                            emoji_managed = v.emoji.managed
+                        else:
+                            emoji_managed = None
+                        _d.update({
+                            'emoji': {
+                                'id': v.emoji.id,
+                                'name': v.emoji.name,
+                                'animated': v.emoji.animated,
+                                'managed': emoji_managed
+                            }
+                        })
+                    val_content.append(_d)
+            elif attr == 'stickers':
+                # iterable; .name, .id, .url --> can be saved to bytes
+                #   object with .read()
+                val_content = []
+                if val:  # For compatibility with discord.py <= 1.7.3
+                    for v in val:
+                        if GET_DATA:
+                            stickers_data = v.read()
+                        else:
+                            stickers_data = None
+                        val_content.append({
+                            'id': v.id,
+                            'name': v.name,
+                            'url': v.url,
+                            'data': stickers_data
+                        })
+            elif attr in ['flags', 'type']:
+                # get all public attrs
+                val_content = {
+                    k: getattr(val, k)
+                    for k in dir(val) if not k.startswith('_')
+                    if k not in ['count', 'index']
+                }
+            else:
+                continue
+
+            d.update({attr: val_content})
+
+        history.append(d)
+
+    return history
+
+
+def run_compiled(messages):
+    return [bot.serialize_message(x) for x in messages]
+
+
+def make_messages(num_messages):
+    """Returns messages with every kind of attribute that has its own
+    encoder: references (to a cached message, or not), attachments, embeds,
+    stickers, and custom emoji reactions."""
+    author = _Named(1, 'author')
+    channel = _Named(2, 'general')
+    guild = _Named(3, 'guild')
+    messages = []
+    for n in range(num_messages):
+        x = _Message(n, author, channel, guild)
+        if n % 9 == 0 and n:
+            x.reference = _Reference(x.id - 1, channel.id, guild.id)
+            if n % 18 == 0:
+                x.reference.cached_message = messages[-1]
+        if n % 11 == 0:
+            x.reactions = [
+                _Reaction('👍', False, 3),
+                _Reaction(_Emoji(n % 50), True, 1)
+            ]
+        if n % 13 == 0:
+            x.attachments = [_Attachment(x.id, f'image_{n}.png')]
+        if n % 17 == 0:
+            x.embeds = [_Embed(n)]
+        if n % 19 == 0:
+            x.stickers = [_Sticker(n % 20)]
+        messages.append(x)
+    return messages
+
+
+def measure(func, messages, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(messages)
+        best = min(best, time.perf_counter() - start)
+    return output, len(messages) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+
+    legacy_output, legacy_rate = measure(run_legacy, messages, args.repeat)
+    output, rate = measure(run_compiled, messages, args.repeat)
+    assert json.dumps(output, default=str) == json.dumps(legacy_output,
+                                                        default=str)
+
+    print(
+        json.dumps({
+            'messages': args.messages,
+            'legacy_messages_per_sec': round(legacy_rate),
+            'messages_per_sec': round(rate),
+            'speedup': round(rate / legacy_rate, 2)
+        }))
+
+
+if __name__ == '__main__':
+    main()
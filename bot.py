@@ -1,80 +1,3789 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
+import asyncio
+import atexit
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
 import inspect
 import io
+import itertools
 import json
+import logging
+import lzma
+import multiprocessing
 import os
 import re
+import shutil
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
 import time
+import uuid
 import zipfile
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import aiohttp
 import discord
-import requests
+import urllib3
+from aiohttp import web
 from discord.ext import commands  # noqa: F401
 from dotenv import load_dotenv
 from loguru import logger
 from minio import Minio
 
 
-class _UploadFile:
+# Archives streamed to S3 are uploaded in parts of this size (S3 requires
+# at least 5 MiB per part).
+S3_PART_SIZE = 16 * 1024 * 1024
 
-    def __init__(self, raw_data, object_name):
-        self.raw_data = raw_data
-        self.object_name = object_name
 
-    def get_compressed_file_object(self):
-        with tempfile.NamedTemporaryFile(suffix='.zip') as f:
-            with zipfile.ZipFile(f,
-                                 mode='w',
-                                 compression=zipfile.ZIP_DEFLATED,
-                                 compresslevel=9) as zf:
-                with tempfile.NamedTemporaryFile() as rf:
-                    rf.write(json.dumps(self.raw_data).encode('utf-8'))
-                    rf.seek(0)
-                    zf.write(rf.name, arcname=Path(self.object_name).stem)
-            f.flush()
-            f.seek(0)
-            obj = io.BytesIO(f.read())
-        return obj
-
-    def upload_s3_object(self, object_data):
-        client = Minio(os.getenv('S3_ENDPOINT'), os.getenv('S3_ACCESS_KEY'),
-                       os.getenv('S3_SECRET_KEY'))
-        s3_object = client.put_object(os.getenv('S3_BUCKET_NAME'),
-                                      self.object_name,
-                                      object_data,
-                                      object_data.getbuffer().nbytes,
-                                      content_type='application/zip')
-        presigned_url = client.presigned_get_object(s3_object.bucket_name,
-                                                    s3_object.object_name)
-        return presigned_url
+@functools.lru_cache(maxsize=None)
+def _get_s3_client():
+    """Returns the S3 client, shared by all uploads.
+
+    The connections are pooled and reused across parts and uploads, and a
+    part that fails (a dropped connection or a 5xx response) is retried with
+    a backoff instead of failing the whole upload.
+    """
+    http_client = urllib3.PoolManager(
+        maxsize=int(os.getenv('S3_MAX_CONNECTIONS', 10)),
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=urllib3.Retry(total=5,
+                              backoff_factor=0.5,
+                              status_forcelist=[500, 502, 503, 504]))
+    return Minio(os.getenv('S3_ENDPOINT'),
+                 os.getenv('S3_ACCESS_KEY'),
+                 os.getenv('S3_SECRET_KEY'),
+                 secure=os.getenv('S3_SECURE', 'yes') != 'no',
+                 http_client=http_client)
+
+
+class _Metrics:
+    """The counters, gauges and histograms of the bot, rendered in the
+    Prometheus text format (served on `/metrics` if `METRICS_PORT` is set).
+
+    Metrics are updated both from the event loop and from the threads of
+    `run_blocking`, so each update takes a lock.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 300, 900, 3600)
+
+    def __init__(self, metrics):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        for name, metric_type, help_text in metrics:
+            self._types[name] = metric_type
+            self._help[name] = help_text
+        self._values = {name: {} for name in self._types}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = [[0] * len(self.BUCKETS), 0, 0]
+            buckets, _, count = values[key]
+            for n, upper_bound in enumerate(self.BUCKETS):
+                if value <= upper_bound:
+                    buckets[n] += 1
+            values[key][1] += value
+            values[key][2] = count + 1
+
+    def get(self, name, **labels):
+        return self._values[name].get(tuple(sorted(labels.items())))
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escaped = [(k, str(v).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for k, v in labels]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, metric_type in self._types.items():
+                lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for key, value in self._values[name].items():
+                    if metric_type != 'histogram':
+                        lines.append(f'{name}{self._format_labels(key)} '
+                                     f'{value}')
+                        continue
+                    buckets, total, count = value
+                    for upper_bound, n in zip(self.BUCKETS + ('+Inf', ),
+                                              buckets + [count]):
+                        bucket_labels = key + (('le', upper_bound), )
+                        lines.append(f'{name}_bucket'
+                                     f'{self._format_labels(bucket_labels)} '
+                                     f'{n}')
+                    lines.append(f'{name}_sum{self._format_labels(key)} '
+                                 f'{total}')
+                    lines.append(f'{name}_count{self._format_labels(key)} '
+                                 f'{count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = _Metrics([
+    ('discord_backup_messages_total', 'counter',
+     'Messages backed up, by channel.'),
+    ('discord_backup_api_requests_total', 'counter',
+     'Requests to the Discord API, by route and status.'),
+    ('discord_backup_api_request_seconds', 'histogram',
+     'Duration of the requests to the Discord API (including the time '
+     'spent waiting for the rate limits), by route.'),
+    ('discord_backup_rate_limits_total', 'counter',
+     'Responses of the Discord API with a 429 status, by route.'),
+    ('discord_backup_rate_limit_wait_seconds_total', 'counter',
+     'Time spent waiting after a 429 response, by route.'),
+    ('discord_backup_serialized_bytes_total', 'counter',
+     'Bytes of serialized messages.'),
+    ('discord_backup_serialization_seconds_total', 'counter',
+     'Time spent serializing messages.'),
+    ('discord_backup_archive_input_bytes_total', 'counter',
+     'Bytes written into archives, before compression, by codec.'),
+    ('discord_backup_archive_bytes_total', 'counter',
+     'Bytes of the archive entries, after compression, by codec.'),
+    ('discord_backup_archive_seconds_total', 'counter',
+     'Time spent writing and compressing archives, by codec.'),
+    ('discord_backup_upload_seconds', 'histogram',
+     'Duration of the archive uploads, by service.'),
+    ('discord_backup_phase_seconds', 'histogram',
+     'Duration of the phases of the backups.'),
+    ('discord_backup_request_budget_wait_seconds_total', 'counter',
+     'Time requests waited for the request budget, by class.'),
+    ('discord_backup_jobs', 'gauge', 'Backup jobs, by state.'),
+    ('discord_backup_jobs_finished_total', 'counter',
+     'Finished backup jobs, by status.'),
+])
+
+# The trace of the backup job that the current task (or thread) is part of.
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+# The route of the Discord API request that is being made.
+_current_route = contextvars.ContextVar('current_route', default=None)
+# The class of the Discord API requests made by the current task (see
+# `_RequestScheduler`); None to classify them by their route.
+_request_class = contextvars.ContextVar('request_class', default=None)
+
+
+class _Trace:
+    """The spans of a backup job, saved in the Chrome trace event format
+    (which can be opened with https://ui.perfetto.dev).
+
+    Each span is attributed to the task (or thread) it ran in, so the
+    channels that are backed up concurrently show up side by side.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.events = []
+        self._start = time.perf_counter()
+        self._tids = {}
+
+    def _tid(self):
+        try:
+            key = id(asyncio.current_task())
+        except RuntimeError:
+            key = threading.get_ident()
+        return self._tids.setdefault(key, len(self._tids) + 1)
+
+    def add(self, name, start, end, args):
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': round((start - self._start) * 1e6),
+            'dur': round((end - start) * 1e6),
+            'pid': self.job.guild_id,
+            'tid': self._tid(),
+            'args': args
+        })
+
+    def dump(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events}, f)
+
+
+@contextlib.contextmanager
+def _span(name, metric=None, **labels):
+    """Times a block: records it as a span of the current trace, if any,
+    and observes its duration in the `metric` histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if metric:
+            METRICS.observe(metric, end - start, **labels)
+        trace = _current_trace.get()
+        if trace:
+            trace.add(name, start, end, labels)
+
+
+def _phase(name):
+    return _span(name, 'discord_backup_phase_seconds', phase=name)
+
+
+def _instrument_requests(request):
+    """Wraps `discord.http.HTTPClient.request` to count and time the
+    requests by route (e.g. `GET /channels/{channel_id}/messages`)."""
+
+    @functools.wraps(request)
+    async def wrapper(route, **kwargs):
+        route_name = f'{route.method} {route.path}'
+        token = _current_route.set(route_name)
+        status = 'ok'
+        try:
+            with _span(route_name,
+                       'discord_backup_api_request_seconds',
+                       route=route_name):
+                return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = e.status
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            _current_route.reset(token)
+            METRICS.inc('discord_backup_api_requests_total',
+                        route=route_name,
+                        status=status)
+
+    return wrapper
+
+
+class _RateLimitHandler(logging.Handler):
+    """Counts the 429 responses, and the time waited after them, from the
+    warnings of `discord.http` (which are logged in the task that made the
+    request, so its route is known)."""
+
+    def emit(self, record):
+        if not str(record.msg).startswith(
+                'We are being rate limited.') or len(record.args) != 3:
+            return
+        route = _current_route.get()
+        METRICS.inc('discord_backup_rate_limits_total', route=route)
+        if 'Retrying in' in record.msg:
+            METRICS.inc('discord_backup_rate_limit_wait_seconds_total',
+                        record.args[2],
+                        route=route)
+
+
+class _RequestScheduler:
+    """Schedules the requests to the Discord API, by class.
+
+    Requests are sent at most `rate` per second (under the global rate limit
+    of Discord), and each class of requests gets a priority and a share of
+    this budget (`CLASSES`):
+
+    - `interactive`: replies to commands, which are sent first;
+    - `bulk`: the data fetched by backups (any other `GET` request);
+    - `cosmetic`: edits of the progress embeds, which only get what the
+      other classes leave, and at most a tenth of the budget.
+
+    Requests are classified by their method, unless the task that makes them
+    sets `_request_class`.
+    """
+
+    # Priority (lower first) and share of the rate, by class.
+    CLASSES = {'interactive': (0, 1), 'bulk': (1, 1), 'cosmetic': (2, 0.1)}
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._updated = time.monotonic()
+        self._tokens = {x: self._capacity(x) for x in [None, *self.CLASSES]}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _capacity(self, request_class):
+        share = 1 if request_class is None else self.CLASSES[request_class][1]
+        return max(self.rate * share, 1)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        for request_class, tokens in self._tokens.items():
+            capacity = self._capacity(request_class)
+            self._tokens[request_class] = min(
+                capacity, tokens + elapsed * capacity)
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        self._waiters = [x for x in self._waiters if not x[-1].done()]
+        for waiter in sorted(self._waiters):
+            request_class, future = waiter[2:]
+            if self._tokens[None] < 1:
+                break
+            if self._tokens[request_class] < 1:
+                continue
+            self._tokens[None] -= 1
+            self._tokens[request_class] -= 1
+            self._waiters.remove(waiter)
+            future.set_result(None)
+        if self._waiters:
+            # Wait for the next token that lets a waiter through.
+            delay = min(
+                max((1 - self._tokens[x]) / self._capacity(x)
+                    for x in [None, request_class])
+                for request_class in {x[2] for x in self._waiters})
+            self._timer = asyncio.get_event_loop().call_later(
+                max(delay, 0.001), self._dispatch)
+
+    async def acquire(self, request_class):
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((self.CLASSES[request_class][0],
+                              next(self._seq), request_class, future))
+        self._dispatch()
+        if not future.done():
+            start = time.perf_counter()
+            await future
+            METRICS.inc('discord_backup_request_budget_wait_seconds_total',
+                        time.perf_counter() - start,
+                        request_class=request_class)
+
+    def wrap(self, request):
+        """Wraps `discord.http.HTTPClient.request` to schedule the
+        requests."""
+
+        @functools.wraps(request)
+        async def wrapper(route, **kwargs):
+            request_class = _request_class.get() or ('bulk' if route.method
+                                                     == 'GET' else
+                                                     'interactive')
+            await self.acquire(request_class)
+            return await request(route, **kwargs)
+
+        return wrapper
+
+
+class _ProgressEmbed:
+    """The progress embed of a backup, kept up to date in the background.
+
+    The embed is rebuilt with `render` every `interval` seconds, and the
+    message is only edited if it changed, so that a backup of many small
+    channels does not spend its rate limits on progress updates. The edits
+    are sent as `cosmetic` requests (see `_RequestScheduler`).
+    """
+
+    def __init__(self, message, render, interval):
+        self.message = message
+        self.render = render
+        self.interval = interval
+        self._last_embed = None
+        self._task = None
+
+    async def _run(self, owner):
+        # Stops with the task that started it, if it was not stopped.
+        while True:
+            await asyncio.sleep(self.interval)
+            if owner.done():
+                return
+            await self.refresh()
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(asyncio.current_task()))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def refresh(self):
+        embed = self.render()
+        # The fields are mutated in place, so they are compared as JSON.
+        embed_json = json.dumps(embed.to_dict(), default=str)
+        if embed_json == self._last_embed:
+            return
+        self._last_embed = embed_json
+        token = _request_class.set('cosmetic')
+        try:
+            await self.message.edit(embed=embed)
+        finally:
+            _request_class.reset(token)
+
+
+class _Uploader:
+    """Uploads the archives to their destinations (`UPLOAD_DESTINATIONS`).
+
+    - `s3`: streamed to S3 while the archive is written, one part at a time
+      (see `upload_s3`); the link is shortened with Polr, if configured.
+    - `fileio`: uploaded to file.io once the archive is written.
+    - `local`: written to `UPLOAD_DIR` while the archive is written.
+
+    The HTTP requests share a pool of keep-alive connections, time out if
+    the server does not respond for `UPLOAD_TIMEOUT` seconds, and are
+    retried with an exponential backoff.
+    """
+
+    DESTINATIONS = ['s3', 'fileio', 'local']
+    RETRIES = 3
+
+    def __init__(self):
+        default = 's3' if '--use-all-services' in sys.argv else 'fileio'
+        self.destinations = [
+            x.strip() for x in os.getenv('UPLOAD_DESTINATIONS', default).split(
+                ',') if x.strip()
+        ]
+        invalid = set(self.destinations) - set(self.DESTINATIONS)
+        if invalid or not self.destinations:
+            raise ValueError(f'Invalid UPLOAD_DESTINATIONS: '
+                             f'{", ".join(sorted(invalid)) or "(empty)"}')
+        self._session = None
+        self._loop = None
+
+    @property
+    def session(self):
+        # Created on first use, inside the event loop (and again if the
+        #   loop changed, e.g. in tests).
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed or (self._loop
+                                                             is not loop):
+            self._loop = loop
+            timeout = float(os.getenv('UPLOAD_TIMEOUT', 60))
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None,
+                                              sock_connect=timeout,
+                                              sock_read=timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def request(self, method, url, make_data=None, **kwargs):
+        """Sends a request, retrying on connection errors, timeouts and
+        server errors. `make_data` makes the body again for each attempt,
+        since a body is consumed when it is sent.
+
+        Returns the status and the body of the response.
+        """
+        for attempt in range(self.RETRIES + 1):
+            try:
+                async with self.session.request(
+                        method,
+                        url,
+                        data=make_data() if make_data else None,
+                        **kwargs) as response:
+                    body = await response.read()
+                    if response.status < 500 or attempt == self.RETRIES:
+                        return response.status, body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.RETRIES:
+                    raise
+                # The error is passed as an argument: loguru formats the
+                #   message, and the error may contain braces.
+                logger.warning('Upload request to {} failed ({!r}); '
+                               'retrying.',
+                               url,
+                               e,
+                               server_id=None,
+                               user_id=None)
+            await asyncio.sleep(2**attempt)
 
     @staticmethod
-    def shorten_url(long_url):
+    def upload_s3(object_data, object_name):
+        """Uploads a file, or a stream of unknown length, to S3.
+
+        Streams (e.g. a `_StreamPipe`) are read and uploaded one part at a
+        time as a multipart upload, so the archive does not have to be fully
+        written (or held in memory) before the upload starts.
+        """
+        with _span('upload', 'discord_backup_upload_seconds', service='s3'):
+            client = _get_s3_client()
+            if hasattr(object_data, 'seek'):
+                length = object_data.seek(0, io.SEEK_END)
+                object_data.seek(0)
+                part_size = 0
+            else:
+                length = -1
+                part_size = int(os.getenv('S3_PART_SIZE', S3_PART_SIZE))
+            s3_object = client.put_object(os.getenv('S3_BUCKET_NAME'),
+                                          object_name,
+                                          object_data,
+                                          length,
+                                          content_type='application/zip',
+                                          part_size=part_size)
+            return client.presigned_get_object(s3_object.bucket_name,
+                                               s3_object.object_name)
+
+    async def shorten_url(self, long_url):
+        if not os.getenv('POLR_SERVER'):
+            return long_url
         request_data = {
             'key': os.getenv('POLR_KEY'),
             'url': long_url,
             'is_secret': False
         }
-        res = requests.post(
-            f'{os.getenv("POLR_SERVER")}/api/v2/action/shorten',
-            json=request_data)
-        if res.status_code != 200:
+        try:
+            status, body = await self.request(
+                'POST',
+                f'{os.getenv("POLR_SERVER")}/api/v2/action/shorten',
+                json=request_data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             return long_url
-        return res.text
+        if status != 200:
+            return long_url
+        return body.decode()
+
+    async def upload_fileio(self, path, object_name):
+
+        def make_data():
+            # aiohttp closes the file once it is sent.
+            data = aiohttp.FormData()
+            data.add_field('file',
+                           open(path, 'rb'),
+                           filename=object_name,
+                           content_type='application/zip')
+            return data
+
+        with _span('upload', 'discord_backup_upload_seconds',
+                   service='file.io'):
+            status, body = await self.request(
+                'POST', os.getenv('FILEIO_URL', 'https://file.io'),
+                make_data)
+        if status != 200:
+            raise RuntimeError(f'file.io responded with {status}: '
+                               f'{body[:200]!r}')
+        return json.loads(body)['link']
+
+    async def publish(self, object_name, write, copies=()):
+        """Writes an archive with `write(fileobj)` (in a thread), and uploads
+        it to all of the destinations in parallel.
+
+        The streaming destinations (`s3` and `local`), and the `copies` (the
+        paths the archive is also saved to), receive the archive as it is
+        written; `fileio` gets it once it is complete. A destination that
+        fails does not stop the others, unless they all fail.
+
+        Returns the link to the archive (one per line, by destination, if
+        there are several).
+        """
+        pipe = _StreamPipe() if 's3' in self.destinations else None
+        staging = None
+        if 'fileio' in self.destinations:
+            fd, staging = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            staging = Path(staging)
+        outputs = [Path(x) for x in copies]
+        if 'local' in self.destinations:
+            upload_dir = Path(os.getenv('UPLOAD_DIR', 'uploads'))
+            upload_dir.mkdir(parents=True, exist_ok=True)
+            outputs.append(upload_dir / object_name)
+        tmp_paths = [x.with_name(x.name + '.tmp') for x in outputs]
+
+        def write_archive():
+            files = [open(x, 'wb') for x in tmp_paths]
+            if staging:
+                files.append(open(staging, 'wb'))
+            try:
+                with _phase('archive'):
+                    # The S3 upload is left behind if it fails, as long as
+                    #   there are other destinations to write to.
+                    write(
+                        _Tee(*files, optional=[pipe] if pipe else [])
+                        if len(self.destinations) > 1 else _Tee(
+                            *files, *([pipe] if pipe else [])))
+            except BaseException as e:
+                if pipe:
+                    pipe.close(e)
+                raise
+            finally:
+                for f in files:
+                    f.close()
+            if pipe:
+                pipe.close()
+            for tmp_path, path in zip(tmp_paths, outputs):
+                os.replace(tmp_path, path)
+
+        def upload_pipe():
+            try:
+                return self.upload_s3(pipe, object_name)
+            except BaseException as e:
+                pipe.close(e)
+                raise
+
+        writer = run_thread(write_archive)
+        uploads = {}
+        if pipe:
+
+            async def to_s3():
+                url = await run_thread(upload_pipe)
+                return await self.shorten_url(url)
+
+            uploads['s3'] = to_s3()
+        if staging:
+
+            async def to_fileio():
+                await writer
+                return await self.upload_fileio(staging, object_name)
+
+            uploads['fileio'] = to_fileio()
+        if 'local' in self.destinations:
+
+            async def to_local():
+                await writer
+                return str(outputs[-1].resolve())
+
+            uploads['local'] = to_local()
+
+        try:
+            # Wait for all sides, so a failed upload is never left behind by
+            #   a writer that is still running (and vice versa).
+            results = await asyncio.gather(writer,
+                                           *uploads.values(),
+                                           return_exceptions=True)
+        finally:
+            for path in tmp_paths + ([staging] if staging else []):
+                if path.exists():
+                    path.unlink()
+        if isinstance(results[0], BaseException):
+            raise results[0]
+        links = dict(zip(uploads, results[1:]))
+        for destination, link in links.items():
+            if isinstance(link, BaseException):
+                logger.error('Could not upload {} to {}: {!r}',
+                             object_name,
+                             destination,
+                             link,
+                             server_id=None,
+                             user_id=None)
+                links[destination] = 'upload failed'
+        if all(isinstance(x, BaseException) for x in results[1:]):
+            for path in outputs[:len(copies)]:
+                path.unlink()
+            raise results[1]
+        if len(links) == 1:
+            return links.popitem()[1]
+        return '\n'.join(f'{k}: {v}' for k, v in links.items())
+
+
+# The codecs an archive can be compressed with, and their valid levels.
+_CODECS = {
+    'store': (zipfile.ZIP_STORED, []),
+    'deflate': (zipfile.ZIP_DEFLATED, range(0, 10)),
+    'bzip2': (zipfile.ZIP_BZIP2, range(1, 10)),
+    'lzma': (zipfile.ZIP_LZMA, [])
+}
+DEFAULT_COMPRESSION = 'deflate:6'
+
+
+def parse_compression(spec):
+    """Parses a compression setting, e.g. `deflate:6`, `bzip2` or `lzma`.
+
+    Returns the compression method (e.g. `zipfile.ZIP_DEFLATED`) and the
+    level (or None, for the default one). Raises ValueError if the setting
+    is not valid.
+    """
+    codec, _, level = spec.partition(':')
+    if codec not in _CODECS:
+        raise ValueError(f'Unknown compression codec: `{codec}` (choose '
+                         f'from: {", ".join(_CODECS)}).')
+    compression, levels = _CODECS[codec]
+    if not level:
+        return compression, None
+    if not level.isdigit() or int(level) not in levels:
+        raise ValueError(
+            f'Invalid compression level for `{codec}`: `{level}`.')
+    return compression, int(level)
+
+
+# The entries of an archive are compressed by the worker processes in
+#   chunks of this size.
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _num_worker_processes():
+    # `WORKER_PROCESSES`; 1 (the default) compresses in the bot process.
+    return max(1, int(os.getenv('WORKER_PROCESSES') or 1))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_worker_pool():
+    """Returns the pool of worker processes that compress the archives, or
+    None if they are compressed in the bot process (`WORKER_PROCESSES=1`,
+    the default).
+
+    The workers are started (not forked), so they do not inherit the
+    threads or the connections of the bot.
+    """
+    if _num_worker_processes() <= 1:
+        return None
+    pool = concurrent.futures.ProcessPoolExecutor(
+        _num_worker_processes(),
+        mp_context=multiprocessing.get_context('spawn'))
+    atexit.register(pool.shutdown)
+    return pool
+
+
+def _deflate_chunk(data, level, zdict, finish):
+    # Runs in a worker process.
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+class _ParallelDeflate:
+    """Compresses a zip entry in chunks, on the worker processes (like a
+    raw deflate `zlib.compressobj`).
+
+    Like pigz, each chunk is compressed on its own (primed with the 32 KiB
+    that come before it) and ends on a byte boundary, so that the compressed
+    chunks form a single deflate stream once they are concatenated. At most
+    `max_pending` chunks are compressed at a time.
+    """
+
+    def __init__(self, pool, level, max_pending):
+        self._pool = pool
+        self._level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        self._max_pending = max_pending
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._zdict = None
+
+    def _submit(self, data, finish):
+        self._pending.append(
+            self._pool.submit(_deflate_chunk, data, self._level, self._zdict,
+                              finish))
+        self._zdict = data[-32 * 1024:]
+
+    def compress(self, data):
+        self._buffer += data
+        while len(self._buffer) >= COMPRESSION_CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:COMPRESSION_CHUNK_SIZE]), False)
+            del self._buffer[:COMPRESSION_CHUNK_SIZE]
+        # The chunks are written out in order, as soon as they are done.
+        compressed = []
+        while self._pending and (self._pending[0].done() or
+                                 len(self._pending) > self._max_pending):
+            compressed.append(self._pending.popleft().result())
+        return b''.join(compressed)
+
+    def flush(self):
+        if self._zdict is None:
+            # Small entries are not worth sending to a worker.
+            return _deflate_chunk(bytes(self._buffer), self._level, None,
+                                  True)
+        self._submit(bytes(self._buffer), True)
+        self._buffer.clear()
+        compressed = [x.result() for x in self._pending]
+        self._pending.clear()
+        return b''.join(compressed)
+
+
+class _LzmaCompressor:
+    """Compresses a zip entry with LZMA, like `zipfile` does: raw LZMA1,
+    after a header with the version of the LZMA SDK and the properties of
+    the stream."""
+
+    def __init__(self):
+        # The defaults of the `lzma` module (preset 6).
+        lc, lp, pb, dict_size = 3, 0, 2, 8 * 1024 * 1024
+        properties = bytes([(pb * 5 + lp) * 9 + lc]) + struct.pack(
+            '<L', dict_size)
+        self._header = struct.pack('<BBH', 9, 4,
+                                   len(properties)) + properties
+        self._compressor = lzma.LZMACompressor(lzma.FORMAT_RAW,
+                                               filters=[{
+                                                   'id': lzma.FILTER_LZMA1,
+                                                   'dict_size': dict_size,
+                                                   'lc': lc,
+                                                   'lp': lp,
+                                                   'pb': pb
+                                               }])
+
+    def compress(self, data):
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b''
+        return header + self._compressor.flush()
+
+
+class _ZipEntry:
+    """An entry being written to a `_ZipWriter` (a file-like object)."""
+
+    def __init__(self, writer, zinfo, compressor):
+        self._writer = writer
+        self._zinfo = zinfo
+        self._compressor = compressor
+        self._crc = 0
+        self._size = 0
+        self._compress_size = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        compressed = self._compressor.compress(
+            data) if self._compressor else data
+        self._compress_size += len(compressed)
+        self._writer.write_raw(compressed)
+        return len(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._compressor:
+            data = self._compressor.flush()
+            self._compress_size += len(data)
+            self._writer.write_raw(data)
+        self._zinfo.CRC = self._crc
+        self._zinfo.file_size = self._size
+        self._zinfo.compress_size = self._compress_size
+        # The data descriptor, in the zip64 format.
+        self._writer.write_raw(
+            struct.pack('<4sLQQ', b'PK\x07\x08', self._crc,
+                        self._compress_size, self._size))
+        self._writer.entries.append(self._zinfo)
+
+
+class _ZipWriter:
+    """Writes a zip file as a stream, one entry at a time.
+
+    The file does not need to be seekable: the CRC and the sizes of each
+    entry are written after its data (in a data descriptor), and every
+    entry has zip64 fields, so entries and archives can be larger than
+    4 GiB. The data of the entries is compressed by the caller's
+    compressors (e.g. `_ParallelDeflate`), so this only writes the
+    structure of the file.
+    """
+
+    # The version of the zip format needed to extract each codec (and
+    #   zip64).
+    _VERSIONS = {
+        zipfile.ZIP_STORED: 45,
+        zipfile.ZIP_DEFLATED: 45,
+        zipfile.ZIP_BZIP2: 46,
+        zipfile.ZIP_LZMA: 63
+    }
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._offset = 0
+        self.entries = []
+
+    def write_raw(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def open(self, arcname, compress_type, compressor):
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0o600 << 16
+        zinfo.create_system = 3
+        zinfo.create_version = zinfo.extract_version = self._VERSIONS[
+            compress_type]
+        zinfo.header_offset = self._offset
+        # Bit 3: the sizes are in the data descriptor; bit 11: UTF-8 name.
+        zinfo.flag_bits = 0x08 | 0x800
+        if compress_type == zipfile.ZIP_LZMA:
+            zinfo.flag_bits |= 0x02  # The stream has an end marker.
+        name = arcname.encode('utf-8')
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        self.write_raw(
+            struct.pack('<4s2B4HL2L2H', b'PK\x03\x04',
+                        zinfo.extract_version, 0, zinfo.flag_bits,
+                        compress_type, *self._dos_date_time(zinfo), 0,
+                        0xffffffff, 0xffffffff, len(name), len(extra)) +
+            name + extra)
+        return _ZipEntry(self, zinfo, compressor)
+
+    @staticmethod
+    def _dos_date_time(zinfo):
+        year, month, day, hour, minute, second = zinfo.date_time
+        return (hour << 11 | minute << 5 | second // 2,
+                (year - 1980) << 9 | month << 5 | day)
+
+    def close(self):
+        start = self._offset
+        for zinfo in self.entries:
+            name = zinfo.filename.encode('utf-8')
+            extra = struct.pack('<HHQQQ', 1, 24, zinfo.file_size,
+                                zinfo.compress_size, zinfo.header_offset)
+            self.write_raw(
+                struct.pack('<4s4B4HL2L5H2L', b'PK\x01\x02',
+                            zinfo.create_version, zinfo.create_system,
+                            zinfo.extract_version, 0, zinfo.flag_bits,
+                            zinfo.compress_type, *self._dos_date_time(zinfo),
+                            zinfo.CRC, 0xffffffff, 0xffffffff, len(name),
+                            len(extra), 0, 0, 0, zinfo.external_attr,
+                            0xffffffff) + name + extra)
+        end = self._offset
+        count = len(self.entries)
+        self.write_raw(
+            struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                        count, count, end - start, start) +
+            struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1) +
+            struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0,
+                        min(count, 0xffff), min(count, 0xffff),
+                        min(end - start, 0xffffffff),
+                        min(start, 0xffffffff), 0))
+
+
+class _ArchiveWriter:
+    """Writes a backup archive to a temporary file, one entry at a time.
+
+    This is CPU-bound (the entries are compressed as they are written), so
+    it is meant to be used off the event loop, e.g. with `run_blocking`.
+    If `fileobj` is given, the archive is written to it instead; it does not
+    need to be seekable.
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION, fileobj=None):
+        self._codec = compression.split(':')[0]
+        self._start = time.perf_counter()
+        self._compression, self._compresslevel = parse_compression(
+            compression)
+        self._file = fileobj or tempfile.TemporaryFile(suffix='.zip')
+        self._zip = _ZipWriter(self._file)
+
+    def write_json(self, arcname, data):
+        with self.open_entry(arcname) as f:
+            f.write(json.dumps(data).encode('utf-8'))
+
+    def write_file(self, arcname, path, compress=True):
+        with open(path, 'rb') as src, self.open_entry(arcname,
+                                                      compress) as f:
+            shutil.copyfileobj(src, f, 1024 * 1024)
+
+    def _compressor(self, compress_type):
+        level = self._compresslevel
+        if compress_type == zipfile.ZIP_DEFLATED:
+            level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+            pool = _get_worker_pool()
+            if pool:
+                return _ParallelDeflate(pool, level,
+                                        2 * _num_worker_processes())
+            return zlib.compressobj(level, zlib.DEFLATED, -15)
+        if compress_type == zipfile.ZIP_BZIP2:
+            return bz2.BZ2Compressor(9 if level is None else level)
+        if compress_type == zipfile.ZIP_LZMA:
+            return _LzmaCompressor()
+        return None
+
+    def open_entry(self, arcname, compress=True):
+        # The entries that are already compressed (e.g., images) are stored.
+        compress_type = self._compression if compress else zipfile.ZIP_STORED
+        return self._zip.open(arcname, compress_type,
+                              self._compressor(compress_type))
+
+    def abort(self):
+        """Drops an archive that failed, without finishing it (its file may
+        be closed already)."""
+        self._zip = None
+
+    def close(self):
+        self._zip.close()
+        entries = self._zip.entries
+        METRICS.inc('discord_backup_archive_input_bytes_total',
+                    sum(x.file_size for x in entries),
+                    codec=self._codec)
+        METRICS.inc('discord_backup_archive_bytes_total',
+                    sum(x.compress_size for x in entries),
+                    codec=self._codec)
+        METRICS.inc('discord_backup_archive_seconds_total',
+                    time.perf_counter() - self._start,
+                    codec=self._codec)
+        if hasattr(self._file, 'seek'):
+            self._file.seek(0)
+        return self._file
+
+
+class _StreamPipe:
+    """A bounded in-memory pipe between two threads.
+
+    The archive is written into one end while the other end is read by the
+    uploader, so compressing and uploading overlap. The writer blocks while
+    `max_size` bytes are waiting to be read, and, like a pipe, `read(size)`
+    returns as soon as any data is available (the reader, e.g. minio,
+    reads again until it has a whole part). Either side can `close` the pipe
+    with an exception, which is then raised on the other side.
+    """
+
+    def __init__(self, max_size=S3_PART_SIZE):
+        self._buffer = bytearray()
+        self._max_size = max_size
+        self._cond = threading.Condition()
+        self._eof = False
+        self._error = None
+
+    def write(self, data):
+        with self._cond:
+            while len(self._buffer) >= self._max_size and not self._error:
+                self._cond.wait()
+            if self._error:
+                raise self._error
+            self._buffer += data
+            self._cond.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size=-1):
+        with self._cond:
+            # Waiting for `size` bytes would deadlock when `size` is more
+            #   than `max_size`.
+            while not (self._eof or self._error) and (size < 0
+                                                      or not self._buffer):
+                self._cond.wait()
+            if self._error:
+                raise self._error
+            if size < 0:
+                size = len(self._buffer)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._cond.notify_all()
+        return data
+
+    def close(self, error=None):
+        with self._cond:
+            if error is None:
+                self._eof = True
+            else:
+                self._error = error
+            self._cond.notify_all()
+
+
+class _Tee:
+    """Writes the same data to several files.
+
+    The `optional` files are dropped, instead of failing the write, once
+    they raise an error (e.g. a `_StreamPipe` closed by its reader).
+    """
+
+    def __init__(self, *files, optional=()):
+        self.files = files
+        self.optional = list(optional)
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        for f in list(self.optional):
+            try:
+                f.write(data)
+            except Exception:
+                self.optional.remove(f)
+        return len(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+
+class _BackupJob:
+    """A backup in progress, checkpointed to local disk.
+
+    The guild and members data, and the messages of each channel, are
+    spooled under the job directory as they are fetched. The pagination
+    cursor of each channel is saved along with the size of its spool, so an
+    interrupted backup can continue where it stopped instead of starting
+    over.
+    """
+
+    def __init__(self, guild_id, job_id=None):
+        self.guild_id = guild_id
+        self.id = job_id or uuid.uuid4().hex[:8]
+        self.path = _BackupJob.jobs_dir(guild_id) / self.id
+        self._file = self.path / 'job.json'
+        self.data = None
+        if self._file.exists():
+            self.data = json.loads(self._file.read_text())
+        # Set when the job is cancelled, so that it is discarded instead of
+        #   being left to resume (e.g., when the bot shuts down).
+        self.cancelled = False
+
+    @staticmethod
+    def jobs_dir(guild_id):
+        return Path(os.getenv('STATE_DIR', 'state'), str(guild_id), 'jobs')
+
+    @classmethod
+    def all(cls, guild_id):
+        jobs_dir = cls.jobs_dir(guild_id)
+        if not jobs_dir.exists():
+            return []
+        jobs = [cls(guild_id, x.name) for x in jobs_dir.iterdir()]
+        jobs = [x for x in jobs if x.exists()]
+        return sorted(jobs, key=lambda x: x.data['created_at'])
+
+    def exists(self):
+        return self.data is not None
+
+    def progress(self):
+        finished = [
+            x for x in self.channels.values() if x['status'] != 'pending'
+        ]
+        num_messages = sum(x['num_messages'] for x in self.channels.values())
+        return len(finished), len(self.channels), num_messages
+
+    def create(self, channel_ids, destination_id, options, after_ids=None):
+        after_ids = after_ids or {}
+        shutil.rmtree(self.path, ignore_errors=True)
+        (self.path / 'channels').mkdir(parents=True)
+        self.data = {
+            'destination_id': destination_id,
+            'options': options,
+            'created_at': time.time(),
+            'channels': {
+                str(x): {
+                    'status': 'pending',
+                    'after': after_ids.get(x),
+                    'cursor': None,
+                    'offset': 0,
+                    'num_messages': 0
+                }
+                for x in channel_ids
+            }
+        }
+        self.checkpoint()
+
+    @property
+    def options(self):
+        return self.data['options']
+
+    @property
+    def channels(self):
+        return self.data['channels']
+
+    def spool_path(self, channel_id):
+        return self.path / 'channels' / f'{channel_id}.ndjson'
+
+    def open_spool(self, channel_id):
+        # Anything written after the last checkpoint is dropped; it will be
+        #   fetched again from the checkpointed cursor.
+        path = self.spool_path(channel_id)
+        if path.exists():
+            os.truncate(path, self.channels[str(channel_id)]['offset'])
+        return open(path, 'ab')
+
+    def checkpoint_channel(self,
+                           channel_id,
+                           spool,
+                           cursor,
+                           num_messages,
+                           status=None):
+        spool.flush()
+        os.fsync(spool.fileno())
+        state = self.channels[str(channel_id)]
+        METRICS.inc('discord_backup_messages_total',
+                    num_messages - state['num_messages'],
+                    guild_id=self.guild_id,
+                    channel_id=channel_id)
+        state.update({
+            'cursor': cursor,
+            'offset': spool.tell(),
+            'num_messages': num_messages
+        })
+        if status:
+            state['status'] = status
+        self.checkpoint()
+
+    def set_status(self, channel_id, status):
+        self.channels[str(channel_id)]['status'] = status
+        self.checkpoint()
+
+    def add_blob(self, sha256):
+        # Recorded before the message that references it is spooled, so a
+        #   checkpointed message never references a blob that is not listed.
+        with open(self.path / 'blobs.txt', 'a') as f:
+            f.write(sha256 + '\n')
+
+    def blobs(self):
+        if not self.has_json('blobs.txt'):
+            return []
+        return list(
+            dict.fromkeys((self.path / 'blobs.txt').read_text().split()))
+
+    def has_json(self, name):
+        return (self.path / name).exists()
+
+    def has_members(self):
+        return self.has_json('members.json') or self.has_json(
+            'members.ndjson')
+
+    def read(self, name):
+        if not self.has_json(name):
+            return None
+        return (self.path / name).read_bytes()
+
+    def write_json(self, name, data):
+        tmp_file = self.path / f'{name}.tmp'
+        tmp_file.write_text(json.dumps(data))
+        os.replace(tmp_file, self.path / name)
+
+    def read_json(self, name):
+        return json.loads((self.path / name).read_text())
+
+    def checkpoint(self):
+        self.write_json('job.json', self.data)
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.data = None
+
+
+class _JobScheduler:
+    """Runs backup jobs in the background.
+
+    At most `max_jobs` jobs run at once, and at most `max_jobs_per_guild` for
+    any one guild. Queued jobs are started round-robin across guilds, so a
+    guild that queues many jobs cannot starve the others.
+    """
+
+    def __init__(self, max_jobs, max_jobs_per_guild):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_guild = max_jobs_per_guild
+        self._queues = collections.OrderedDict()
+        self._running = {}
+
+    def submit(self, job, run):
+        self._queues.setdefault(job.guild_id, collections.deque()).append(
+            (job, run))
+        self._dispatch()
+
+    def _update_metrics(self):
+        METRICS.set('discord_backup_jobs',
+                    sum(len(x) for x in self._queues.values()),
+                    state='queued')
+        METRICS.set('discord_backup_jobs', len(self._running), state='running')
+
+    def _running_in(self, guild_id):
+        return len(
+            [x for x, _ in self._running.values() if x.guild_id == guild_id])
+
+    def _dispatch(self):
+        while len(self._running) < self.max_jobs:
+            for guild_id, queue in self._queues.items():
+                if self._running_in(guild_id) < self.max_jobs_per_guild:
+                    break
+            else:
+                self._update_metrics()
+                return
+
+            job, run = queue.popleft()
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+            task = asyncio.ensure_future(self._run(job, run))
+            self._running[job.id] = (job, task)
+        self._update_metrics()
+
+    async def _run(self, job, run):
+        status = 'failed'
+        try:
+            await run()
+            status = 'done'
+        except asyncio.CancelledError:
+            status = 'cancelled'
+        except Exception:  # noqa
+            logger.exception(f'Backup job {job.id} failed.',
+                             server_id=job.guild_id,
+                             user_id=None)
+        finally:
+            METRICS.inc('discord_backup_jobs_finished_total', status=status)
+            self._running.pop(job.id, None)
+            self._dispatch()
+
+    def running(self):
+        return [x for x, _ in self._running.values()]
+
+    def queued(self):
+        return [x for queue in self._queues.values() for x, _ in queue]
+
+    def jobs(self, guild_id):
+        jobs = [(x, 'running') for x, _ in self._running.values()
+                if x.guild_id == guild_id]
+        for n, (job, _) in enumerate(self._queues.get(guild_id, []), 1):
+            jobs.append((job, f'queued (#{n})'))
+        return jobs
+
+    def cancel(self, job_id):
+        for guild_id, queue in self._queues.items():
+            for entry in queue:
+                if entry[0].id == job_id:
+                    queue.remove(entry)
+                    if not queue:
+                        del self._queues[guild_id]
+                    entry[0].discard()
+                    self._update_metrics()
+                    return True
+        if job_id in self._running:
+            job, task = self._running[job_id]
+            job.cancelled = True
+            task.cancel()
+            return True
+        return False
+
+
+class _Cron:
+    """A cron expression: `minute hour day month weekday` (in UTC), where
+    each field is `*`, a number, a range (`1-5`), a step (`*/15`, `0-30/10`)
+    or a list of those (`1,15`). Weekdays are 0-6 (or 7), from Sunday.
+    """
+
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f'`{expression}` is not a valid cron '
+                             'expression (it needs 5 fields).')
+        self.expression = expression
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [self._parse(x, *y) for x, y in zip(fields, self.FIELDS)]
+        self.weekdays = {x % 7 for x in weekdays}
+        # Like cron, a day matches either field if both are restricted.
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            base, _, step = part.partition('/')
+            try:
+                if base == '*':
+                    start, end = low, high
+                elif '-' in base:
+                    start, end = map(int, base.split('-'))
+                else:
+                    start = int(base)
+                    end = high if step else start
+                step = int(step) if step else 1
+            except ValueError:
+                raise ValueError(f'`{field}` is not a valid cron field.')
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f'`{field}` is out of range ({low}-{high}).')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, t):
+        """Returns the first time after `t` that matches the expression."""
+        t = t.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) +
+                     timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f'`{self.expression}` never matches.')
+
+
+class _BackupSchedule:
+    """The schedule of the automatic backups of a guild, saved under
+    `STATE_DIR/<guild_id>/schedule.json`.
+
+    A schedule is a cron expression, or `@daily` or `@weekly` to let the bot
+    pick the time in the off-peak window (`OFF_PEAK_WINDOW`, in UTC). Each
+    guild runs at its own offset, derived from its id: across the window for
+    `@daily` and `@weekly` (and on its own weekday for `@weekly`), and within
+    `SCHEDULE_SPREAD` seconds of the time of a cron expression. So guilds
+    with the same schedule do not all start at the same time.
+    """
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.path = Path(os.getenv('STATE_DIR', 'state'), str(guild_id),
+                         'schedule.json')
+        self.data = None
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text())
+
+    @classmethod
+    def all(cls):
+        state_dir = Path(os.getenv('STATE_DIR', 'state'))
+        if not state_dir.exists():
+            return []
+        return [
+            cls(int(x.parent.name)) for x in state_dir.glob('*/schedule.json')
+        ]
+
+    def _offset(self, n):
+        # A fraction in [0, 1) that is stable for the guild.
+        digest = hashlib.sha256(f'{self.guild_id}:{n}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big') / 2**64
+
+    def cron(self, expression=None):
+        """Returns the `_Cron` of the schedule, and the delay (in seconds)
+        of this guild after each of its times."""
+        expression = expression or self.data['expression']
+        if expression not in ['@daily', '@weekly']:
+            return _Cron(expression), self._offset(0) * float(
+                os.getenv('SCHEDULE_SPREAD', 600))
+
+        start, _, end = os.getenv('OFF_PEAK_WINDOW', '01:00-07:00').partition(
+            '-')
+        start, end = [
+            int(x.split(':')[0]) * 60 + int(x.split(':')[1])
+            for x in [start, end]
+        ]
+        length = (end - start) % 1440 or 1440
+        offset = start * 60 + self._offset(0) * length * 60
+        minute = int(offset // 60) % 1440
+        weekday = int(self._offset(1) * 7) if expression == '@weekly' else '*'
+        cron = _Cron(f'{minute % 60} {minute // 60} * * {weekday}')
+        return cron, offset % 60
+
+    def next_run(self, after, expression=None):
+        cron, delay = self.cron(expression)
+        return cron.next_after(after) + timedelta(seconds=delay)
+
+    def set(self, expression, kind, options, destination_id, now):
+        self.data = {
+            'expression': expression,
+            'kind': kind,
+            'options': options,
+            'destination_id': destination_id,
+            'next_run': self.next_run(now, expression).isoformat()
+        }
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name('schedule.json.tmp')
+        tmp_file.write_text(json.dumps(self.data))
+        os.replace(tmp_file, self.path)
+
+    def remove(self):
+        self.data = None
+        if self.path.exists():
+            self.path.unlink()
+
+    @property
+    def due_at(self):
+        return datetime.fromisoformat(self.data['next_run'])
+
+    def advance(self, now):
+        # After a run (or a skipped one): runs missed while the bot was
+        #   offline are not made up for more than once.
+        self.data['next_run'] = self.next_run(now).isoformat()
+        self.save()
+
+
+class _HistoryRange:
+    """A range of message ids of a channel (`after` and `before` are
+    exclusive; a range with no `before` extends to the newest message)."""
+
+    def __init__(self, after, before):
+        self.after = after
+        self.before = before
+        self.position = after
+        self.last_message_id = None
+        self.num_messages = 0
+        self.path = None
+        self.started = False
+        self.finished = asyncio.Event()
+
+
+class _SlicedHistory:
+    """Fetches the history of one channel as concurrent ranges of ids.
+
+    The ids between `after` and `last_message_id` are split into `slices`
+    ranges, each paginated by its own worker into a file of its own. When a
+    worker is done and no range is left, it takes over the second half of
+    the range with the most messages left to fetch (estimated from the
+    density of the messages fetched so far), so the workers stay busy even
+    if the messages are not spread evenly. The ranges are passed to
+    `on_range` (a coroutine function), in order, as they are completed.
+    """
+
+    # A range is not split into ranges shorter than a minute.
+    MIN_SPAN = 60 * 1000 << 22
+
+    def __init__(self, iter_range, after, last_message_id, slices,
+                 parts_dir):
+        self.iter_range = iter_range
+        self.slices = slices
+        self.parts_dir = parts_dir
+        self._end = last_message_id + 1
+        bounds = [
+            after + (self._end - after) * i // slices for i in range(slices)
+        ]
+        # `after` and `before` are exclusive: each range ends at the id
+        #   that the next one starts after.
+        self.ranges = [
+            _HistoryRange(x, y + 1 if y else None)
+            for x, y in zip(bounds, bounds[1:] + [None])
+        ]
+        self._error = None
+
+    async def run(self, on_range):
+        workers = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.slices)
+        ]
+        try:
+            while self.ranges:
+                await self.ranges[0].finished.wait()
+                if self._error:
+                    raise self._error
+                await on_range(self.ranges.pop(0))
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self):
+        try:
+            while True:
+                history_range = self._next_range()
+                if history_range is None:
+                    return
+                await self._fetch(history_range)
+        except Exception as e:  # noqa
+            self._error = e
+            for x in self.ranges:
+                x.finished.set()
+
+    def _remaining(self, history_range, density):
+        # The number of messages left in a range, estimated from the density
+        #   of its messages so far (or of all of them, if it has none yet).
+        if history_range.num_messages:
+            density = history_range.num_messages / max(
+                history_range.position - history_range.after, 1)
+        return ((history_range.before or self._end) -
+                history_range.position) * density
+
+    def _next_range(self):
+        for history_range in self.ranges:
+            if not history_range.started:
+                history_range.started = True
+                return history_range
+        active = [
+            x for x in self.ranges if not x.finished.is_set()
+            and (x.before or self._end) - x.position > 2 * self.MIN_SPAN
+        ]
+        if not active:
+            return None
+        density = sum(x.num_messages for x in self.ranges) / max(
+            sum(x.position - x.after for x in self.ranges), 1) or 1
+        victim = max(active, key=lambda x: self._remaining(x, density))
+        middle = (victim.position + (victim.before or self._end)) // 2
+        history_range = _HistoryRange(middle, victim.before)
+        history_range.started = True
+        victim.before = middle + 1
+        self.ranges.insert(self.ranges.index(victim) + 1, history_range)
+        return history_range
+
+    async def _fetch(self, history_range):
+        history_range.path = self.parts_dir / f'{history_range.after}.ndjson'
+        with open(history_range.path, 'wb') as f:
+            async for message_id, line in self.iter_range(
+                    history_range.after, history_range.before):
+                # The range may have been split since it was requested.
+                before = history_range.before
+                if before and message_id >= before:
+                    break
+                f.write(line)
+                history_range.position = message_id
+                history_range.last_message_id = message_id
+                history_range.num_messages += 1
+        history_range.finished.set()
+
+
+def _same_emoji(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a['id'] == b['id']
+    return a == b
+
+
+def apply_journal_entry(message_dict, entry):
+    """Applies an entry of a `_MessageJournal` to the last known state of
+    its message (None if there is none yet), and returns the new state.
+
+    The content of the previous versions of an edited message is kept in
+    its `edit_history`, and a deleted message gets a `deleted_at` date.
+    """
+    op = entry['op']
+    if op in ['create', 'backfill', 'edit'] and 'message' in entry:
+        new_dict = entry['message']
+    elif message_dict is None:
+        # Only the full state of a message can be restored from nothing.
+        return None
+    elif op == 'edit':
+        new_dict = dict(message_dict)
+        data = entry['data']
+        for key, attr in [('content', 'content'), ('embeds', 'embeds'),
+                          ('pinned', 'pinned')]:
+            if key in data:
+                new_dict[attr] = data[key]
+        if data.get('edited_timestamp'):
+            new_dict['edited_at'] = str(
+                discord.utils.parse_time(data['edited_timestamp']))
+    else:
+        new_dict = dict(message_dict)
+
+    if message_dict is not None:
+        edit_history = message_dict.get('edit_history', [])
+        if (message_dict['content'], message_dict['edited_at']) != (
+                new_dict['content'], new_dict['edited_at']):
+            edit_history = edit_history + [{
+                'content': message_dict['content'],
+                'edited_at': message_dict['edited_at']
+            }]
+        if edit_history:
+            new_dict['edit_history'] = edit_history
+        if 'deleted_at' in message_dict:
+            new_dict['deleted_at'] = message_dict['deleted_at']
+
+    if op == 'delete':
+        new_dict['deleted_at'] = entry['at']
+    elif op == 'reaction_add':
+        reactions = [dict(x) for x in new_dict['reactions']]
+        for reaction in reactions:
+            if _same_emoji(reaction['emoji'], entry['emoji']):
+                reaction['count'] += 1
+                reaction['me'] = reaction['me'] or entry['me']
+                break
+        else:
+            reactions.append({
+                'is_custom_emoji': isinstance(entry['emoji'], dict),
+                'me': entry['me'],
+                'count': 1,
+                'emoji': entry['emoji']
+            })
+        new_dict['reactions'] = reactions
+    elif op == 'reaction_remove':
+        reactions = []
+        for reaction in new_dict['reactions']:
+            if _same_emoji(reaction['emoji'], entry['emoji']):
+                reaction = dict(reaction,
+                                count=reaction['count'] - 1,
+                                me=reaction['me'] and not entry['me'])
+                if reaction['count'] <= 0:
+                    continue
+            reactions.append(reaction)
+        new_dict['reactions'] = reactions
+    elif op == 'reaction_clear':
+        new_dict['reactions'] = []
+    elif op == 'reaction_clear_emoji':
+        new_dict['reactions'] = [
+            x for x in new_dict['reactions']
+            if not _same_emoji(x['emoji'], entry['emoji'])
+        ]
+    return new_dict
+
+
+class _MessageJournal:
+    """A local, append-only journal of the messages of a guild.
+
+    Once enabled, the messages that are sent, edited or deleted, and the
+    reactions that are added or removed, are appended to the journal as
+    they are received from the gateway, and the history that came before
+    is backfilled once. The journal is split into segments of
+    `JOURNAL_SEGMENT_SIZE` bytes, and indexed by channel and message in a
+    SQLite database, so that the latest state of the messages of a channel
+    can be exported without any API call.
+
+    `append` only queues the entries, on the event loop; they are written
+    to the segments and the index in batches, by a thread of the journal
+    (every second), or by `flush`.
+    """
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.path = Path(os.getenv('STATE_DIR', 'state'), str(guild_id),
+                         'journal')
+        self._state_file = self.path / 'state.json'
+        self.state = {'enabled': False, 'started_at': None, 'backfill': {}}
+        if self._state_file.exists():
+            self.state = json.loads(self._state_file.read_text())
+        self._db = None
+        self._file = None
+        self._segment = None
+        self._pending = []
+        self._lock = threading.Lock()  # Guards `_pending` and `_writer`.
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._closing = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.state['enabled']
+
+    @property
+    def ready(self):
+        # The journal has the whole history once the backfill is done.
+        return self.enabled and all(
+            x['status'] != 'pending' for x in self.state['backfill'].values())
+
+    def save_state(self):
+        tmp_file = self._state_file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(self.state))
+        os.replace(tmp_file, self._state_file)
+
+    def start(self, channel_ids):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Everything after this point is captured live.
+        self.state.update({
+            'enabled': True,
+            'started_at': discord.utils.time_snowflake(
+                datetime.now(timezone.utc)),
+            'backfill': {
+                str(x): {
+                    'status': 'pending',
+                    'cursor': None
+                }
+                for x in channel_ids
+            }
+        })
+        self.save_state()
+
+    def stop(self):
+        self.state['enabled'] = False
+        self.save_state()
+        self.close()
+
+    def _segment_path(self, segment):
+        return self.path / f'{segment:06d}.ndjson'
+
+    def _open(self):
+        # Used by the writer thread, and by `flush` in other threads, one at
+        #   a time.
+        self._db = sqlite3.connect(str(self.path / 'index.sqlite'),
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries (seq INTEGER '
+                         'PRIMARY KEY, channel_id INTEGER, message_id '
+                         'INTEGER, segment INTEGER, offset INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_message ON '
+                         'entries (channel_id, message_id, seq)')
+        # Index the entries that were written, but not indexed, before the
+        #   bot stopped; an entry that was only partly written is dropped.
+        last = self._db.execute('SELECT segment, offset FROM entries ORDER '
+                                'BY seq DESC LIMIT 1').fetchone()
+        segments = sorted(int(x.stem) for x in self.path.glob('*.ndjson'))
+        self._segment, offset = last or (segments[0] if segments else 1, 0)
+        for segment in [x for x in segments if x >= self._segment]:
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.seek(offset)
+                if last and segment == last[0]:
+                    f.readline()
+                while True:
+                    offset = f.tell()
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        f.truncate(offset)
+                        break
+                    entry = json.loads(line)
+                    self._db.execute(
+                        'INSERT INTO entries (channel_id, message_id, '
+                        'segment, offset) VALUES (?, ?, ?, ?)',
+                        (entry['channel_id'], entry['message_id'], segment,
+                         offset))
+            self._segment, offset, last = segment, 0, None
+        self._db.commit()
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+    def append(self, op, channel_id, message_id, **data):
+        entry = {
+            'op': op,
+            'channel_id': channel_id,
+            'message_id': message_id,
+            'at': str(datetime.now(timezone.utc)),
+            **data
+        }
+        with self._lock:
+            self._pending.append(entry)
+            if self._writer is None:
+                self._closing.clear()
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        # The entries are written out in batches (at least every second);
+        #   the ones that are lost on a crash are re-indexed by `_open`.
+        while not self._closing.wait(1):
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                logger.error('Could not write the journal: {!r}',
+                             e,
+                             server_id=self.guild_id,
+                             user_id=None)
+
+    def flush(self):
+        """Writes the queued entries to the journal.
+
+        This blocks, so it is meant to be used off the event loop, e.g. with
+        `run_blocking`.
+        """
+        with self._write_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+            if not entries:
+                return
+            start = None
+            try:
+                if self._file is None:
+                    self._open()
+                start = (self._segment, self._file.tell())
+                self._write(entries)
+            except BaseException:
+                # The batch is undone, and written again by the next flush.
+                if start:
+                    self._rollback(*start)
+                with self._lock:
+                    self._pending[:0] = entries
+                raise
+
+    def _write(self, entries):
+        segment_size = int(os.getenv('JOURNAL_SEGMENT_SIZE',
+                                     64 * 1024 * 1024))
+        rows = []
+        for entry in entries:
+            if self._file.tell() >= segment_size:
+                self._file.close()
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), 'ab')
+            rows.append((entry['channel_id'], entry['message_id'],
+                         self._segment, self._file.tell()))
+            self._file.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self._file.flush()
+        self._db.executemany(
+            'INSERT INTO entries (channel_id, message_id, segment, '
+            'offset) VALUES (?, ?, ?, ?)', rows)
+        self._db.commit()
+
+    def _rollback(self, segment, offset):
+        # Drops what a failed batch wrote after `offset` of `segment`, so
+        #   that it is not in the journal twice once it is written again.
+        try:
+            self._db.rollback()
+            self._file.close()
+            for path in self.path.glob('*.ndjson'):
+                if int(path.stem) > segment:
+                    path.unlink()
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(offset)
+            self._segment = segment
+            self._file = open(self._segment_path(segment), 'ab')
+        except (OSError, sqlite3.Error):
+            # `_open` checks the files against the index again.
+            self._file.close()
+            self._db.close()
+            self._file = self._db = None
+
+    def close(self):
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer:
+            self._closing.set()
+            writer.join()
+        self.flush()
+        with self._write_lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._db.close()
+            self._file = self._db = None
+
+    def stats(self):
+        segments = list(self.path.glob('*.ndjson'))
+        return len(segments), sum(x.stat().st_size for x in segments)
+
+    def export_channel(self, channel_id, spool, after=None):
+        """Writes the latest state of the messages of a channel (newer than
+        `after`) to `spool`, in order. Returns the number of messages, and
+        the id of the last one.
+
+        This only reads local files, so it is meant to be used off the event
+        loop, e.g. with `run_blocking`, after `flush`.
+        """
+        db = sqlite3.connect(str(self.path / 'index.sqlite'))
+        rows = db.execute(
+            'SELECT message_id, segment, offset FROM entries WHERE '
+            'channel_id = ? AND message_id > ? ORDER BY message_id, seq',
+            (int(channel_id), after or 0))
+        files = {}
+        num_messages = 0
+        last_message_id = None
+        try:
+            for message_id, entries in itertools.groupby(rows,
+                                                         key=lambda x: x[0]):
+                journal_entries = []
+                for _, segment, offset in entries:
+                    if segment not in files:
+                        files[segment] = open(self._segment_path(segment),
+                                              'rb')
+                    files[segment].seek(offset)
+                    journal_entries.append(
+                        json.loads(files[segment].readline()))
+                # A message can be backfilled after the events it got live,
+                #   so its backfilled state is applied first.
+                journal_entries.sort(key=lambda x: x['op'] != 'backfill')
+                message_dict = None
+                for entry in journal_entries:
+                    message_dict = apply_journal_entry(message_dict, entry)
+                if message_dict is None:
+                    continue
+                spool.write(json.dumps(message_dict).encode('utf-8') + b'\n')
+                num_messages += 1
+                last_message_id = message_id
+        finally:
+            for f in files.values():
+                f.close()
+            db.close()
+        return num_messages, last_message_id
+
+
+def run_blocking(func, *args):
+    """Runs a blocking function in a thread, off the event loop (in the
+    context of the caller, e.g. with its trace)."""
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(None,
+                                functools.partial(context.run, func, *args))
+
+
+def run_thread(func, *args):
+    """Like `run_blocking`, but in a thread of its own, for functions that
+    wait on other tasks (which could otherwise hold up the shared threads
+    that those tasks need)."""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def set_result(result, error):
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def run():
+        try:
+            result = context.run(func, *args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(set_result, None, e)
+        else:
+            loop.call_soon_threadsafe(set_result, result, None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def write_json_document(f, job, channel_ids, digests=None):
+    """Writes a backup in the single-document `json` export format.
+
+    The document is assembled from the spools of the job as it is written,
+    so it never has to be held in memory. The messages of a channel are
+    keyed by their date; like in the original format, only the first
+    (oldest) of the messages sent at the same time is kept. The digests of
+    the channels (of the messages that are kept) are added to `digests`, if
+    given.
+    """
+    digests = {} if digests is None else digests
+    f.write(b'{"channels": {')
+    for i, channel_id in enumerate(channel_ids):
+        if i:
+            f.write(b', ')
+        f.write(json.dumps(channel_id).encode('utf-8') + b': {')
+        digest = digests[channel_id] = _ChannelDigest()
+        last_created_at = None
+        with open(job.spool_path(channel_id), 'rb') as spool:
+            for line in spool:
+                message_dict = json.loads(line)
+                # The spools are in snowflake order, so messages sent at the
+                #   same time follow each other.
+                if message_dict['created_at'] == last_created_at:
+                    continue
+                if last_created_at is not None:
+                    f.write(b', ')
+                last_created_at = message_dict['created_at']
+                digest.update(line, message_dict['id'])
+                f.write(
+                    json.dumps(last_created_at).encode('utf-8') + b': ' +
+                    line.rstrip(b'\n'))
+        f.write(b'}')
+    f.write(b'}, "guild": ')
+    with open(job.path / 'guild.json', 'rb') as src:
+        shutil.copyfileobj(src, f, 1024 * 1024)
+    f.write(b', "members": ')
+    if job.has_json('members.json'):
+        with open(job.path / 'members.json', 'rb') as src:
+            shutil.copyfileobj(src, f, 1024 * 1024)
+    else:
+        # The compact form: {"tables": {...}, "members": {"<id>": {...}}}
+        f.write(b'{"tables": ' + job.read('member_tables.json') +
+                b', "members": {')
+        with open(job.path / 'members.ndjson', 'rb') as src:
+            for i, line in enumerate(src):
+                if i:
+                    f.write(b', ')
+                member_id = json.loads(line)['id']
+                f.write(
+                    json.dumps(str(member_id)).encode('utf-8') + b': ' +
+                    line.rstrip(b'\n'))
+        f.write(b'}}')
+    f.write(b'}')
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE guild (id INTEGER PRIMARY KEY, name TEXT, data TEXT);
+CREATE TABLE channels (id INTEGER PRIMARY KEY, name TEXT,
+                       num_messages INTEGER);
+CREATE TABLE roles (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE members (id INTEGER PRIMARY KEY, name TEXT, display_name TEXT,
+                      discriminator TEXT, bot INTEGER, joined_at TEXT,
+                      data TEXT);
+CREATE TABLE member_roles (member_id INTEGER, role_id INTEGER);
+CREATE TABLE messages (id INTEGER PRIMARY KEY, channel_id INTEGER,
+                       author_id INTEGER, created_at TEXT, content TEXT,
+                       data TEXT);
+CREATE TABLE mentions (message_id INTEGER, user_id INTEGER);
+CREATE TABLE reactions (message_id INTEGER, emoji TEXT, emoji_id INTEGER,
+                        count INTEGER);
+CREATE TABLE attachments (message_id INTEGER, id INTEGER, filename TEXT,
+                          url TEXT, sha256 TEXT);
+"""
+
+# Created once the tables are filled, which is faster than updating them
+#   on every insert.
+_SQLITE_INDEXES = [
+    'CREATE INDEX messages_channel_id ON messages (channel_id, created_at)',
+    'CREATE INDEX messages_author_id ON messages (author_id, created_at)',
+    'CREATE INDEX messages_created_at ON messages (created_at)',
+    'CREATE INDEX member_roles_role_id ON member_roles (role_id)',
+    'CREATE INDEX mentions_user_id ON mentions (user_id)',
+    'CREATE INDEX mentions_message_id ON mentions (message_id)',
+    'CREATE INDEX reactions_message_id ON reactions (message_id)',
+    'CREATE INDEX attachments_message_id ON attachments (message_id)'
+]
+
+# The columns of `messages` that are not repeated in its `data` column.
+_SQLITE_MESSAGE_COLUMNS = [
+    'id', 'channel', 'guild', 'author', 'created_at', 'content', 'mentions',
+    'reactions', 'attachments'
+]
+
+
+def write_sqlite_database(path,
+                          job,
+                          channel_ids,
+                          digests=None,
+                          batch_size=10000):
+    """Writes a backup in the `sqlite` export format.
+
+    The messages are read from the spools of the job and inserted in
+    batches, in a single transaction. The messages are indexed by channel,
+    author and date, and their content is indexed for full-text search (if
+    the SQLite library supports FTS5). The digests of the channels are
+    added to `digests`, if given.
+    """
+    digests = {} if digests is None else digests
+    db = sqlite3.connect(str(path), isolation_level=None)
+    # The database is written in one go, to a file that is discarded if
+    #   the backup fails, so it does not need to be crash-safe.
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.executescript(_SQLITE_SCHEMA)
+    db.execute('BEGIN')
+
+    guild_dict = job.read_json('guild.json')
+    db.execute('INSERT INTO guild VALUES (?, ?, ?)',
+               (guild_dict.get('id'), guild_dict.get('name'),
+                json.dumps(guild_dict)))
+    channel_names = {
+        x['id']: x['name']
+        for x in guild_dict.get('text_channels') or []
+    }
+    db.executemany('INSERT INTO channels VALUES (?, ?, ?)',
+                   [(int(x), channel_names.get(int(x)),
+                     job.channels[x]['num_messages']) for x in channel_ids])
+
+    members_dicts, tables = load_members(job.read)
+    roles = dict((tables or {}).get('roles', {}))
+    members, member_roles = [], []
+    for member_dict in members_dicts.values():
+        for role in member_dict['roles']:
+            if isinstance(role, dict):
+                roles[str(role['id'])] = role['name']
+                role = role['id']
+            member_roles.append((member_dict['id'], role))
+        members.append(
+            (member_dict['id'], member_dict['name'],
+             member_dict['display_name'], member_dict['discriminator'],
+             member_dict['bot'], member_dict['joined_at'],
+             json.dumps(member_dict)))
+    db.executemany('INSERT INTO roles VALUES (?, ?)',
+                   [(int(k), v) for k, v in roles.items()])
+    db.executemany('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   members)
+    db.executemany('INSERT INTO member_roles VALUES (?, ?)', member_roles)
+    del members_dicts, members, member_roles
+
+    rows = collections.defaultdict(list)
+    statements = {
+        'messages': 'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+        'mentions': 'INSERT INTO mentions VALUES (?, ?)',
+        'reactions': 'INSERT INTO reactions VALUES (?, ?, ?, ?)',
+        'attachments': 'INSERT INTO attachments VALUES (?, ?, ?, ?, ?)'
+    }
+
+    def flush():
+        for table, statement in statements.items():
+            db.executemany(statement, rows[table])
+        rows.clear()
+
+    for channel_id in channel_ids:
+        digest = digests[channel_id] = _ChannelDigest()
+        with open(job.spool_path(channel_id), 'rb') as spool:
+            for line in spool:
+                x = json.loads(line)
+                digest.update(line, x['id'])
+                rows['messages'].append(
+                    (x['id'], int(channel_id), x['author']['id'],
+                     x['created_at'], x['content'],
+                     json.dumps({
+                         k: v
+                         for k, v in x.items()
+                         if k not in _SQLITE_MESSAGE_COLUMNS
+                     })))
+                rows['mentions'].extend(
+                    (x['id'], v['id']) for v in x['mentions'])
+                for v in x['reactions']:
+                    emoji = v['emoji']
+                    if isinstance(emoji, dict):
+                        rows['reactions'].append(
+                            (x['id'], emoji['name'], emoji['id'], v['count']))
+                    else:
+                        rows['reactions'].append(
+                            (x['id'], emoji, None, v['count']))
+                rows['attachments'].extend(
+                    (x['id'], v['id'], v['filename'], v['url'],
+                     v.get('sha256')) for v in x['attachments'])
+                if len(rows['messages']) >= batch_size:
+                    flush()
+    flush()
+
+    for statement in _SQLITE_INDEXES:
+        db.execute(statement)
+    try:
+        db.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, "
+                   "content='messages', content_rowid='id')")
+        db.execute("INSERT INTO messages_fts (messages_fts) VALUES "
+                   "('rebuild')")
+    except sqlite3.OperationalError as e:
+        logger.warning('Skipping the full-text index of the messages ({}).',
+                       e,
+                       server_id=job.guild_id,
+                       user_id=None)
+    db.execute('COMMIT')
+    db.close()
+
+
+def write_blobs(archive, job, manifest=None):
+    # Each blob is written once, under `blobs/<sha256>`; deltas leave out
+    #   the blobs that an archive earlier in the chain already has.
+    shipped = set(manifest.data.get('blobs', [])) if manifest else set()
+    store = _BlobStore()
+    for sha256 in job.blobs():
+        if sha256 not in shipped:
+            archive.write_file(f'blobs/{sha256}',
+                               store.blob_path(sha256),
+                               compress=False)
+
+
+def write_segments(archive, job, channel_ids, segment_size, digests=None):
+    """Writes the messages of each channel in segments of `segment_size`
+    messages (`channels/<channel_id>/<n>.ndjson`), and returns their index.
+
+    The index records, for each channel and each of its segments, the number
+    of messages, the position of the first message in the channel and the
+    range of message ids, so that `ArchiveReader` only has to open the
+    segments it needs. The digests of the channels are added to `digests`,
+    if given.
+    """
+    digests = {} if digests is None else digests
+    index = {'segment_size': segment_size, 'channels': {}}
+    for channel_id in channel_ids:
+        segments = []
+        digest = digests[channel_id] = _ChannelDigest()
+        with open(job.spool_path(channel_id), 'rb') as spool:
+            lines = iter(spool)
+            for line in lines:
+                name = f'channels/{channel_id}/{len(segments):06d}.ndjson'
+                start = digest.num_messages
+                with archive.open_entry(name) as f:
+                    f.write(line)
+                    digest.update(line)
+                    first_message_id = digest.segments[-1][
+                        'last_message_id']
+                    for line in itertools.islice(lines, segment_size - 1):
+                        f.write(line)
+                        digest.update(line)
+                segments.append({
+                    'name': name,
+                    'offset': segment_size * len(segments),
+                    'num_messages': digest.num_messages - start,
+                    'first_message_id': first_message_id,
+                    'last_message_id': digest.segments[-1]['last_message_id']
+                })
+        index['channels'][channel_id] = {
+            'num_messages': sum(x['num_messages'] for x in segments),
+            'first_message_id':
+            segments[0]['first_message_id'] if segments else None,
+            'last_message_id':
+            segments[-1]['last_message_id'] if segments else None,
+            'segments': segments
+        }
+    return index
+
+
+# The digests of the messages of a channel are taken over segments of about
+#   this many messages (see `_ChannelDigest`).
+DIGEST_SEGMENT_SIZE = 1000
+
+
+class _ChannelDigest:
+    """The SHA-256 digests of the messages of a channel (its lines, as in
+    the spools), as a whole and in segments, with their number of messages
+    and range of message ids.
+
+    A segment ends after a message whose id has a CRC-32 under a threshold
+    (or after 4 times `segment_size` messages), so the boundaries only
+    depend on the ids around them: a message that was added, edited or
+    deleted between two backups only changes the digest of its segment, and
+    `diff_archives` only has to decode the segments that differ. Each
+    segment records the last message id of the previous one (`after`),
+    which identifies it across archives.
+    """
+
+    def __init__(self, segment_size=DIGEST_SEGMENT_SIZE):
+        self.segment_size = segment_size
+        self._threshold = (1 << 32) // segment_size
+        self._sha256 = hashlib.sha256()
+        self._segment_sha256 = None
+        self.num_messages = 0
+        self.segments = []
+
+    def update(self, line, message_id=None):
+        if message_id is None:
+            message_id = json.loads(line)['id']
+        if self._segment_sha256 is None:
+            self._segment_sha256 = hashlib.sha256()
+            self.segments.append({
+                'after':
+                self.segments[-1]['last_message_id']
+                if self.segments else None,
+                'num_messages': 0,
+                'first_message_id': message_id
+            })
+        segment = self.segments[-1]
+        self._sha256.update(line)
+        self._segment_sha256.update(line)
+        self.num_messages += 1
+        segment['num_messages'] += 1
+        segment['last_message_id'] = message_id
+        if (segment['num_messages'] >= 4 * self.segment_size
+                or zlib.crc32(message_id.to_bytes(8, 'little')) <
+                self._threshold):
+            segment['sha256'] = self._segment_sha256.hexdigest()
+            self._segment_sha256 = None
+
+    def to_dict(self):
+        if self._segment_sha256 is not None:
+            self.segments[-1]['sha256'] = self._segment_sha256.hexdigest()
+            self._segment_sha256 = None
+        return {
+            'num_messages': self.num_messages,
+            'first_message_id':
+            self.segments[0]['first_message_id'] if self.segments else None,
+            'last_message_id':
+            self.segments[-1]['last_message_id'] if self.segments else None,
+            'sha256': self._sha256.hexdigest(),
+            'segments': self.segments
+        }
+
+
+def _copy_lines(src, dst, digest):
+    # Copies the messages of a channel (one per line) in blocks of lines.
+    for lines in iter(lambda: src.readlines(1024 * 1024), []):
+        dst.write(b''.join(lines))
+        for line in lines:
+            digest.update(line)
+
+
+def write_digests(archive, export_format, digests):
+    """Writes the digests of the channels of an archive (`digests.json`),
+    which `verify_archive` and `diff_archives` read."""
+    archive.write_json(
+        'digests.json', {
+            'format': export_format,
+            'segment_size': DIGEST_SEGMENT_SIZE,
+            'channels': {k: v.to_dict()
+                         for k, v in digests.items()}
+        })
+
+
+class _ChannelWaiter:
+    """Lets the archive of a backup job be written (in another thread) while
+    its channels are still being fetched, by waiting for each channel to be
+    finished before it is read.
+    """
+
+    def __init__(self, job):
+        self._channels = {k: threading.Event() for k in job.channels}
+        self._all = threading.Event()
+        self._error = None
+        for channel_id, state in job.channels.items():
+            if state['status'] != 'pending':
+                self._channels[channel_id].set()
+
+    def finish(self, channel_id=None):
+        """Marks a channel (or, by default, all of them and their
+        attachments) as finished."""
+        if channel_id is None:
+            self._all.set()
+        else:
+            self._channels[str(channel_id)].set()
+
+    def abort(self, error):
+        self._error = error
+        self._all.set()
+        for event in self._channels.values():
+            event.set()
+
+    def wait(self, channel_id=None):
+        """Waits for a channel (or, by default, all of them) to be
+        finished."""
+        if channel_id is None:
+            self._all.wait()
+        else:
+            self._channels[channel_id].wait()
+        if self._error:
+            raise RuntimeError('The backup was interrupted.') from self._error
+
+
+def _done_channels(job, waiter=None):
+    # Lazily, so that each channel is waited for when it is reached.
+    for channel_id in list(job.channels):
+        if waiter:
+            waiter.wait(channel_id)
+        if job.channels[channel_id]['status'] == 'done':
+            yield channel_id
+
+
+def build_archive(job, data_fname, manifest=None, fileobj=None, waiter=None):
+    """Writes the archive of a backup job.
+
+    With a `waiter` (a `_ChannelWaiter`), the channels are written as they
+    are finished, in order, while the next ones are being fetched; only the
+    `sqlite` format has to wait for all of them.
+    """
+    archive = _ArchiveWriter(
+        job.options.get('compression', DEFAULT_COMPRESSION), fileobj)
+    try:
+        return _write_archive(archive, job, data_fname, manifest, waiter)
+    except BaseException:
+        archive.abort()
+        raise
+
+
+def _write_archive(archive, job, data_fname, manifest, waiter):
+    channel_ids = _done_channels(job, waiter)
+    export_format = job.options['export_format']
+    digests = {}
+
+    if export_format == 'json':
+        with archive.open_entry(Path(data_fname).stem) as f:
+            write_json_document(f, job, channel_ids, digests)
+        if waiter:
+            waiter.wait()
+        write_blobs(archive, job, manifest)
+        write_digests(archive, export_format, digests)
+        return archive.close()
+
+    if export_format == 'sqlite':
+        db_file = job.path / 'backup.sqlite'
+        if db_file.exists():
+            db_file.unlink()
+        if waiter:
+            waiter.wait()
+        write_sqlite_database(db_file, job, list(channel_ids), digests)
+        archive.write_file(Path(data_fname).stem, db_file)
+        db_file.unlink()
+        write_blobs(archive, job, manifest)
+        write_digests(archive, export_format, digests)
+        return archive.close()
+
+    guild_dict = job.read_json('guild.json')
+    if not manifest or manifest.guild_changed(guild_dict):
+        archive.write_json('guild.json', guild_dict)
+
+    removed_members = []
+    if manifest and manifest.chain:
+        # Deltas only carry the members that joined or changed.
+        members_dicts, tables = load_members(job.read)
+        changed_members, removed_members = manifest.diff_members(
+            members_dicts)
+        dump_members(archive, changed_members, tables)
+    else:
+        for name in ['members.json', 'members.ndjson', 'member_tables.json']:
+            if job.has_json(name):
+                archive.write_file(name, job.path / name)
+
+    if export_format == 'segmented':
+        archive.write_json(
+            'index.json',
+            write_segments(archive, job, channel_ids,
+                           int(os.getenv('SEGMENT_SIZE', 10000)), digests))
+    else:
+        for channel_id in channel_ids:
+            digests[channel_id] = _ChannelDigest()
+            with open(job.spool_path(channel_id), 'rb') as src, \
+                    archive.open_entry(f'channels/{channel_id}.ndjson') as f:
+                _copy_lines(src, f, digests[channel_id])
+    if waiter:
+        waiter.wait()
+    write_blobs(archive, job, manifest)
+    write_digests(archive, export_format, digests)
+
+    if manifest:
+        parent = manifest.chain[-1] if manifest.chain else None
+        archive.write_json(
+            'manifest.json', {
+                'type': 'delta' if parent else 'full',
+                'parent': parent,
+                'channels': {
+                    k: {
+                        'after': v['after'],
+                        'last_message_id': v['cursor']
+                    }
+                    for k, v in job.channels.items()
+                },
+                'removed_members': removed_members
+            })
+    return archive.close()
+
+
+class _BackupManifest:
+    """The state of the incremental backups of a guild, kept on local disk.
+
+    Stores the chain of archives since the last full snapshot, the last
+    backed up message of each channel, and the guild and members snapshots
+    the next delta is computed against.
+    """
+
+    def __init__(self, guild_id):
+        self.path = Path(os.getenv('STATE_DIR', 'state'), str(guild_id))
+        self.archives_dir = self.path / 'archives'
+        self.archives_dir.mkdir(parents=True, exist_ok=True)
+        self._file = self.path / 'manifest.json'
+        if self._file.exists():
+            self.data = json.loads(self._file.read_text())
+        else:
+            self.data = {
+                'chain': [],
+                'channels': {},
+                'guild': None,
+                'members': {}
+            }
+
+    @property
+    def chain(self):
+        return self.data['chain']
+
+    def last_message_id(self, channel_id):
+        return self.data['channels'].get(str(channel_id))
+
+    def diff_members(self, members_dicts):
+        # Round-trip through JSON so that keys and values compare as stored.
+        members_dicts = json.loads(json.dumps(members_dicts))
+        changed = {
+            k: v
+            for k, v in members_dicts.items()
+            if self.data['members'].get(k) != v
+        }
+        removed = [k for k in self.data['members'] if k not in members_dicts]
+        return changed, removed
+
+    def guild_changed(self, guild_dict):
+        return json.loads(json.dumps(guild_dict)) != self.data['guild']
+
+    def commit(self, archive_name, job):
+        self.data['chain'].append(archive_name)
+        self.data['channels'].update({
+            k: v['cursor']
+            for k, v in job.channels.items()
+            if v['status'] == 'done' and v['cursor']
+        })
+        self.data['guild'] = job.read_json('guild.json')
+        self.data['members'] = load_members(job.read)[0]
+        blobs = self.data.setdefault('blobs', [])
+        blobs.extend(set(job.blobs()) - set(blobs))
+        self.save()
+
+    def add_archive(self, archive_name, data_obj):
+        with open(self.archives_dir / archive_name, 'wb') as f:
+            shutil.copyfileobj(data_obj, f, 1024 * 1024)
+        data_obj.seek(0)
+
+    def compact(self, archive_name):
+        chain = list(self.chain)
+        archive = _ArchiveWriter(
+            os.getenv('COMPRESSION', DEFAULT_COMPRESSION))
+        meta = compact_archives([self.archives_dir / x for x in chain],
+                                archive)
+        meta.update({
+            'type': 'full',
+            'parent': None,
+            'channels': {
+                k: {
+                    'after': None,
+                    'last_message_id': v
+                }
+                for k, v in self.data['channels'].items()
+            },
+            'removed_members': [],
+            'compacted_from': chain
+        })
+        archive.write_json('manifest.json', meta)
+        data_obj = archive.close()
+
+        self.add_archive(archive_name, data_obj)
+        self.data['chain'] = [archive_name]
+        self.save()
+        for name in set(chain) - {archive_name}:
+            (self.archives_dir / name).unlink()
+        return data_obj
+
+    def save(self):
+        tmp_file = self._file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(self.data))
+        os.replace(tmp_file, self._file)
+
+
+def compact_archives(paths, archive):
+    """Merges a full archive and its chain of deltas into a full snapshot.
+
+    Deltas only hold messages newer than the previous archive in the chain,
+    so concatenating the channel entries in chain order keeps them sorted
+    and without duplicates.
+    """
+    guild_dict = None
+    members_dicts = {}
+    tables = None
+    channel_sources = {}
+    blob_sources = {}
+    for path in paths:
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+            meta = json.loads(zf.read('manifest.json'))
+            if 'guild.json' in names:
+                guild_dict = json.loads(zf.read('guild.json'))
+            _members_dicts, _tables = load_members(
+                lambda x: zf.read(x) if x in names else None)
+            members_dicts.update(_members_dicts)
+            if _tables is not None:
+                tables = tables or {'roles': {}, 'guilds': {}}
+                tables['roles'].update(_tables['roles'])
+                tables['guilds'].update(_tables['guilds'])
+            for member_id in meta['removed_members']:
+                members_dicts.pop(member_id, None)
+            for name in names:
+                if name.startswith('channels/'):
+                    channel_sources.setdefault(name, []).append(path)
+                elif name.startswith('blobs/'):
+                    blob_sources.setdefault(name, path)
+
+    archive.write_json('guild.json', guild_dict)
+    dump_members(archive, members_dicts, tables)
+    digests = {}
+    for name, sources in channel_sources.items():
+        digest = digests[Path(name).stem] = _ChannelDigest()
+        with archive.open_entry(name) as f:
+            for path in sources:
+                with zipfile.ZipFile(path) as zf, zf.open(name) as src:
+                    _copy_lines(src, f, digest)
+    for name, path in blob_sources.items():
+        with zipfile.ZipFile(path) as zf, zf.open(name) as src, \
+                archive.open_entry(name, compress=False) as f:
+            shutil.copyfileobj(src, f, 1024 * 1024)
+    write_digests(archive, 'ndjson', digests)
+    return meta
+
+
+def iter_chunks(f, avg_size, lines=True):
+    """Splits a file into content-defined chunks of about `avg_size` bytes.
+
+    A chunk ends after a line whose CRC-32 falls under a threshold that is
+    proportional to the length of the line, so the boundaries only depend on
+    the lines around them: messages added to (or edited in) a channel only
+    change the chunks they are in, and the other chunks are the same as in
+    the previous snapshots. Files that are not made of lines (`lines=False`,
+    e.g. attachments) are split every `avg_size` bytes.
+    """
+    if not lines:
+        while True:
+            chunk = f.read(avg_size)
+            if not chunk:
+                return
+            yield chunk
+    min_size, max_size = avg_size // 4, avg_size * 4
+    scale = (1 << 32) / (avg_size - min_size)
+    chunk = []
+    size = 0
+    for line in f:
+        chunk.append(line)
+        size += len(line)
+        if size >= max_size or (size >= min_size
+                                and zlib.crc32(line) < len(line) * scale):
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+class _LocalRepository:
+    """The objects of a `_Repository` in a local directory."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def list(self, prefix):
+        # Yields the key and size of each object.
+        root = self.path / prefix
+        if not root.exists():
+            return
+        for path in root.rglob('*'):
+            if path.is_file() and not path.name.endswith('.tmp'):
+                yield (path.relative_to(self.path).as_posix(),
+                       path.stat().st_size)
+
+    def get(self, key):
+        return (self.path / key).read_bytes()
+
+    def put(self, key, data):
+        path = self.path / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, path)
+
+    def delete(self, key):
+        (self.path / key).unlink()
+
+
+class _S3Repository:
+    """The objects of a `_Repository` in an S3 bucket."""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def list(self, prefix):
+        for obj in _get_s3_client().list_objects(self.bucket,
+                                                 prefix=self.prefix + prefix,
+                                                 recursive=True):
+            yield obj.object_name[len(self.prefix):], obj.size
+
+    def get(self, key):
+        response = _get_s3_client().get_object(self.bucket,
+                                                self.prefix + key)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def put(self, key, data):
+        _get_s3_client().put_object(self.bucket, self.prefix + key,
+                                    io.BytesIO(data), len(data))
+
+    def delete(self, key):
+        _get_s3_client().remove_object(self.bucket, self.prefix + key)
+
+
+class _Repository:
+    """A repository of backup snapshots (`REPOSITORY`), that stores each
+    chunk of data once, however many snapshots (of however many servers)
+    use it.
+
+    The files of a snapshot (the guild and members data, the messages of
+    each channel and the attachments) are split with `iter_chunks`, and each
+    chunk is stored, compressed, under the SHA-256 of its content
+    (`chunks/<sha256[:2]>/<sha256>`). A snapshot only uploads the chunks
+    that the repository does not have yet, so a daily snapshot of a server
+    uploads about as much as what changed since the day before. Its manifest
+    (`snapshots/<guild_id>/<name>.json`) lists the chunks of each file, and
+    is written last: a snapshot without a manifest never happened, and its
+    chunks are collected by `gc`.
+
+    `REPOSITORY` is a local directory, or `s3://<bucket>/<prefix>` (with the
+    `S3_*` settings).
+
+    Snapshots (of different servers) can be written at the same time, but
+    not while `gc` runs, since the chunks of a snapshot are not in a
+    manifest until it is done.
+    """
+
+    def __init__(self, location):
+        if location.startswith('s3://'):
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            self.store = _S3Repository(bucket, prefix)
+        else:
+            self.store = _LocalRepository(location)
+        self.chunk_size = int(os.getenv('CHUNK_SIZE', 1024 * 1024))
+        # The snapshots being written, or -1 while `gc` runs.
+        self._num_writers = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._num_writers >= 0)
+            self._num_writers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._num_writers -= 1
+                self._cond.notify_all()
+
+    @staticmethod
+    def chunk_key(sha256):
+        return f'chunks/{sha256[:2]}/{sha256}'
+
+    def chunks(self):
+        return {
+            key.rsplit('/', 1)[-1]: size
+            for key, size in self.store.list('chunks/')
+        }
+
+    def snapshots(self, guild_id=None):
+        """Returns the `(guild_id, name)` of the snapshots, oldest first."""
+        prefix = f'snapshots/{guild_id}/' if guild_id else 'snapshots/'
+        return sorted(
+            tuple(key[len('snapshots/'):-len('.json')].split('/'))
+            for key, _ in self.store.list(prefix) if key.endswith('.json'))
+
+    def read_manifest(self, guild_id, name):
+        return json.loads(self.store.get(f'snapshots/{guild_id}/{name}.json'))
+
+    def write_snapshot(self, job, name, waiter=None):
+        """Stores the data of a backup job as the snapshot `name`.
+
+        The channels are stored as they are finished, like `build_archive`
+        does with a `waiter`. The chunks are compressed and uploaded by
+        `S3_MAX_CONNECTIONS` threads. Returns the number of chunks and bytes
+        of the snapshot, and how many of them were new. Waits for `gc` to
+        finish first, if it is running.
+        """
+        with self._writing():
+            return self._write_snapshot(job, name, waiter)
+
+    def _write_snapshot(self, job, name, waiter):
+        known = set(self.chunks())
+        stats = {'chunks': 0, 'bytes': 0, 'new_chunks': 0, 'new_bytes': 0}
+        files = {}
+        workers = int(os.getenv('S3_MAX_CONNECTIONS', 10))
+        pending = collections.deque()
+
+        def put(sha256, chunk):
+            data = zlib.compress(chunk, 6)
+            self.store.put(self.chunk_key(sha256), data)
+            return len(data)
+
+        def add(arcname, path, lines=True):
+            refs = files[arcname] = []
+            with open(path, 'rb') as f:
+                for chunk in iter_chunks(f, self.chunk_size, lines):
+                    sha256 = hashlib.sha256(chunk).hexdigest()
+                    refs.append([sha256, len(chunk)])
+                    stats['chunks'] += 1
+                    stats['bytes'] += len(chunk)
+                    if sha256 in known:
+                        continue
+                    known.add(sha256)
+                    stats['new_chunks'] += 1
+                    # At most two chunks per thread are held in memory.
+                    if len(pending) >= 2 * workers:
+                        stats['new_bytes'] += pending.popleft().result()
+                    pending.append(executor.submit(put, sha256, chunk))
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            try:
+                add('guild.json', job.path / 'guild.json')
+                for member_file in [
+                        'members.json', 'members.ndjson', 'member_tables.json'
+                ]:
+                    if job.has_json(member_file):
+                        add(member_file, job.path / member_file)
+                for channel_id in _done_channels(job, waiter):
+                    add(f'channels/{channel_id}.ndjson',
+                        job.spool_path(channel_id))
+                if waiter:
+                    waiter.wait()
+                blob_store = _BlobStore()
+                for sha256 in job.blobs():
+                    add(f'blobs/{sha256}',
+                        blob_store.blob_path(sha256),
+                        lines=False)
+                while pending:
+                    stats['new_bytes'] += pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        self.store.put(
+            f'snapshots/{job.guild_id}/{name}.json',
+            json.dumps({
+                'guild_id': job.guild_id,
+                'name': name,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'channels': {
+                    k: {
+                        'num_messages': v['num_messages'],
+                        'last_message_id': v['cursor']
+                    }
+                    for k, v in job.channels.items() if v['status'] == 'done'
+                },
+                'files': files
+            }).encode('utf-8'))
+        return stats
+
+    def restore(self, guild_id, name, path):
+        """Writes the files of a snapshot under `path`."""
+        manifest = self.read_manifest(guild_id, name)
+        for arcname, refs in manifest['files'].items():
+            file_path = Path(path, arcname)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(file_path, 'wb') as f:
+                for sha256, size in refs:
+                    chunk = zlib.decompress(
+                        self.store.get(self.chunk_key(sha256)))
+                    if len(chunk) != size or hashlib.sha256(
+                            chunk).hexdigest() != sha256:
+                        raise ValueError(f'The chunk {sha256} of {arcname} '
+                                         'is corrupted.')
+                    f.write(chunk)
+        return manifest
+
+    def gc(self, guild_id, keep):
+        """Deletes the snapshots of a guild but the `keep` most recent ones,
+        then the chunks that no snapshot uses anymore (of any guild).
+
+        Returns the number of snapshots and chunks deleted, and the bytes
+        freed; or None, without deleting anything, if a snapshot is being
+        written (its chunks are not in a manifest yet). Snapshots wait for
+        `gc` to finish before they start.
+        """
+        with self._cond:
+            if self._num_writers:
+                return None
+            self._num_writers = -1
+        try:
+            return self._gc(guild_id, keep)
+        finally:
+            with self._cond:
+                self._num_writers = 0
+                self._cond.notify_all()
+
+    def _gc(self, guild_id, keep):
+        expired = self.snapshots(guild_id)[:-keep]
+        for expired_guild_id, name in expired:
+            self.store.delete(f'snapshots/{expired_guild_id}/{name}.json')
+
+        used = set()
+        for snapshot in self.snapshots():
+            for refs in self.read_manifest(*snapshot)['files'].values():
+                used.update(sha256 for sha256, _ in refs)
+        num_chunks = freed = 0
+        for sha256, size in self.chunks().items():
+            if sha256 not in used:
+                self.store.delete(self.chunk_key(sha256))
+                num_chunks += 1
+                freed += size
+        return len(expired), num_chunks, freed
+
+
+class _BlobStore:
+    """A content-addressed store of downloaded attachments and stickers.
+
+    Each file is stored once, under the SHA-256 of its content, however many
+    times it was posted and however many backups captured it. The index maps
+    the attachments and stickers ids to the hash of their content, so that a
+    file captured by a previous backup is not downloaded again.
+
+    The index is loaded (and compacted) once per process, and shared by the
+    stores of all the jobs; it is only appended to, under a lock, for files
+    that it does not have yet.
+    """
+
+    _indexes = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.path = Path(os.getenv('STATE_DIR', 'state'), 'blobs')
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index_file = self.path / 'index.ndjson'
+        with self._lock:
+            key = self.path.resolve()
+            if key not in self._indexes:
+                self._indexes[key] = self._load_index()
+            self._index = self._indexes[key]
+
+    def _load_index(self):
+        index = {}
+        num_lines = 0
+        if self._index_file.exists():
+            with open(self._index_file) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    index[entry['key']] = entry['sha256']
+                    num_lines += 1
+        if num_lines > len(index):
+            # Rewrites the index without the entries that were replaced.
+            tmp_file = self._index_file.with_suffix('.tmp')
+            with open(tmp_file, 'w') as f:
+                for key, sha256 in index.items():
+                    f.write(json.dumps({'key': key, 'sha256': sha256}) + '\n')
+            os.replace(tmp_file, self._index_file)
+        return index
+
+    def blob_path(self, sha256):
+        return self.path / sha256[:2] / sha256
+
+    def lookup(self, key):
+        sha256 = self._index.get(key)
+        if sha256 and self.blob_path(sha256).exists():
+            return sha256
+        return None
+
+    def add(self, key, tmp_file, sha256):
+        blob_path = self.blob_path(sha256)
+        if blob_path.exists():
+            os.unlink(tmp_file)
+        else:
+            blob_path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_file, blob_path)
+        with self._lock:
+            if self._index.get(key) == sha256:
+                return
+            self._index[key] = sha256
+            with open(self._index_file, 'a') as f:
+                f.write(json.dumps({'key': key, 'sha256': sha256}) + '\n')
+
+
+class _BlobDownloader:
+    """Downloads the attachments and stickers of the messages of a job.
+
+    At most `concurrency` files are downloaded at once (across all the
+    channels of the job), each streamed to disk while it is hashed. The
+    messages are passed through in order, with the `sha256` of each of their
+    files set, once these are in the blob store.
+    """
+
+    def __init__(self, job, concurrency):
+        self.job = job
+        self.store = _BlobStore()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        self._tasks = {}
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await self._session.close()
+
+    async def resolve(self, messages, window=100):
+        # Up to `window` messages are held back while their files download.
+        pending = collections.deque()
+        try:
+            async for x in messages:
+                files = [('attachment', v) for v in x['attachments']
+                         ] + [('sticker', v) for v in x['stickers']]
+                task = None
+                if files:
+                    task = asyncio.ensure_future(self._fetch_all(files))
+                pending.append((x, task))
+                while pending and (len(pending) >= window or
+                                   not pending[0][1] or pending[0][1].done()):
+                    x, task = pending.popleft()
+                    if task:
+                        await task
+                    yield x
+            while pending:
+                x, task = pending.popleft()
+                if task:
+                    await task
+                yield x
+        finally:
+            for _, task in pending:
+                if task:
+                    task.cancel()
+
+    async def _fetch_all(self, files):
+        hashes = await asyncio.gather(
+            *[self.fetch(f'{kind}:{v["id"]}', v['url']) for kind, v in files])
+        for (_, v), sha256 in zip(files, hashes):
+            v['sha256'] = sha256
+
+    def fetch(self, key, url):
+        # The same sticker is often in many messages; it is downloaded once.
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(
+                self._fetch(key, url))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return asyncio.shield(task)
+
+    async def _fetch(self, key, url):
+        sha256 = self.store.lookup(key)
+        if sha256 is None:
+            async with self._semaphore:
+                sha256 = await self._download(key, url)
+        if sha256:
+            self.job.add_blob(sha256)
+        return sha256
+
+    async def _download(self, key, url):
+        digest = hashlib.sha256()
+        fd, tmp_file = tempfile.mkstemp(dir=self.store.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async with self._session.get(url) as resp:
+                    resp.raise_for_status()
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            os.unlink(tmp_file)
+            logger.warning('Could not download {} ({}: {}).',
+                           url,
+                           type(e).__name__,
+                           e,
+                           server_id=self.job.guild_id,
+                           user_id=None)
+            return None
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+        sha256 = digest.hexdigest()
+        self.store.add(key, tmp_file, sha256)
+        return sha256
+
+
+def _encode_id_name(val):
+    # .name, .id (more details can be accessed through each key in the global
+    #   dict)
+    return {'id': val.id, 'name': val.name}
+
+
+def _encode_id_name_list(val):
+    # iterable; .name and .id
+    return [{'id': v.id, 'name': v.name} for v in val]
+
+
+def _encode_attachments(val):
+    # iterable; .id, .filename, .url --> the content is downloaded to the blob
+    #   store by `_BlobDownloader` (`data` is kept for compatibility)
+    return [{
+        'id': v.id,
+        'filename': v.filename,
+        'url': v.url,
+        'data': None
+    } for v in val]
+
+
+def _encode_embeds(val):
+    # iterable; access .to_dict()
+    return [v.to_dict() for v in val]
+
+
+def _encode_reference(val):
+    # .message_id, .channel_id, .guild_id, cached_message.system_content:
+    #   optional
+    if not val:
+        return None
+    val_content = {
+        'reference': {
+            'message_id': val.message_id,
+            'channel_id': val.channel_id,
+            'guild_id': val.guild_id
+        }
+    }
+    if val.cached_message:
+        val_content.update(
+            {'cached_message': val.cached_message.system_content})
+    else:
+        val_content.update({'cached_message': val.cached_message})
+    return val_content
+
+
+def _encode_reactions(val):
+    # iterable; .emoji, .is_custom_emoji, .me, .count. If custom_emoji:
+    #   [v.emoji.id, v.emoji.name, v.emoji.animated, v.emoji.animated,
+    #   v.emoji.managed]
+    val_content = []
+    for v in val:
+        if not hasattr(v, 'is_custom_emoji'):
+            # For compatibility with discord.py <= 1.7.3
+            is_custom_emoji = None
+        else:
+            is_custom_emoji = v.is_custom_emoji()
+
+        _d = {'is_custom_emoji': is_custom_emoji, 'me': v.me, 'count': v.count}
+        if isinstance(v.emoji, str):
+            _d.update({'emoji': v.emoji})
+        else:
+            if hasattr(v.emoji, 'managed'):
+                emoji_managed = v.emoji.managed
+            else:
+                emoji_managed = None
+            _d.update({
+                'emoji': {
+                    'id': v.emoji.id,
+                    'name': v.emoji.name,
+                    'animated': v.emoji.animated,
+                    'managed': emoji_managed
+                }
+            })
+        val_content.append(_d)
+    return val_content
+
+
+def _encode_stickers(val):
+    # iterable; .name, .id, .url --> the content is downloaded to the blob
+    #   store by `_BlobDownloader` (`data` is kept for compatibility)
+    if not val:  # For compatibility with discord.py <= 1.7.3
+        return []
+    return [{
+        'id': v.id,
+        'name': v.name,
+        'url': v.url,
+        'data': None
+    } for v in val]
+
+
+_public_attrs = {}
+
+
+def _encode_public_attrs(val):
+    # get all public attrs
+    keys = _public_attrs.get(type(val))
+    if keys is None:
+        keys = _public_attrs[type(val)] = [
+            k for k in dir(val)
+            if not k.startswith('_') and k not in ['count', 'index']
+        ]
+    return {k: getattr(val, k) for k in keys}
+
+
+# Attributes not listed here (methods, and "call", which is deprecated, or
+#   "nonce", which is almost always None) are not exported.
+_MESSAGE_ENCODERS = {
+    **{
+        attr: None
+        for attr in [
+            'activity', 'application', 'clean_content', 'content', 'id',
+            'jump_url', 'mention_everyone', 'pinned', 'system_content',
+            'tts', 'webhook_id', 'raw_channel_mentions', 'raw_mentions',
+            'raw_role_mentions', 'created_at'
+        ]
+    },  # as it is
+    'author': _encode_id_name,
+    'channel': _encode_id_name,
+    'guild': _encode_id_name,
+    'edited_at': str,
+    'channel_mentions': _encode_id_name_list,
+    'mentions': _encode_id_name_list,
+    'role_mentions': _encode_id_name_list,
+    'attachments': _encode_attachments,
+    'embeds': _encode_embeds,
+    'reference': _encode_reference,
+    'reactions': _encode_reactions,
+    'stickers': _encode_stickers,
+    'flags': _encode_public_attrs,
+    'type': _encode_public_attrs
+}
+
+_message_plans = {}
+
+
+def serialize_message(message):
+    """Converts a message to a dict of its exported attributes.
+
+    The attributes to export, and the encoder of each one, are looked up
+    once per message class (in `dir` order, like the keys of the exported
+    dict) and reused for every following message.
+    """
+    plan = _message_plans.get(type(message))
+    if plan is None:
+        plan = _message_plans[type(message)] = [
+            (attr, _MESSAGE_ENCODERS[attr]) for attr in dir(message)
+            if attr in _MESSAGE_ENCODERS
+        ]
+    return {
+        attr: encode(getattr(message, attr)) if encode else getattr(
+            message, attr)
+        for attr, encode in plan
+    }
+
+
+# "status" attrs are skipped (they require the presences intent), and
+#   "roles" is exported before the others.
+_MEMBER_ATTRS = [
+    'activities', 'bot', 'discriminator', 'display_name', 'id', 'joined_at',
+    'mention', 'mutual_guilds', 'name', 'pending', 'roles', 'system'
+]
+
+_permission_attrs = {}
+
+
+def _encode_permissions(permissions):
+    keys = _permission_attrs.get(type(permissions))
+    if keys is None:
+        keys = _permission_attrs[type(permissions)] = [
+            x for x in dir(permissions) if not x.startswith('_')
+            and not inspect.ismethod(getattr(permissions, x))
+        ]
+    return {x: getattr(permissions, x) for x in keys}
+
+
+def encode_member(member):
+    roles = [{'id': x.id, 'name': x.name} for x in member.roles]
+    member_dict = {
+        'guild_permissions': _encode_permissions(member.guild_permissions),
+        'roles': roles
+    }
+    for attr in _MEMBER_ATTRS:
+        if attr == 'joined_at':
+            val = str(member.joined_at)
+        elif attr == 'roles':
+            val = roles
+        elif attr == 'mutual_guilds':
+            if not hasattr(member, 'mutual_guilds'):
+                val = None
+            else:
+                val = [{
+                    'id': x.id,
+                    'name': x.name
+                } for x in member.mutual_guilds]
+        else:
+            val = getattr(member, attr)
+        member_dict[attr] = val
+    return member_dict
+
+
+def encode_member_compact(member, tables):
+    """Converts a member to the compact form of `encode_member`.
+
+    The permissions are stored as their integer value, and the roles and
+    mutual guilds as lists of ids, with their names added to `tables`
+    instead of being repeated for every member. The mention is left out, as
+    it is derived from the id. `expand_member` restores the verbose form.
+    """
+    for role in member.roles:
+        tables['roles'][str(role.id)] = role.name
+    member_dict = {
+        'guild_permissions': member.guild_permissions.value,
+        'roles': [x.id for x in member.roles]
+    }
+    for attr in _MEMBER_ATTRS:
+        if attr == 'joined_at':
+            val = str(member.joined_at)
+        elif attr in ['roles', 'mention']:
+            continue
+        elif attr == 'mutual_guilds':
+            if not hasattr(member, 'mutual_guilds'):
+                val = None
+            else:
+                val = []
+                for guild in member.mutual_guilds:
+                    tables['guilds'][str(guild.id)] = guild.name
+                    val.append(guild.id)
+        else:
+            val = getattr(member, attr)
+        member_dict[attr] = val
+    return member_dict
+
+
+def expand_member(member_dict, tables):
+    roles = [{
+        'id': x,
+        'name': tables['roles'][str(x)]
+    } for x in member_dict['roles']]
+    verbose_dict = {
+        'guild_permissions':
+        _encode_permissions(discord.Permissions(
+            member_dict['guild_permissions'])),
+        'roles':
+        roles
+    }
+    for attr in _MEMBER_ATTRS:
+        if attr == 'roles':
+            val = roles
+        elif attr == 'mention':
+            val = f'<@{member_dict["id"]}>'
+        elif attr == 'mutual_guilds' and member_dict[attr] is not None:
+            val = [{
+                'id': x,
+                'name': tables['guilds'][str(x)]
+            } for x in member_dict[attr]]
+        else:
+            val = member_dict[attr]
+        verbose_dict[attr] = val
+    return verbose_dict
+
+
+async def get_members(members_iterator):
+    members_dicts = {}
+    async for member in members_iterator:
+        member_dict = encode_member(member)
+        members_dicts[member_dict['id']] = member_dict
+    return members_dicts
+
+
+async def export_members_compact(members_iterator, f):
+    """Writes the members in the compact form, one per line, as they are
+    fetched, and returns the tables of role and guild names."""
+    tables = {'roles': {}, 'guilds': {}}
+    async for member in members_iterator:
+        f.write(
+            json.dumps(encode_member_compact(member, tables)).encode('utf-8') +
+            b'\n')
+    return tables
+
+
+def load_members(read):
+    """Loads the members from a job or an archive (`read` returns the
+    content of one of its files, or None if it does not exist).
+
+    Returns the members by id, and their tables if they are in the compact
+    form (None otherwise).
+    """
+    data = read('members.json')
+    if data is not None:
+        return json.loads(data), None
+    members_dicts = {}
+    for line in read('members.ndjson').splitlines():
+        member_dict = json.loads(line)
+        members_dicts[str(member_dict['id'])] = member_dict
+    return members_dicts, json.loads(read('member_tables.json'))
+
+
+def dump_members(archive, members_dicts, tables):
+    if tables is None:
+        archive.write_json('members.json', members_dicts)
+        return
+    with archive.open_entry('members.ndjson') as f:
+        for member_dict in members_dicts.values():
+            f.write(json.dumps(member_dict).encode('utf-8') + b'\n')
+    archive.write_json('member_tables.json', tables)
+
+
+def expand_members(members_dicts, tables):
+    if tables is None:
+        return members_dicts
+    return {k: expand_member(v, tables) for k, v in members_dicts.items()}
+
+
+def _changed_members(change):
+    # The members that a change of a `_MemberCache` updates.
+    if 'member' in change:
+        return [change['member']]
+    return change.get('members', [])
+
+
+class _MemberCache:
+    """The members of a guild, kept up to date from the gateway.
+
+    The cache is seeded from the member chunks that the gateway sends for
+    the guild, then updated by the member events, so that backups do not
+    have to fetch the whole member list again. Members are kept in the
+    compact form of `encode_member_compact` (as JSON), with their tables.
+
+    The cache is persisted under `STATE_DIR/<guild_id>/members`, as a
+    snapshot and a log of the changes since. It is only `synced` once it
+    has been seeded again by the current run, since the events that were
+    missed while the bot was offline are not in the log.
+
+    The changes are applied on the event loop, and written off it (with
+    `run_blocking`) one write at a time, in the order they were made.
+    """
+
+    def __init__(self, guild_id):
+        self.path = Path(os.getenv('STATE_DIR', 'state'), str(guild_id),
+                         'members')
+        self.members = {}
+        self.tables = {'roles': {}, 'guilds': {}}
+        self.synced = False
+        self._log = None
+        self._num_changes = 0
+        # The changes that are not written to the log yet.
+        self._pending = []
+        self._write_lock = None
+        # The roles of each member, and the members of each role.
+        self._member_roles = {}
+        self._role_members = collections.defaultdict(set)
+        # The members that changed while the cache is being seeded.
+        self._touched = None
+        if (self.path / 'tables.json').exists():
+            self._load()
+
+    def _load(self):
+        self.tables = json.loads((self.path / 'tables.json').read_text())
+        with open(self.path / 'members.ndjson', 'rb') as f:
+            for line in f:
+                member_dict = json.loads(line)
+                self.members[str(member_dict['id'])] = line.rstrip(b'\n')
+                self._index(str(member_dict['id']), member_dict['roles'])
+        log_file = self.path / 'changes.ndjson'
+        if log_file.exists():
+            with open(log_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Partly written.
+                    self._apply(json.loads(line))
+                    self._num_changes += 1
+
+    def _index(self, member_id, roles):
+        for role_id in self._member_roles.pop(member_id, ()):
+            self._role_members[role_id].discard(member_id)
+        if roles:
+            self._member_roles[member_id] = roles
+            for role_id in roles:
+                self._role_members[role_id].add(member_id)
+
+    def _apply(self, change):
+        for table, names in change.get('tables', {}).items():
+            self.tables[table].update(names)
+        # `members` is a batch of members (see `update_many`).
+        for member_dict in _changed_members(change):
+            self.members[str(member_dict['id'])] = json.dumps(
+                member_dict).encode('utf-8')
+            self._index(str(member_dict['id']), member_dict['roles'])
+        if 'removed' in change:
+            self.members.pop(change['removed'], None)
+            self._index(change['removed'], None)
+
+    def _append(self, change):
+        if self._touched is not None:
+            self._touched.update(
+                str(x['id']) for x in _changed_members(change))
+            if 'removed' in change:
+                self._touched.add(change['removed'])
+        self._apply(change)
+        self._pending.append(change)
+        self._num_changes += 1
+
+    def _writing(self):
+        # Created in the event loop of the bot.
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    async def flush(self):
+        """Writes the pending changes to the log, or a new snapshot if the
+        log has more changes than the snapshot has members."""
+        async with self._writing():
+            if self._num_changes > max(len(self.members), 1000):
+                await self._save()
+                return
+            # Taken once the previous writes are done, so that the changes
+            #   are written in order.
+            changes, self._pending = self._pending, []
+            if changes:
+                await run_blocking(self._write_log, changes)
+
+    def _write_log(self, changes):
+        if self._log is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._log = open(self.path / 'changes.ndjson', 'ab')
+        self._log.write(b''.join(
+            json.dumps(x).encode('utf-8') + b'\n' for x in changes))
+        self._log.flush()
+
+    async def save(self):
+        """Writes a snapshot of the cache, and clears the log."""
+        async with self._writing():
+            await self._save()
+
+    async def _save(self):
+        # The pending changes are in the snapshot already. The members that
+        #   change while it is written are in the next log.
+        self._pending = []
+        self._num_changes = 0
+        await run_blocking(self._write_snapshot, list(self.members.values()),
+                           json.dumps(self.tables))
+
+    def _write_snapshot(self, lines, tables_json):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path / 'members.ndjson.tmp'
+        with open(tmp_file, 'wb') as f:
+            for line in lines:
+                f.write(line + b'\n')
+        os.replace(tmp_file, self.path / 'members.ndjson')
+        tmp_file = self.path / 'tables.json.tmp'
+        tmp_file.write_text(tables_json)
+        os.replace(tmp_file, self.path / 'tables.json')
+        if self._log:
+            self._log.close()
+            self._log = None
+        (self.path / 'changes.ndjson').unlink(missing_ok=True)
+
+    def begin_seed(self):
+        self._touched = set()
+
+    @staticmethod
+    def _encode_seed(members_dicts):
+        # Runs in a thread.
+        members = {}
+        member_roles = {}
+        role_members = collections.defaultdict(set)
+        for member_id, member_dict in members_dicts.items():
+            members[member_id] = json.dumps(member_dict).encode('utf-8')
+            if member_dict['roles']:
+                member_roles[member_id] = member_dict['roles']
+                for role_id in member_dict['roles']:
+                    role_members[role_id].add(member_id)
+        return members, member_roles, role_members
+
+    async def seed(self, members_dicts, tables):
+        """Replaces the cache with the members of a guild, as encoded by
+        `encode_member_compact` since `begin_seed`; the members that changed
+        in the meantime are kept as they are in the cache."""
+        members, member_roles, role_members = await run_blocking(
+            self._encode_seed, members_dicts)
+        old_members, old_member_roles = self.members, self._member_roles
+        self.members = members
+        self._member_roles = member_roles
+        self._role_members = role_members
+        for member_id in self._touched:
+            if member_id in old_members:
+                self.members[member_id] = old_members[member_id]
+                self._index(member_id, old_member_roles.get(member_id))
+            else:
+                self.members.pop(member_id, None)
+                self._index(member_id, None)
+        self.tables = {k: dict(v, **tables[k]) for k, v in self.tables.items()}
+        self._touched = None
+        await self.save()
+        self.synced = True
+
+    async def update(self, member):
+        tables = {'roles': {}, 'guilds': {}}
+        self._append({
+            'member': encode_member_compact(member, tables),
+            'tables': tables
+        })
+        await self.flush()
+
+    async def update_many(self, members):
+        """Updates many members at once (e.g., those with a role that
+        changed), as a single change."""
+        if not members:
+            return
+        tables = {'roles': {}, 'guilds': {}}
+        self._append({
+            'members': [encode_member_compact(x, tables) for x in members],
+            'tables': tables
+        })
+        await self.flush()
+
+    def members_with_role(self, role_id):
+        """Returns the ids of the cached members that have a role."""
+        return sorted(self._role_members.get(role_id, ()), key=int)
+
+    async def update_tables(self, tables):
+        self._append({'tables': tables})
+        await self.flush()
+
+    async def remove(self, member_id):
+        self._append({'removed': str(member_id)})
+        await self.flush()
+
+    def dump(self, f):
+        """Writes the members, one per line, in the order of their ids."""
+        for member_id in sorted(self.members, key=int):
+            f.write(self.members[member_id] + b'\n')
+
+
+def get_guild(guild):
+    guild_dict = {}
+    guild_attr_get_id_name = [
+        'system_channel', 'voice_channels', 'text_channels',
+        'default_role', 'categories', 'stage_channels',
+        'premium_subscribers', 'channels', 'premium_subscriber_role',
+        'rules_channel', 'owner', 'self_role', 'public_updates_channel',
+        'members', 'me'
+    ]
+    special_guild_attrs = [
+        'afk_channel', 'verification_level', 'explicit_content_filter',
+        'default_notifications', 'voice_client'
+    ]
+    guild_is_level_attrs = ['nsfw_level', 'mfa_level']
+    for attr in dir(guild):
+        if attr.startswith('_') or inspect.ismethod(getattr(guild, attr)):
+            continue
+
+        val = getattr(guild, attr)
+
+        if attr in guild_is_level_attrs:
+            guild_dict[attr] = {
+                x: getattr(val, x)
+                for x in ['name', 'value']
+            }
+
+        elif attr == 'system_channel_flags':
+            guild_dict[attr] = {
+                k: getattr(val, k)
+                for k in dir(val) if not k.startswith('_')
+                if k not in ['count', 'index']
+            }
+
+        elif attr in special_guild_attrs:
+            if val:
+                try:
+                    guild_dict[attr] = val.name
+                except AttributeError:
+                    guild_dict[attr] = None
+            else:
+                guild_dict[attr] = val
+
+        elif attr in ['region', 'created_at']:
+            guild_dict[attr] = str(val)
+
+        elif attr == 'roles':
+            _vals = []
+            for _val in val:
+                _d = {
+                    x: getattr(_val, x)
+                    for x in dir(_val)
+                    if (not x.startswith('_') and not inspect.ismethod(
+                        getattr(_val, x)) and x != 'guild')
+                }
+                _d.pop('members')
+                for _k, _v in _d.items():
+                    if _k == 'created_at':
+                        _d[_k] = str(_d[_k])
+                    elif _k == 'color':
+                        _d[_k] = _d[_k].to_rgb()
+                    elif _k == 'permissions':
+                        _d[_k] = _d[_k].value
+                    elif _k == 'tags':
+                        _tags = {
+                            _tag: getattr(_d[_k], _tag)
+                            for _tag in dir(_d[_k]) if _tag in [
+                                'bot_id', 'integration_id',
+                                'premium_subscriber', 'unicode_emoji'
+                            ]
+                        }
+        elif attr in ['emojis', 'stickers']:
+            _vals = []
+            for _val in val:
+                _d = {
+                    x: getattr(_val, x)
+                    for x in dir(_val)
+                    if (not x.startswith('_') and not inspect.ismethod(
+                        getattr(_val, x)) and x != 'guild')
+                }
+                _d['created_at'] = str(_d['created_at'])
+                _vals.append(_d)
+
+            guild_dict[attr] = _vals
+
+        elif attr == 'icon':
+            if val:
+                guild_dict[attr] = val.url
+            else:
+                guild_dict[attr] = None
 
-    def fileio_upload(self, object_data):
-        url = 'https://file.io'
-        r = requests.post(
-            url,
-            files={'file': (self.object_name, object_data, 'application/zip')})
-        if r.status_code == 200:
-            return r.json()['link']
+        elif attr == 'preferred_locale':
+            guild_dict[attr] = val.name
+
+        elif attr == 'guild':
+            guild_dict[attr] = {
+                x: getattr(val, x)
+                for x in dir(val)
+                if (not x.startswith('_')
+                    and not inspect.ismethod(getattr(val, x)))
+            }
+        elif attr in guild_attr_get_id_name:
+            if not val:
+                continue
+            try:
+                iter(val)
+            except TypeError:
+                guild_dict[attr] = {
+                    x: getattr(val, x)
+                    for x in ['id', 'name']
+                }
+                continue
+
+            _vals = []
+            for _val in val:
+                _vals.append({x: getattr(_val, x) for x in ['id', 'name']})
+            guild_dict[attr] = _vals
+        else:
+            guild_dict[attr] = val
+    return guild_dict
 
 
 def update_embed(embed, cur_progress, total_channels, num_messages, message):
@@ -109,8 +3818,6 @@ def main():
 
     logger.configure(**config)
 
-    GET_DATA = False  # todo; if true, can only export as pickle.
-
     load_dotenv()
     intents = discord.Intents.default()
     try:
@@ -126,360 +3833,945 @@ def main():
         description='A Discord bot to automatically back up the server '
         'messages data.')
 
+    request_scheduler = _RequestScheduler(
+        float(os.getenv('API_RATE_LIMIT', 45)))
+    bot.http.request = request_scheduler.wrap(
+        _instrument_requests(bot.http.request))
+    logging.getLogger('discord.http').addHandler(_RateLimitHandler())
+    uploader = _Uploader()
+    close_bot = bot.close
+
+    async def close():
+        await uploader.close()
+        await close_bot()
+
+    bot.close = close
+    repository = _Repository(
+        os.getenv('REPOSITORY')) if os.getenv('REPOSITORY') else None
+
     @bot.event
-    async def on_ready():
-        print(f'Logged in as {bot.user.name} ({bot.user.id})')
-        print('-' * 80)
+    async def setup_hook():
+        pool = _get_worker_pool()
+        if pool:
+            # Start the workers now, rather than in the first backup.
+            for _ in range(_num_worker_processes()):
+                pool.submit(int)
 
-    def get_guild(guild):
-        guild_dict = {}
-        guild_attr_get_id_name = [
-            'system_channel', 'voice_channels', 'text_channels',
-            'default_role', 'categories', 'stage_channels',
-            'premium_subscribers', 'channels', 'premium_subscriber_role',
-            'rules_channel', 'owner', 'self_role', 'public_updates_channel',
-            'members', 'me'
-        ]
-        special_guild_attrs = [
-            'afk_channel', 'verification_level', 'explicit_content_filter',
-            'default_notifications', 'voice_client'
-        ]
-        guild_is_level_attrs = ['nsfw_level', 'mfa_level']
-        for attr in dir(guild):
-            if attr.startswith('_') or inspect.ismethod(getattr(guild, attr)):
-                continue
+        if not os.getenv('METRICS_PORT'):
+            return
 
-            val = getattr(guild, attr)
+        async def metrics(_):
+            return web.Response(
+                body=METRICS.render().encode('utf-8'),
+                headers={'Content-Type': 'text/plain; version=0.0.4'})
 
-            if attr in guild_is_level_attrs:
-                guild_dict[attr] = {
-                    x: getattr(val, x)
-                    for x in ['name', 'value']
-                }
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, os.getenv('METRICS_HOST', '127.0.0.1'),
+                          int(os.getenv('METRICS_PORT'))).start()
 
-            elif attr == 'system_channel_flags':
-                guild_dict[attr] = {
-                    k: getattr(val, k)
-                    for k in dir(val) if not k.startswith('_')
-                    if k not in ['count', 'index']
-                }
+    scheduler = _JobScheduler(int(os.getenv('MAX_CONCURRENT_JOBS', 2)),
+                              int(os.getenv('MAX_JOBS_PER_GUILD', 1)))
 
-            elif attr in special_guild_attrs:
-                if val:
-                    try:
-                        guild_dict[attr] = val.name
-                    except AttributeError:
-                        guild_dict[attr] = None
-                else:
-                    guild_dict[attr] = val
-
-            elif attr in ['region', 'created_at']:
-                guild_dict[attr] = str(val)
-
-            elif attr == 'roles':
-                _vals = []
-                for _val in val:
-                    _d = {
-                        x: getattr(_val, x)
-                        for x in dir(_val)
-                        if (not x.startswith('_') and not inspect.ismethod(
-                            getattr(_val, x)) and x != 'guild')
-                    }
-                    _d.pop('members')
-                    for _k, _v in _d.items():
-                        if _k == 'created_at':
-                            _d[_k] = str(_d[_k])
-                        elif _k == 'color':
-                            _d[_k] = _d[_k].to_rgb()
-                        elif _k == 'permissions':
-                            _d[_k] = _d[_k].value
-                        elif _k == 'tags':
-                            _tags = {
-                                _tag: getattr(_d[_k], _tag)
-                                for _tag in dir(_d[_k]) if _tag in [
-                                    'bot_id', 'integration_id',
-                                    'premium_subscriber', 'unicode_emoji'
-                                ]
-                            }
-            elif attr in ['emojis', 'stickers']:
-                _vals = []
-                for _val in val:
-                    _d = {
-                        x: getattr(_val, x)
-                        for x in dir(_val)
-                        if (not x.startswith('_') and not inspect.ismethod(
-                            getattr(_val, x)) and x != 'guild')
-                    }
-                    _d['created_at'] = str(_d['created_at'])
-                    _vals.append(_d)
+    def interrupted_jobs(guild_id):
+        # Jobs that are checkpointed on disk, but not queued or running.
+        scheduled = {x.id for x, _ in scheduler.jobs(guild_id)}
+        return [x for x in _BackupJob.all(guild_id) if x.id not in scheduled]
 
-                guild_dict[attr] = _vals
+    def queue_backup(guild, destination, job):
+        scheduler.submit(job,
+                         functools.partial(run_backup, guild, destination,
+                                           job))
 
-            elif attr == 'icon':
-                if val:
-                    guild_dict[attr] = val.url
-                else:
-                    guild_dict[attr] = None
+    schedules = {x.guild_id: x for x in _BackupSchedule.all()}
+    schedule_task = None
 
-            elif attr == 'preferred_locale':
-                guild_dict[attr] = val.name
+    async def start_scheduled_backup(schedule, now):
+        guild = bot.get_guild(schedule.guild_id)
+        destination = guild and guild.get_channel(
+            schedule.data['destination_id'])
+        if not destination:
+            logger.warning(
+                f'Skipped the scheduled backup of {schedule.guild_id}: the '
+                'server or its channel is gone.',
+                server_id=schedule.guild_id,
+                user_id=None)
+        elif _BackupJob.all(guild.id):
+            await destination.send(
+                '⏭️ Skipped the scheduled backup: a backup of this server '
+                'is still in progress, or was interrupted (use `!backup '
+                'resume` to continue it).')
+        else:
+            kind = schedule.data['kind']
+            await start_backup(guild,
+                               destination,
+                               incremental=kind == 'incremental',
+                               options=dict(schedule.data['options']),
+                               snapshot=kind == 'snapshot',
+                               scheduled=True)
+        schedule.advance(now)
 
-            elif attr == 'guild':
-                guild_dict[attr] = {
-                    x: getattr(val, x)
-                    for x in dir(val)
-                    if (not x.startswith('_')
-                        and not inspect.ismethod(getattr(val, x)))
-                }
-            elif attr in guild_attr_get_id_name:
-                if not val:
-                    continue
+    async def run_schedules():
+        """Starts the scheduled backups that are due, the longest overdue
+        first, while fewer than `MAX_SCHEDULED_JOBS` scheduled backups are
+        queued or running (so that they never take up all of the slots of
+        the job scheduler)."""
+        max_jobs = int(os.getenv('MAX_SCHEDULED_JOBS', 1))
+        while True:
+            now = datetime.now(timezone.utc)
+            due = sorted(
+                [x for x in schedules.values() if x.due_at <= now],
+                key=lambda x: x.due_at)
+            for schedule in due:
+                if len([
+                        x for x in scheduler.running() + scheduler.queued()
+                        if x.options.get('scheduled')
+                ]) >= max_jobs:
+                    break
                 try:
-                    iter(val)
-                except TypeError:
-                    guild_dict[attr] = {
-                        x: getattr(val, x)
-                        for x in ['id', 'name']
-                    }
-                    continue
+                    await start_scheduled_backup(schedule, now)
+                except Exception:  # noqa
+                    logger.exception(
+                        'Could not start the scheduled backup of '
+                        f'{schedule.guild_id}.',
+                        server_id=schedule.guild_id,
+                        user_id=None)
+                    schedule.advance(now)
+            await asyncio.sleep(30)
 
-                _vals = []
-                for _val in val:
-                    _vals.append({x: getattr(_val, x) for x in ['id', 'name']})
-                guild_dict[attr] = _vals
-            else:
-                guild_dict[attr] = val
-        return guild_dict
+    journals = {}
+    backfills = {}
+
+    def get_journal(guild_id):
+        if guild_id not in journals:
+            journals[guild_id] = _MessageJournal(guild_id)
+        return journals[guild_id]
+
+    def enabled_journal(guild_id):
+        if guild_id is None:
+            return None
+        journal = get_journal(guild_id)
+        return journal if journal.enabled else None
+
+    def encode_emoji(emoji):
+        # Like the emojis of `_encode_reactions`.
+        if emoji.id is None:
+            return emoji.name
+        return {
+            'id': emoji.id,
+            'name': emoji.name,
+            'animated': emoji.animated,
+            'managed': None
+        }
+
+    @bot.listen()
+    async def on_message(message):
+        journal = message.guild and enabled_journal(message.guild.id)
+        if journal:
+            message_dict = serialize_message(message)
+            message_dict['created_at'] = str(message_dict['created_at'])
+            journal.append('create',
+                           message.channel.id,
+                           message.id,
+                           message=message_dict)
+
+    @bot.listen()
+    async def on_raw_message_edit(payload):
+        journal = enabled_journal(payload.guild_id)
+        if not journal:
+            return
+        message = getattr(payload, 'message', None)  # discord.py >= 2.5
+        if message:
+            message_dict = serialize_message(message)
+            message_dict['created_at'] = str(message_dict['created_at'])
+            journal.append('edit',
+                           payload.channel_id,
+                           payload.message_id,
+                           message=message_dict)
+        else:
+            journal.append('edit',
+                           payload.channel_id,
+                           payload.message_id,
+                           data={
+                               k: v
+                               for k, v in payload.data.items() if k in [
+                                   'content', 'edited_timestamp', 'embeds',
+                                   'pinned'
+                               ]
+                           })
+
+    @bot.listen()
+    async def on_raw_message_delete(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            journal.append('delete', payload.channel_id, payload.message_id)
+
+    @bot.listen()
+    async def on_raw_bulk_message_delete(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            for message_id in sorted(payload.message_ids):
+                journal.append('delete', payload.channel_id, message_id)
+
+    @bot.listen()
+    async def on_raw_reaction_add(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            journal.append('reaction_add',
+                           payload.channel_id,
+                           payload.message_id,
+                           emoji=encode_emoji(payload.emoji),
+                           me=payload.user_id == bot.user.id)
+
+    @bot.listen()
+    async def on_raw_reaction_remove(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            journal.append('reaction_remove',
+                           payload.channel_id,
+                           payload.message_id,
+                           emoji=encode_emoji(payload.emoji),
+                           me=payload.user_id == bot.user.id)
+
+    @bot.listen()
+    async def on_raw_reaction_clear(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            journal.append('reaction_clear', payload.channel_id,
+                           payload.message_id)
+
+    @bot.listen()
+    async def on_raw_reaction_clear_emoji(payload):
+        journal = enabled_journal(payload.guild_id)
+        if journal:
+            journal.append('reaction_clear_emoji',
+                           payload.channel_id,
+                           payload.message_id,
+                           emoji=encode_emoji(payload.emoji))
+
+    async def backfill_journal(guild, journal):
+        # Fetches the messages that were sent before the journal was
+        #   enabled, once; the channels are checkpointed like backups.
+        before = discord.Object(id=journal.state['started_at'])
+        checkpoint_interval = int(os.getenv('CHECKPOINT_INTERVAL', 1000))
+        semaphore = asyncio.Semaphore(int(os.getenv('BACKUP_CONCURRENCY',
+                                                    1)))
+
+        async def backfill_channel(channel_id, state):
+            channel = guild.get_channel(int(channel_id))
+            async with semaphore:
+                if not channel:
+                    state['status'] = 'failed'
+                    return
+                after = None
+                if state['cursor']:
+                    after = discord.Object(id=state['cursor'])
+                num_messages = 0
+                try:
+                    async for x in iter_channel(channel,
+                                                after=after,
+                                                before=before):
+                        if not journal.enabled:
+                            return
+                        x['created_at'] = str(x['created_at'])
+                        journal.append('backfill',
+                                       channel.id,
+                                       x['id'],
+                                       message=x)
+                        num_messages += 1
+                        if num_messages % checkpoint_interval == 0:
+                            await run_blocking(journal.flush)
+                            state['cursor'] = x['id']
+                            journal.save_state()
+                    state['status'] = 'done'
+                except discord.errors.Forbidden:
+                    state['status'] = 'failed'
+                await run_blocking(journal.flush)
+                journal.save_state()
+
+        await asyncio.gather(*[
+            backfill_channel(k, v)
+            for k, v in journal.state['backfill'].items()
+            if v['status'] == 'pending'
+        ])
+        if journal.ready:
+            logger.info('The journal of {} is backfilled.',
+                        guild.name,
+                        server_id=guild.id,
+                        user_id=None)
+
+    def start_backfill(guild, journal):
+        if guild.id not in backfills or backfills[guild.id].done():
+            backfills[guild.id] = asyncio.ensure_future(
+                backfill_journal(guild, journal))
+
+    member_caches = {}
+    member_syncs = {}
+
+    def get_member_cache(guild_id):
+        if guild_id not in member_caches:
+            member_caches[guild_id] = _MemberCache(guild_id)
+        return member_caches[guild_id]
+
+    async def sync_member_cache(guild):
+        # Seeds the cache from the members that discord.py received from the
+        #   gateway (and asks for them if it did not); they are encoded in
+        #   batches, so that the gateway is not blocked on large servers.
+        if not guild.chunked:
+            await guild.chunk()
+        member_cache = get_member_cache(guild.id)
+        member_cache.begin_seed()
+        members_dicts = {}
+        tables = {'roles': {}, 'guilds': {}}
+        for n, member in enumerate(list(guild.members), 1):
+            members_dicts[str(member.id)] = encode_member_compact(
+                member, tables)
+            if n % 1000 == 0:
+                await asyncio.sleep(0)
+        await member_cache.seed(members_dicts, tables)
+
+    def start_member_sync(guild):
+        if guild.id not in member_syncs or member_syncs[guild.id].done():
+            member_syncs[guild.id] = asyncio.ensure_future(
+                sync_member_cache(guild))
+
+    async def update_member(user_id):
+        # The mutual guilds of a member are part of their state in each of
+        #   these guilds.
+        for guild in bot.guilds:
+            member = guild.get_member(user_id)
+            if member:
+                await get_member_cache(guild.id).update(member)
+
+    @bot.listen()
+    async def on_member_join(member):
+        await update_member(member.id)
 
-    async def get_members(members_iterator):
-        members_dicts = []
+    @bot.listen()
+    async def on_member_update(before, after):
+        await get_member_cache(after.guild.id).update(after)
 
-        members_as_is_attrs = [
-            'activities', 'bot', 'desktop_status', 'discriminator',
-            'display_name', 'id', 'joined_at', 'mention', 'mobile_status',
-            'mutual_guilds', 'name', 'pending', 'raw_status', 'roles',
-            'status', 'system', 'web_status'
+    @bot.listen()
+    async def on_user_update(before, after):
+        await update_member(after.id)
+
+    @bot.listen()
+    async def on_member_remove(member):
+        await get_member_cache(member.guild.id).remove(member.id)
+        await update_member(member.id)
+
+    @bot.listen()
+    async def on_guild_role_update(before, after):
+        # The name or the permissions of the role changed.
+        await get_member_cache(after.guild.id).update_many(after.members)
+
+    @bot.listen()
+    async def on_guild_role_delete(role):
+        member_cache = get_member_cache(role.guild.id)
+        members = [
+            role.guild.get_member(int(x))
+            for x in member_cache.members_with_role(role.id)
         ]
+        await member_cache.update_many([x for x in members if x])
 
-        async for member in members_iterator:
-            member_dict = {}
-            guild_permissions = {}
-            for x in dir(member.guild_permissions):
-                if not x.startswith('_'):
-                    _val = getattr(member.guild_permissions, x)
-                    if not inspect.ismethod(_val):
-                        guild_permissions[x] = _val
-            member_dict['guild_permissions'] = guild_permissions
-            member_dict['roles'] = [{
-                'id': x.id,
-                'name': x.name
-            } for x in member.roles]
-
-            for attr in members_as_is_attrs:
-                if attr in ['created_at', 'joined_at']:
-                    val = str(getattr(member, attr))
-                elif 'status' in attr:
-                    continue
-                elif attr in ['roles', 'mutual_guilds']:
-                    if attr == 'mutual_guilds' and not hasattr(
-                            member, 'mutual_guilds'):
-                        val = None
-                    else:
-                        _val = getattr(member, attr)
-                        val = [{'id': x.id, 'name': x.name} for x in _val]
-                else:
-                    val = getattr(member, attr)
-                member_dict[attr] = val
+    @bot.listen()
+    async def on_guild_update(before, after):
+        if before.name == after.name:
+            return
+        for guild in bot.guilds:
+            member_cache = get_member_cache(guild.id)
+            if str(after.id) in member_cache.tables['guilds']:
+                await member_cache.update_tables(
+                    {'guilds': {
+                        str(after.id): after.name
+                    }})
 
-            members_dicts.append(member_dict)
+    @bot.listen()
+    async def on_guild_join(guild):
+        start_member_sync(guild)
 
-        members_dicts = {x['id']: x for x in members_dicts}
-        return members_dicts
+    def export_cached_members(job, members, tables):
+        # Runs off the event loop, with a copy of the cache.
+        if job.options.get('member_format') == 'compact':
+            tmp_file = job.path / 'members.ndjson.tmp'
+            with open(tmp_file, 'wb') as f:
+                for member_id in sorted(members, key=int):
+                    f.write(members[member_id] + b'\n')
+            job.write_json('member_tables.json', tables)
+            os.replace(tmp_file, job.path / 'members.ndjson')
+        else:
+            job.write_json(
+                'members.json',
+                expand_members(
+                    {
+                        k: json.loads(members[k])
+                        for k in sorted(members, key=int)
+                    }, tables))
 
-    async def backup_channel(channel):
-        regular_types = [
-            'activity', 'application', 'clean_content', 'content', 'id',
-            'jump_url', 'mention_everyone', 'pinned', 'system_content', 'tts',
-            'webhook_id', 'raw_channel_mentions', 'raw_mentions',
-            'raw_role_mentions', 'created_at'
-        ]  # as it is
-        cls_methods = [
-            'clear_reaction', 'delete', 'pin', 'reply', 'publish',
-            'to_message_reference_dict', 'is_system', 'to_reference', 'unpin',
-            'ack', 'edit', 'add_reaction', 'remove_reaction', 'clear_reactions'
-        ]  # ignore these attrs
-        ignore = ['call', 'nonce'
-                  ]  # "call" is deprecated, "nonce" is almost always None
-
-        public_attrs = []
-        history = []
-
-        async for x in channel.history(limit=None):
-            d = {}
-            if not public_attrs:
-                public_attrs = [
-                    x for x in dir(x)
-                    if not x.startswith('_') and x not in cls_methods + ignore
-                ]
+    @bot.event
+    async def on_ready():
+        nonlocal schedule_task
+        print(f'Logged in as {bot.user.name} ({bot.user.id})')
+        print('-' * 80)
 
-            for attr in public_attrs:
-                val = getattr(x, attr)
-                if attr in regular_types:
-                    val_content = val
-                elif attr in ['author', 'channel', 'guild']:
-                    # .name, .id (more details can be accessed through each key
-                    #   in the global dict)
-                    val_content = {'id': val.id, 'name': val.name}
-                elif attr == 'edited_at':
-                    val_content = str(val)
-                elif attr in ['channel_mentions', 'mentions', 'role_mentions']:
-                    # iterable; .name and .id
-                    val_content = [{'id': v.id, 'name': v.name} for v in val]
-                elif attr == 'attachments':
-                    # iterable; .id, .filename, .url --> can be saved to bytes
-                    #   object with .read()
-                    val_content = []
-                    for v in val:
-                        if GET_DATA:
-                            attachments_data = v.read()
-                        else:
-                            attachments_data = None
-                        val_content.append({
-                            'id': v.id,
-                            'filename': v.filename,
-                            'url': v.url,
-                            'data': attachments_data
-                        })
-                elif attr == 'embeds':
-                    # iterable; access .to_dict()
-                    val_content = [v.to_dict() for v in val]
-                elif attr == 'reference':
-                    # .message_id, .channel_id, .guild_id,
-                    #   cached_message.system_content: optional
-                    if val:
-                        val_content = {
-                            attr: {
-                                'message_id': val.message_id,
-                                'channel_id': val.channel_id,
-                                'guild_id': val.guild_id
-                            }
-                        }
-                        if val.cached_message:
-                            val_content.update({
-                                'cached_message':
-                                val.cached_message.system_content
-                            })
-                        else:
-                            val_content.update(
-                                {'cached_message': val.cached_message})
-                    else:
-                        val_content = None
-                elif attr == 'reactions':
-                    # iterable; .emoji, .is_custom_emoji, .me, .count. If
-                    #   custom_emoji: [v.emoji.id, v.emoji.name,
-                    #   v.emoji.animated, v.emoji.animated, v.emoji.managed]
-                    val_content = []
-                    for v in val:
-                        if not hasattr(v, 'is_custom_emoji'):
-                            # For compatibility with discord.py <= 1.7.3
-                            is_custom_emoji = None
-                        else:
-                            is_custom_emoji = v.is_custom_emoji()
-
-                        _d = {
-                            'is_custom_emoji': is_custom_emoji,
-                            'me': v.me,
-                            'count': v.count
-                        }
-                        if isinstance(v.emoji, str):
-                            _d.update({'emoji': v.emoji})
-                        else:
-                            if hasattr(v.emoji, 'managed'):
-                                emoji_managed = v.emoji.managed
-                            else:
-                                emoji_managed = None
-                            _d.update({
-                                'emoji': {
-                                    'id': v.emoji.id,
-                                    'name': v.emoji.name,
-                                    'animated': v.emoji.animated,
-                                    'managed': emoji_managed
-                                }
-                            })
-                        val_content.append(_d)
-                elif attr == 'stickers':
-                    # iterable; .name, .id, .url --> can be saved to bytes
-                    #   object with .read()
-                    val_content = []
-                    if val:  # For compatibility with discord.py <= 1.7.3
-                        for v in val:
-                            if GET_DATA:
-                                stickers_data = v.read()
-                            else:
-                                stickers_data = None
-                            val_content.append({
-                                'id': v.id,
-                                'name': v.name,
-                                'url': v.url,
-                                'data': stickers_data
-                            })
-                elif attr in ['flags', 'type']:
-                    # get all public attrs
-                    val_content = {
-                        k: getattr(val, k)
-                        for k in dir(val) if not k.startswith('_')
-                        if k not in ['count', 'index']
-                    }
-                else:
+        if schedule_task is None:
+            schedule_task = asyncio.ensure_future(run_schedules())
+
+        for guild in bot.guilds:
+            start_member_sync(guild)
+            journal = get_journal(guild.id)
+            if journal.enabled and not journal.ready:
+                start_backfill(guild, journal)
+
+        if '--auto-resume' not in sys.argv:
+            return
+        for guild in bot.guilds:
+            for job in interrupted_jobs(guild.id):
+                destination = guild.get_channel(job.data['destination_id'])
+                if not destination:
                     continue
+                logger.info('Resuming the interrupted backup {} of {}.',
+                            job.id,
+                            guild.name,
+                            server_id=guild.id,
+                            user_id=None)
+                queue_backup(guild, destination, job)
+
+    async def iter_channel(channel, after=None, before=None):
+        async for x in channel.history(limit=None,
+                                       after=after,
+                                       before=before,
+                                       oldest_first=True):
+            start = time.perf_counter()
+            message_dict = serialize_message(x)
+            METRICS.inc('discord_backup_serialization_seconds_total',
+                        time.perf_counter() - start)
+            yield message_dict
+
+    def encode_message(message_dict):
+        # One line of a channel spool.
+        start = time.perf_counter()
+        message_dict['created_at'] = str(message_dict['created_at'])
+        line = json.dumps(message_dict).encode('utf-8') + b'\n'
+        METRICS.inc('discord_backup_serialization_seconds_total',
+                    time.perf_counter() - start)
+        METRICS.inc('discord_backup_serialized_bytes_total', len(line))
+        return line
+
+    async def export_channel(channel, job, downloader=None):
+        # Messages arrive in snowflake order (`oldest_first`), so each one can
+        #   be written out as soon as it is fetched, without sorting.
+        if job.options.get('source') == 'journal':
+            return await export_channel_journal(channel, job)
+        state = job.channels[str(channel.id)]
+        cursor = state['cursor']
+        num_messages = state['num_messages']
+        after = cursor or state['after']
+        if after:
+            after = discord.Object(id=after)
+        checkpoint_interval = int(os.getenv('CHECKPOINT_INTERVAL', 1000))
+        slices = int(os.getenv('CHANNEL_SLICES', 1))
+        if slices > 1 and channel.last_message_id and (
+                after.id if after else channel.id) < channel.last_message_id:
+            return await export_channel_sliced(channel, job, downloader,
+                                               slices)
+        messages = iter_channel(channel, after=after)
+        if downloader:
+            messages = downloader.resolve(messages)
+
+        with job.open_spool(channel.id) as spool:
+            async for x in messages:
+                spool.write(encode_message(x))
+                num_messages += 1
+                cursor = x['id']
+                if num_messages % checkpoint_interval == 0:
+                    job.checkpoint_channel(channel.id, spool, cursor,
+                                           num_messages)
+            job.checkpoint_channel(channel.id,
+                                   spool,
+                                   cursor,
+                                   num_messages,
+                                   status='done')
+        return num_messages
+
+    async def export_channel_journal(channel, job):
+        # Messages are read from the journal, without any API call.
+        state = job.channels[str(channel.id)]
+        journal = get_journal(job.guild_id)
+        await run_blocking(journal.flush)
+        with job.open_spool(channel.id) as spool:
+            num_messages, cursor = await run_blocking(
+                journal.export_channel, channel.id, spool, state['cursor']
+                or state['after'])
+            num_messages += state['num_messages']
+            job.checkpoint_channel(channel.id,
+                                   spool,
+                                   cursor or state['cursor'],
+                                   num_messages,
+                                   status='done')
+        return num_messages
+
+    async def export_channel_sliced(channel, job, downloader, slices):
+        # The ranges are fetched concurrently, and appended to the spool in
+        #   order as they are completed; the channel is checkpointed after
+        #   each one, so a resumed backup continues from the last range that
+        #   was appended.
+        state = job.channels[str(channel.id)]
+        cursor = state['cursor']
+        num_messages = state['num_messages']
+        parts_dir = job.path / 'channels' / f'{channel.id}.parts'
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        parts_dir.mkdir()
+
+        async def iter_range(after, before):
+            messages = iter_channel(
+                channel,
+                after=discord.Object(id=after),
+                before=discord.Object(id=before) if before else None)
+            if downloader:
+                messages = downloader.resolve(messages)
+            async for x in messages:
+                yield x['id'], encode_message(x)
+
+        # A channel id is the id of its creation time: the ids of its
+        #   messages are greater.
+        history = _SlicedHistory(iter_range,
+                                 cursor or state['after'] or channel.id,
+                                 channel.last_message_id, slices, parts_dir)
+        with job.open_spool(channel.id) as spool:
 
-                d.update({attr: val_content})
+            def copy_range(history_range):
+                # A range can be gigabytes: it is copied, and synced to disk,
+                #   off the event loop (the checkpoint is then quick).
+                with open(history_range.path, 'rb') as src:
+                    shutil.copyfileobj(src, spool, 1024 * 1024)
+                spool.flush()
+                os.fsync(spool.fileno())
+                history_range.path.unlink()
 
-            history.append(d)
+            async def append(history_range):
+                nonlocal cursor, num_messages
+                await run_blocking(copy_range, history_range)
+                num_messages += history_range.num_messages
+                cursor = history_range.last_message_id or cursor
+                job.checkpoint_channel(channel.id, spool, cursor,
+                                       num_messages)
 
-        history = {x['created_at']: x for x in history}
+            await history.run(append)
+            job.checkpoint_channel(channel.id,
+                                   spool,
+                                   cursor,
+                                   num_messages,
+                                   status='done')
+        shutil.rmtree(parts_dir)
+        return num_messages
 
-        history = dict(sorted(history.items()))
-        history = {str(k): v for k, v in history.items()}
-        for k, v in history.items():
-            v['created_at'] = str(v['created_at'])
-        return history
+    async def parse_channel_arg(ctx, arg):
+        if arg == 'all':
+            return None
+        if arg.isdigit():
+            return int(arg)
+        elif arg[2:-1].isdigit():
+            return int(arg[2:-1])
+        await ctx.send(f'❌ `{arg}` is not a valid channel!')
+        return False
 
-    @bot.command()
+    async def parse_options(ctx, options):
+        parsed = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            if key not in ['compression', 'attachments', 'source'
+                           ] or not value:
+                await ctx.send(f'❌ `{option}` is not a valid option!')
+                return None
+            parsed[key] = value
+        return parsed
+
+    async def start_backup(guild,
+                           destination,
+                           channel_id=None,
+                           incremental=False,
+                           options=None,
+                           snapshot=False,
+                           scheduled=False):
+        """Queues a backup of `guild`, which reports to the `destination`
+        channel. Returns the job, or None if the backup cannot start."""
+        options = options or {}
+        if snapshot and repository is None:
+            await destination.send('❌ Set `REPOSITORY` to take snapshots!')
+            return
+        compression = options.get(
+            'compression', os.getenv('COMPRESSION', DEFAULT_COMPRESSION))
+        try:
+            parse_compression(compression)
+        except ValueError as e:
+            await destination.send(f'❌ {e}')
+            return
+        attachments = options.get('attachments',
+                                  os.getenv('ATTACHMENTS', 'no'))
+        if attachments not in ['yes', 'no']:
+            await destination.send(
+                f'❌ Invalid value for `attachments`: `{attachments}` '
+                '(choose from: yes, no).')
+            return
+        # Backups are built from the journal of the server if it has one
+        #   (attachments are only downloaded from the API).
+        journal = get_journal(guild.id)
+        source = options.get(
+            'source',
+            'journal' if journal.ready and attachments == 'no' else 'api')
+        if source not in ['journal', 'api']:
+            await destination.send(
+                f'❌ Invalid value for `source`: `{source}` (choose from: '
+                'journal, api).')
+            return
+        if source == 'journal' and not journal.ready:
+            await destination.send(
+                '❌ The journal of this server is not enabled, or is not '
+                'backfilled yet! Use `!backup journal` to see its status.')
+            return
+
+        jobs = _BackupJob.all(guild.id)
+        if incremental and any(x.options['incremental'] for x in jobs):
+            await destination.send(
+                '❌ An incremental backup of this server is already in '
+                'progress! Use `!backup status` to see it.')
+            return
+
+        channels = [
+            channel for channel in guild.text_channels
+            if not channel_id or channel.id == channel_id
+        ]
+        after_ids = {}
+        if incremental:
+            manifest = _BackupManifest(guild.id)
+            after_ids = {
+                x.id: manifest.last_message_id(x.id)
+                for x in channels
+            }
+        job = _BackupJob(guild.id)
+        job.create([x.id for x in channels],
+                    destination.id, {
+                        'incremental':
+                        incremental,
+                        'snapshot':
+                        snapshot,
+                        'scheduled':
+                        scheduled,
+                        'export_format':
+                        'ndjson' if incremental or snapshot else os.getenv(
+                            'EXPORT_FORMAT', 'json'),
+                        # Snapshots are chunked by lines (see `iter_chunks`).
+                        'member_format':
+                        'compact' if snapshot else os.getenv(
+                            'MEMBER_FORMAT', 'verbose'),
+                        'compression':
+                        compression,
+                        'attachments':
+                        attachments == 'yes',
+                        'source':
+                        source
+                    },
+                    after_ids=after_ids)
+        queue_backup(guild, destination, job)
+
+        status = dict(scheduler.jobs(guild.id))[job]
+        if status != 'running':
+            await destination.send(
+                f'⏳ The backup `{job.id}` is {status}. It will start as '
+                'soon as the running backups finish.')
+        return job
+
+    @bot.group(invoke_without_command=True)
     @commands.has_permissions(administrator=True)
-    async def backup(ctx, arg=None):
+    async def backup(ctx, arg=None, *options):
         logger.info(
             f'Backup requested from {ctx.author.name} in {ctx.guild.name}.',
             server_id=ctx.author.id,
             user_id=ctx.guild.id)
 
-        clean_guild_name = re.sub(r'\W', '_', ctx.guild.name)
-
         if not arg:
             await ctx.send(
                 '❌ Specify at least one channel, or `!backup all` to backup '
                 'all channels.')
             return
 
-        channel_id = None
-        LEN_CHANNELS = len(ctx.guild.text_channels)
-        if arg != 'all':
-            if arg.isdigit():
-                channel_id = int(arg)
-            elif arg[2:-1].isdigit():
-                channel_id = int(arg[2:-1])
-            else:
-                await ctx.send(f'❌ `{arg}` is not a valid channel!')
+        channel_id = await parse_channel_arg(ctx, arg)
+        options = await parse_options(ctx, options)
+        if channel_id is False or options is None:
+            return
+        await start_backup(ctx.guild, ctx.channel, channel_id, options=options)
+
+    @backup.command(name='incremental')
+    @commands.has_permissions(administrator=True)
+    async def backup_incremental(ctx, arg='all', *options):
+        logger.info('Incremental backup requested from {} in {}.',
+                    ctx.author.name,
+                    ctx.guild.name,
+                    server_id=ctx.author.id,
+                    user_id=ctx.guild.id)
+
+        channel_id = await parse_channel_arg(ctx, arg)
+        options = await parse_options(ctx, options)
+        if channel_id is False or options is None:
+            return
+        await start_backup(ctx.guild,
+                           ctx.channel,
+                           channel_id,
+                           incremental=True,
+                           options=options)
+
+    @backup.command(name='snapshot')
+    @commands.has_permissions(administrator=True)
+    async def backup_snapshot(ctx, arg='all', *options):
+        logger.info('Snapshot requested from {} in {}.',
+                    ctx.author.name,
+                    ctx.guild.name,
+                    server_id=ctx.author.id,
+                    user_id=ctx.guild.id)
+
+        channel_id = await parse_channel_arg(ctx, arg)
+        options = await parse_options(ctx, options)
+        if channel_id is False or options is None:
+            return
+        await start_backup(ctx.guild,
+                           ctx.channel,
+                           channel_id,
+                           options=options,
+                           snapshot=True)
+
+    @backup.command(name='gc')
+    @commands.has_permissions(administrator=True)
+    async def backup_gc(ctx, keep=None):
+        if repository is None:
+            await ctx.send('❌ Set `REPOSITORY` to take snapshots!')
+            return
+        keep = keep or os.getenv('REPOSITORY_KEEP', '7')
+        if not keep.isdigit() or int(keep) < 1:
+            await ctx.send(f'❌ `{keep}` is not a valid number of snapshots '
+                           'to keep!')
+            return
+        result = await run_blocking(repository.gc, ctx.guild.id, int(keep))
+        if result is None:
+            await ctx.send('❌ A snapshot is in progress! Wait for it to '
+                           'finish, or cancel it first.')
+            return
+        num_snapshots, num_chunks, freed = result
+        await ctx.send(f'✅ Deleted {num_snapshots} expired snapshots, and '
+                       f'{num_chunks} unused chunks '
+                       f'({freed / 1024 ** 2:.1f} MiB).')
+
+    @backup.command(name='schedule')
+    @commands.has_permissions(administrator=True)
+    async def backup_schedule(ctx, expression=None, kind='full', *options):
+        schedule = schedules.get(ctx.guild.id) or _BackupSchedule(
+            ctx.guild.id)
+        if expression is None:
+            if not schedule.data:
+                await ctx.send('There are no scheduled backups for this '
+                               'server.')
+                return
+            await ctx.send(
+                f'Backups of this server are scheduled for '
+                f'`{schedule.data["expression"]}` '
+                f'({schedule.data["kind"]}); the next one starts at '
+                f'{schedule.due_at:%Y-%m-%d %H:%M} UTC.')
+            return
+        if expression == 'off':
+            schedule.remove()
+            schedules.pop(ctx.guild.id, None)
+            await ctx.send('✅ Scheduled backups are disabled.')
+            return
+
+        if kind not in ['full', 'incremental', 'snapshot']:
+            await ctx.send(f'❌ `{kind}` is not a valid kind of backup '
+                           '(choose from: full, incremental, snapshot).')
+            return
+        if kind == 'snapshot' and repository is None:
+            await ctx.send('❌ Set `REPOSITORY` to take snapshots!')
+            return
+        options = await parse_options(ctx, options)
+        if options is None:
+            return
+        try:
+            schedule.set(expression, kind, options, ctx.channel.id,
+                         datetime.now(timezone.utc))
+        except ValueError as e:
+            await ctx.send(f'❌ {e}')
+            return
+        schedules[ctx.guild.id] = schedule
+        await ctx.send(f'✅ Backups of this server are scheduled; the next '
+                       f'one starts at {schedule.due_at:%Y-%m-%d %H:%M} UTC.')
+
+    @backup.command(name='resume')
+    @commands.has_permissions(administrator=True)
+    async def backup_resume(ctx):
+        jobs = interrupted_jobs(ctx.guild.id)
+        if not jobs:
+            await ctx.send('❌ There is no interrupted backup to resume!')
+            return
+        for job in jobs:
+            queue_backup(ctx.guild, ctx, job)
+
+    @backup.command(name='status')
+    @commands.has_permissions(administrator=True)
+    async def backup_status(ctx):
+        jobs = scheduler.jobs(ctx.guild.id) + [
+            (x, 'interrupted (use `!backup resume` to continue it)')
+            for x in interrupted_jobs(ctx.guild.id)
+        ]
+        if not jobs:
+            await ctx.send('There are no backups in progress.')
+            return
+
+        lines = []
+        for job, status in jobs:
+            finished, total, num_messages = job.progress()
+            lines.append(f'`{job.id}`: {status} - {finished}/{total} '
+                         f'channels, {num_messages} messages.')
+        await ctx.send('\n'.join(lines))
+
+    @backup.command(name='cancel')
+    @commands.has_permissions(administrator=True)
+    async def backup_cancel(ctx, job_id=None):
+        jobs = [x for x, _ in scheduler.jobs(ctx.guild.id)]
+        jobs += interrupted_jobs(ctx.guild.id)
+        if job_id:
+            jobs = [x for x in jobs if x.id == job_id]
+        if not jobs:
+            await ctx.send('❌ There is no backup to cancel!')
+            return
+
+        for job in jobs:
+            if not scheduler.cancel(job.id):
+                job.discard()
+        await ctx.send(
+            f'✅ Cancelled: {", ".join(f"`{x.id}`" for x in jobs)}.')
+
+    @backup.command(name='journal')
+    @commands.has_permissions(administrator=True)
+    async def backup_journal(ctx, action=None):
+        journal = get_journal(ctx.guild.id)
+        if action == 'start':
+            if journal.enabled:
+                await ctx.send(
+                    '❌ The journal of this server is already enabled!')
+                return
+            journal.start([x.id for x in ctx.guild.text_channels])
+            start_backfill(ctx.guild, journal)
+            await ctx.send(
+                '✅ Enabled the journal of this server: new messages, edits, '
+                'deletions and reactions are now recorded, and the history '
+                'is being backfilled. Once it is done, backups will be built '
+                'from the journal.')
+        elif action == 'stop':
+            if not journal.enabled:
+                await ctx.send(
+                    '❌ The journal of this server is not enabled!')
                 return
+            await run_blocking(journal.stop)
+            await ctx.send(
+                '✅ Disabled the journal of this server. Backups will fetch '
+                'the messages from the API again.')
+        elif action is None:
+            if not journal.enabled:
+                await ctx.send(
+                    'The journal of this server is disabled. Use `!backup '
+                    'journal start` to enable it.')
+                return
+            backfill = journal.state['backfill'].values()
+            num_done = len([x for x in backfill if x['status'] != 'pending'])
+            num_segments, size = journal.stats()
+            await ctx.send(
+                f'The journal of this server is enabled '
+                f'({num_segments} segments, {size / 1e6:.1f} MB). Backfilled '
+                f'channels: {num_done}/{len(backfill)}.')
+        else:
+            await ctx.send(f'❌ `{action}` is not a valid action! (choose '
+                           'from: start, stop)')
+
+    @backup.command(name='compact')
+    @commands.has_permissions(administrator=True)
+    async def backup_compact(ctx):
+        if any(x.options['incremental']
+               for x in _BackupJob.all(ctx.guild.id)):
+            await ctx.send(
+                '❌ An incremental backup of this server is in progress! '
+                'Wait for it to finish, or cancel it first.')
+            return
 
-            LEN_CHANNELS = 1
+        manifest = _BackupManifest(ctx.guild.id)
+        if len(manifest.chain) < 2:
+            await ctx.send('❌ There are no incremental backups to compact!')
+            return
+
+        num_archives = len(manifest.chain)
+        clean_guild_name = re.sub(r'\W', '_', ctx.guild.name)
+        ts = datetime.now().strftime('%Y-%m-%d_%H.%M.%S')
+        data_fname = f'{clean_guild_name}_data_{ts}.ndjson.zip'
+        data_obj = await run_blocking(manifest.compact, data_fname)
+        data_url = await uploader.publish(
+            data_fname, lambda f: shutil.copyfileobj(data_obj, f, 1024 * 1024))
+        await ctx.send(f'✅ Compacted {num_archives} backups into a full '
+                       f'snapshot: {data_url}')
 
+    async def run_backup(guild, destination, job):
+        trace = None
+        if '--trace' in sys.argv:
+            # This task's context is copied to the tasks and threads that
+            #   it starts, so their spans are added to the same trace.
+            trace = _Trace(job)
+            _current_trace.set(trace)
+        try:
+            with _span('backup', job_id=job.id):
+                await _run_backup(guild, destination, job)
+        except asyncio.CancelledError:
+            if job.cancelled:
+                job.discard()
+            raise
+        except Exception:
+            await destination.send(
+                f'❌ The backup `{job.id}` failed! Use `!backup resume` to '
+                'retry it.')
+            raise
+        finally:
+            if trace:
+                trace.dump(Path('traces', f'{job.guild_id}_{job.id}.json'))
+
+    async def _run_backup(guild, destination, job):
+        clean_guild_name = re.sub(r'\W', '_', guild.name)
+        manifest = None
+        if job.options['incremental']:
+            manifest = _BackupManifest(guild.id)
+
+        LEN_CHANNELS = len(job.channels)
         LEN_MESSAGES = 0
         FINISHED_CHANNELS = 0
 
         global_start = time.time()
         success = []
         fail = []
+        channels = []
+        for channel_id, state in job.channels.items():
+            channel = guild.get_channel(int(channel_id))
+            if state['status'] == 'pending' and channel:
+                channels.append(channel)
+                continue
+            if state['status'] == 'pending':
+                job.set_status(channel_id, 'failed')
+            FINISHED_CHANNELS += 1
+            if job.channels[channel_id]['status'] == 'done':
+                LEN_MESSAGES += state['num_messages']
+                success.append(f'<#{channel_id}>')
+            else:
+                fail.append(f'<#{channel_id}>')
+
+        if FINISHED_CHANNELS or job.has_json('guild.json'):
+            starting_message = 'Resuming the interrupted backup process in 10 '
+        else:
+            starting_message = 'Starting the backup process in 10 '
 
         embed = discord.Embed(
             title='Backup Status',
@@ -497,76 +4789,168 @@ def main():
         embed.insert_field_at(
             index=2,
             name='Latest update:',
-            value='Starting the backup process in 10 seconds... '
+            value=f'{starting_message}seconds... '
             'This might take several minutes/hours depending on how '
             'many messages are on the server/channel.',
             inline=False)
-        status_message = await ctx.send(embed=embed)
-        time.sleep(10)
-
-        embed.set_field_at(index=2,
-                           name='Latest update:',
-                           value='Getting guild data...',
-                           inline=False)
+        status_message = await destination.send(embed=embed)
+        latest_update = embed.fields[2].value
+        running = []
 
-        SERVER = {'channels': {}}
+        def render_progress():
+            # The channels that are being backed up count their messages up
+            #   to their last checkpoint.
+            num_messages = LEN_MESSAGES + sum(
+                job.channels[str(x.id)]['num_messages'] for x in running)
+            message = latest_update
+            if running:
+                in_progress = [
+                    f'{x.mention} '
+                    f'({job.channels[str(x.id)]["num_messages"]} messages)'
+                    for x in running[:5]
+                ]
+                if len(running) > 5:
+                    in_progress.append(f'and {len(running) - 5} more')
+                message += f'\nIn progress: {", ".join(in_progress)}'
+            return update_embed(embed, FINISHED_CHANNELS, LEN_CHANNELS,
+                                num_messages, message)
 
-        guild_dict = get_guild(ctx.guild)
-        SERVER.update({'guild': guild_dict})
+        progress = _ProgressEmbed(status_message, render_progress,
+                                  float(os.getenv('PROGRESS_INTERVAL', 5)))
+        progress.start()
+        await asyncio.sleep(10)
 
-        embed.set_field_at(index=2,
-                           name='Latest update:',
-                           value='Getting members data...',
-                           inline=False)
+        if not job.has_json('guild.json'):
+            latest_update = 'Getting guild data...'
+            with _phase('guild'):
+                job.write_json('guild.json', get_guild(guild))
 
-        members_dicts = await get_members(ctx.guild.fetch_members())
-        SERVER.update({'members': members_dicts})
+        member_cache = get_member_cache(guild.id)
+        if not job.has_members() and member_cache.synced and len(
+                member_cache.members) == guild.member_count:
+            latest_update = 'Getting members data...'
+            with _phase('members'):
+                await run_blocking(
+                    export_cached_members, job, dict(member_cache.members),
+                    {k: dict(v)
+                     for k, v in member_cache.tables.items()})
+        elif not job.has_members():
+            if member_cache.synced:
+                # Some member events were missed: the members are fetched
+                #   from the API this time, and the cache is seeded again.
+                logger.warning(
+                    'The member cache of {} has {} members, but the server '
+                    'has {}; fetching them instead.',
+                    guild.name,
+                    len(member_cache.members),
+                    guild.member_count,
+                    server_id=guild.id,
+                    user_id=None)
+                start_member_sync(guild)
+            latest_update = 'Getting members data...'
+            with _phase('members'):
+                if job.options.get('member_format') == 'compact':
+                    tmp_file = job.path / 'members.ndjson.tmp'
+                    with open(tmp_file, 'wb') as f:
+                        tables = await export_members_compact(
+                            guild.fetch_members(), f)
+                    job.write_json('member_tables.json', tables)
+                    os.replace(tmp_file, job.path / 'members.ndjson')
+                else:
+                    job.write_json('members.json', await
+                                   get_members(guild.fetch_members()))
 
-        for channel in ctx.guild.text_channels:
-            if channel_id:
-                if channel.id != channel_id:
-                    continue
-            start = time.time()
-            try:
-                channel_history = await backup_channel(channel)
-            except discord.errors.Forbidden:
-                FINISHED_CHANNELS += 1
-                embed = update_embed(
-                    embed, FINISHED_CHANNELS, LEN_CHANNELS, LEN_MESSAGES,
-                    f'Could not access channel: [ {channel.name} ]! '
-                    'Skipping!\nResuming in 5 seconds...')
-                await status_message.edit(embed=embed)
-                fail.append(channel.mention)
-                time.sleep(5)
-                continue
+        # Each worker paginates one channel; discord.py shares the rate limit
+        #   buckets between concurrent requests, so they are still respected.
+        semaphore = asyncio.Semaphore(int(os.getenv('BACKUP_CONCURRENCY',
+                                                    1)))
 
-            FINISHED_CHANNELS += 1
-            LEN_MESSAGES += len(channel_history)
-            embed = update_embed(
-                embed, FINISHED_CHANNELS, LEN_CHANNELS, LEN_MESSAGES,
-                f'There were {len(channel_history)} messages in '
-                f'{channel.mention} (took {round(time.time() - start, 2)}s).')
+        async def backup_worker(channel, downloader=None):
+            nonlocal latest_update, FINISHED_CHANNELS, LEN_MESSAGES
 
-            await status_message.edit(embed=embed)
-            success.append(channel.mention)
+            async with semaphore:
+                start = time.time()
+                running.append(channel)
+                try:
+                    with _span(f'#{channel.name}', channel_id=channel.id):
+                        num_messages = await export_channel(
+                            channel, job, downloader)
+                except discord.errors.Forbidden:
+                    job.set_status(channel.id, 'failed')
+                    FINISHED_CHANNELS += 1
+                    latest_update = (f'Could not access channel: '
+                                     f'[ {channel.name} ]! Skipping!')
+                    fail.append(channel.mention)
+                    return
+                finally:
+                    running.remove(channel)
+                    waiter.finish(channel.id)
 
-            SERVER['channels'].update({channel.id: channel_history})
+                FINISHED_CHANNELS += 1
+                LEN_MESSAGES += num_messages
+                latest_update = (f'There were {num_messages} messages in '
+                                 f'{channel.mention} '
+                                 f'(took {round(time.time() - start, 2)}s).')
+                success.append(channel.mention)
 
+        # The archive is written, and uploaded, while the channels are
+        #   fetched: each channel is added to it as soon as it is finished.
         ts = datetime.now().strftime('%Y-%m-%d_%H.%M.%S')
-        data_fname = f'{clean_guild_name}_data_{ts}.json.zip'
-
-        uf = _UploadFile(SERVER, data_fname)
-        data_obj = uf.get_compressed_file_object()
-        if '--use-all-services' in sys.argv:
-            presign_url = uf.upload_s3_object(data_obj)
-            data_url = uf.shorten_url(presign_url)
+        data_fname = (f'{clean_guild_name}_data_{ts}.'
+                      f'{job.options["export_format"]}.zip')
+        waiter = _ChannelWaiter(job)
+        snapshot = job.options.get('snapshot')
+        if snapshot:
+            # Snapshots go to the repository instead, one chunk at a time.
+            if repository is None:
+                raise RuntimeError('REPOSITORY is not set.')
+            publishing = run_thread(repository.write_snapshot, job, ts,
+                                    waiter)
         else:
-            data_url = uf.fileio_upload(data_obj)
+            publishing = asyncio.ensure_future(
+                uploader.publish(
+                    data_fname, lambda f: build_archive(
+                        job, data_fname, manifest, f, waiter),
+                    [manifest.archives_dir / data_fname] if manifest else []))
+
+        latest_update = 'Getting channels data...'
+        try:
+            with _phase('channels'):
+                if job.options.get('attachments'):
+                    async with _BlobDownloader(
+                            job, int(os.getenv('DOWNLOAD_CONCURRENCY',
+                                               4))) as downloader:
+                        await asyncio.gather(
+                            *[backup_worker(x, downloader) for x in channels])
+                else:
+                    await asyncio.gather(*[backup_worker(x) for x in channels])
+        except BaseException as e:
+            waiter.abort(e)
+            publishing.cancel()
+            raise
+        waiter.finish()
+        progress.stop()
 
-        embed = embed.insert_field_at(index=3,
-                                      name='Data download link:',
-                                      value=data_url,
-                                      inline=False)
+        with _phase('upload'):
+            data_url = await publishing
+        if manifest:
+            manifest.commit(data_fname, job)
+        job.discard()
+
+        if snapshot:
+            embed = embed.insert_field_at(
+                index=3,
+                name='Snapshot:',
+                value=f'`{ts}`: {data_url["new_chunks"]} of '
+                f'{data_url["chunks"]} chunks were new '
+                f'({data_url["new_bytes"] / 1024 ** 2:.1f} MiB uploaded, '
+                f'{data_url["bytes"] / 1024 ** 2:.1f} MiB in total).',
+                inline=False)
+        else:
+            embed = embed.insert_field_at(index=3,
+                                          name='Data download link:',
+                                          value=data_url,
+                                          inline=False)
 
         await status_message.edit(embed=embed)
 
@@ -585,5 +4969,466 @@ def main():
     bot.run(token)
 
 
+class ArchiveReader:
+    """Reads the messages of a `segmented` archive lazily.
+
+    Only the index is read when the archive is opened; the segments of a
+    channel are then opened one at a time as its messages are iterated, and
+    the segments outside of the requested range are not opened at all.
+    """
+
+    def __init__(self, path):
+        self._zf = zipfile.ZipFile(path)
+        self.index = json.loads(self._zf.read('index.json'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._zf.close()
+
+    def channels(self):
+        return self.index['channels']
+
+    def iter_messages(self, channel_id, after=None, before=None):
+        """Yields the messages of a channel in chronological order.
+
+        `after` and `before` (exclusive) can be datetimes (UTC if they are
+        naive) or message ids.
+        """
+        if isinstance(after, datetime):
+            after = discord.utils.time_snowflake(
+                after.replace(tzinfo=after.tzinfo or timezone.utc),
+                high=True)
+        if isinstance(before, datetime):
+            before = discord.utils.time_snowflake(
+                before.replace(tzinfo=before.tzinfo or timezone.utc),
+                high=False)
+        for segment in self.channels()[str(channel_id)]['segments']:
+            if after is not None and segment['last_message_id'] <= after:
+                continue
+            if before is not None and segment['first_message_id'] >= before:
+                break
+            with self._zf.open(segment['name']) as f:
+                for line in f:
+                    message = json.loads(line)
+                    if after is not None and message['id'] <= after:
+                        continue
+                    if before is not None and message['id'] >= before:
+                        break
+                    yield message
+
+
+class _JsonDocumentScanner:
+    """Reads the messages of a `json` document (as `write_json_document`
+    writes it) one at a time, as they are decompressed, instead of loading
+    the whole document."""
+
+    def __init__(self, f):
+        self._f = f
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+
+    def _fill(self):
+        data = self._f.read(1024 * 1024)
+        if not data:
+            raise ValueError('The document is truncated.')
+        self._buf = self._buf[self._pos:] + self._text_decoder.decode(data)
+        self._pos = 0
+
+    def skip(self, token):
+        """Skips `token` if it comes next, and returns whether it did."""
+        while len(self._buf) - self._pos < len(token):
+            self._fill()
+        if self._buf.startswith(token, self._pos):
+            self._pos += len(token)
+            return True
+        return False
+
+    def expect(self, token):
+        if not self.skip(token):
+            raise ValueError(f'Expected {token!r} at '
+                             f'{self._buf[self._pos:self._pos + 20]!r}.')
+
+    def value(self):
+        """Returns the next value (a string or an object) and its text."""
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # The value is (probably) cut at the end of the buffer.
+                self._fill()
+                continue
+            text = self._buf[self._pos:end]
+            self._pos = end
+            return value, text
+
+    def messages(self):
+        """Yields the channel id and the line of each message."""
+        self.expect('{"channels": {')
+        if self.skip('}'):
+            return
+        while True:
+            channel_id, _ = self.value()
+            self.expect(': {')
+            if not self.skip('}'):
+                while True:
+                    self.value()  # The date of the message.
+                    self.expect(': ')
+                    _, text = self.value()
+                    yield channel_id, (text + '\n').encode('utf-8')
+                    if self.skip('}'):
+                        break
+                    self.expect(', ')
+            if self.skip('}'):
+                return
+            self.expect(', ')
+
+
+def _iter_archive_lines(zf, export_format, wanted=None):
+    """Yields the channel id, the position in the channel and the line of
+    the messages of an archive, in order.
+
+    `wanted` maps the channels to read to the ranges of positions to yield
+    (`None` for all of them); the entries of the other channels, and the
+    segments of a `segmented` archive outside of the ranges, are not
+    decompressed. Without `wanted`, every message is yielded and every
+    entry of messages is read to its end, so its CRC-32 is checked.
+    """
+
+    def ranges(channel_id):
+        if wanted is None:
+            return [(0, float('inf'))]
+        return wanted.get(channel_id) or []
+
+    def select(channel_id, lines, start=0):
+        channel_ranges = ranges(channel_id)
+        end = max((x[1] for x in channel_ranges), default=0)
+        for position, line in enumerate(lines, start):
+            if wanted is not None and position >= end:
+                return
+            if any(a <= position < b for a, b in channel_ranges):
+                yield channel_id, position, line
+
+    if export_format == 'json':
+        name = next(x for x in zf.namelist() if '/' not in x
+                    and x.endswith('.json') and x != 'digests.json')
+        with zf.open(name) as f:
+            scanner = _JsonDocumentScanner(f)
+            for channel_id, lines in itertools.groupby(
+                    scanner.messages(), key=lambda x: x[0]):
+                yield from select(channel_id, (x[1] for x in lines))
+            if wanted is None:
+                while f.read(1024 * 1024):
+                    pass
+    elif export_format == 'segmented':
+        index = json.loads(zf.read('index.json'))
+        for channel_id, channel in index['channels'].items():
+            channel_ranges = ranges(channel_id)
+            for segment in channel['segments']:
+                start = segment['offset']
+                if not any(a < start + segment['num_messages'] and start < b
+                           for a, b in channel_ranges):
+                    continue
+                with zf.open(segment['name']) as f:
+                    yield from select(channel_id, f, start)
+    elif export_format == 'ndjson':
+        for name in zf.namelist():
+            channel_id = Path(name).stem
+            if name.startswith('channels/') and ranges(channel_id):
+                with zf.open(name) as f:
+                    yield from select(channel_id, f)
+    else:
+        raise ValueError(
+            f'The messages of a `{export_format}` archive cannot be read '
+            'line by line.')
+
+
+def _read_digests(zf):
+    if 'digests.json' not in zf.namelist():
+        raise ValueError('The archive has no digests (`digests.json`); it '
+                         'was made by an older version of the bot.')
+    return json.loads(zf.read('digests.json'))
+
+
+def _verify_sqlite_counts(zf, digests):
+    # The lines of the messages cannot be rebuilt from the database, so only
+    #   the number and the range of ids of the messages are checked.
+    name = next(x for x in zf.namelist() if x.endswith('.sqlite'))
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            zf.extract(name, tmp)
+        except (zipfile.BadZipFile, zlib.error) as e:
+            return [f'{name}: {e}'], {name}
+        db = sqlite3.connect(str(Path(tmp) / name))
+        counts = {
+            str(channel_id): (num_messages, first, last)
+            for channel_id, num_messages, first, last in db.execute(
+                'SELECT channel_id, COUNT(*), MIN(id), MAX(id) FROM '
+                'messages GROUP BY channel_id')
+        }
+        db.close()
+    problems = []
+    for channel_id, channel in digests['channels'].items():
+        expected = (channel['num_messages'], channel['first_message_id'],
+                    channel['last_message_id'])
+        if counts.get(channel_id, (0, None, None)) != expected:
+            problems.append(f'Channel {channel_id}: expected '
+                            f'{channel["num_messages"]} messages, found '
+                            f'{counts.get(channel_id, (0, ))[0]}.')
+    return problems, {name}
+
+
+def verify_archive(path):
+    """Checks the integrity of an archive, in one streaming pass, and returns
+    its problems (none if it is intact) and its number of messages.
+
+    The digests of each channel, and of each of its segments, are computed
+    again from the messages and compared to those in `digests.json`; every
+    other entry is read to its end (so its CRC-32 is checked), and the blobs
+    are checked against their SHA-256.
+    """
+    problems = []
+    with zipfile.ZipFile(path) as zf:
+        digests = _read_digests(zf)
+        if digests['format'] == 'sqlite':
+            sqlite_problems, checked = _verify_sqlite_counts(zf, digests)
+            problems.extend(sqlite_problems)
+        else:
+            checked = set(x for x in zf.namelist()
+                          if x.startswith('channels/'))
+            if digests['format'] == 'json':
+                checked.update(x for x in zf.namelist() if '/' not in x
+                               and x.endswith('.json'))
+            computed = collections.defaultdict(
+                lambda: _ChannelDigest(digests['segment_size']))
+            try:
+                for channel_id, _, line in _iter_archive_lines(
+                        zf, digests['format']):
+                    computed[channel_id].update(line)
+            except (zipfile.BadZipFile, zlib.error, ValueError) as e:
+                problems.append(f'Could not read the messages: {e}')
+            for channel_id in sorted(
+                    set(computed) | set(digests['channels'])):
+                expected = digests['channels'].get(channel_id)
+                actual = computed[channel_id].to_dict()
+                if expected is None:
+                    problems.append(f'Channel {channel_id} has no digest.')
+                elif actual['sha256'] != expected['sha256']:
+                    bad = [(x['first_message_id'], x['last_message_id'])
+                           for x in expected['segments']
+                           if x not in actual['segments']]
+                    problems.append(
+                        f'Channel {channel_id}: {actual["num_messages"]} '
+                        f'messages (expected {expected["num_messages"]}), '
+                        f'{len(bad)} segment(s) do not match (message ids '
+                        f'{", ".join(f"{a}-{b}" for a, b in bad)}).')
+        for name in zf.namelist():
+            if name in checked or name.endswith('/'):
+                continue
+            sha256 = hashlib.sha256()
+            try:
+                with zf.open(name) as f:
+                    for data in iter(lambda: f.read(1024 * 1024), b''):
+                        sha256.update(data)
+            except (zipfile.BadZipFile, zlib.error) as e:
+                problems.append(f'{name}: {e}')
+                continue
+            if (name.startswith('blobs/')
+                    and sha256.hexdigest() != Path(name).name):
+                problems.append(f'{name}: the SHA-256 does not match.')
+    num_messages = sum(x['num_messages']
+                       for x in digests['channels'].values())
+    return problems, num_messages
+
+
+def _changed_positions(old, new, comparable):
+    # The ranges of positions of the segments of `old` that are not in
+    #   `new` (a segment is identified by its `after` and its digest).
+    if not old:
+        return []
+    if not new or not comparable:
+        return [(0, old['num_messages'])]
+    same = set((x['after'], x['sha256']) for x in new['segments'])
+    positions = []
+    start = 0
+    for segment in old['segments']:
+        end = start + segment['num_messages']
+        if (segment['after'], segment['sha256']) not in same:
+            if positions and positions[-1][1] == start:
+                positions[-1] = (positions[-1][0], end)
+            else:
+                positions.append((start, end))
+        start = end
+    return positions
+
+
+def diff_archives(old_path, new_path):
+    """Compares two archives of a server, and returns the ids of the
+    messages that were added, edited and deleted in each channel, and the
+    number of segments that were decoded (and in total).
+
+    Only the segments whose digests differ are decoded: a message that is
+    in an unchanged segment on one side cannot be in a changed segment on
+    the other (each message is in one segment), so the messages of the
+    changed segments are all that have to be compared.
+    """
+    with zipfile.ZipFile(old_path) as old_zf, \
+            zipfile.ZipFile(new_path) as new_zf:
+        old_digests, new_digests = _read_digests(old_zf), _read_digests(
+            new_zf)
+        comparable = (old_digests['segment_size'] ==
+                      new_digests['segment_size'])
+        old_wanted, new_wanted = {}, {}
+        num_segments = [0, 0]
+        for channel_id in (set(old_digests['channels'])
+                           | set(new_digests['channels'])):
+            old = old_digests['channels'].get(channel_id)
+            new = new_digests['channels'].get(channel_id)
+            for x in [old, new]:
+                num_segments[1] += len(x['segments']) if x else 0
+            if old and new and old['sha256'] == new['sha256']:
+                continue
+            old_wanted[channel_id] = _changed_positions(old, new, comparable)
+            new_wanted[channel_id] = _changed_positions(new, old, comparable)
+
+        def read(zf, digests, wanted):
+            messages = collections.defaultdict(dict)
+            for channel_id, _, line in _iter_archive_lines(
+                    zf, digests['format'], wanted):
+                messages[channel_id][json.loads(line)['id']] = line
+            return messages
+
+        old_messages = read(old_zf, old_digests, old_wanted)
+        new_messages = read(new_zf, new_digests, new_wanted)
+
+    changes = {}
+    for channel_id in sorted(set(old_wanted) | set(new_wanted)):
+        old, new = old_messages[channel_id], new_messages[channel_id]
+        changes[channel_id] = {
+            'added': sorted(new.keys() - old.keys()),
+            'edited':
+            sorted(k for k in new.keys() & old.keys() if new[k] != old[k]),
+            'deleted': sorted(old.keys() - new.keys())
+        }
+        num_segments[0] += sum(
+            1 for digests, wanted in [(old_digests, old_wanted),
+                                      (new_digests, new_wanted)]
+            for x in _segment_positions(
+                digests['channels'].get(channel_id))
+            if any(a < x[1] and x[0] < b for a, b in wanted[channel_id]))
+    return changes, tuple(num_segments)
+
+
+def _segment_positions(channel):
+    # The range of positions of each segment of a channel.
+    start = 0
+    for segment in channel['segments'] if channel else []:
+        yield start, start + segment['num_messages']
+        start += segment['num_messages']
+
+
+def read_messages_cli(args):
+    """Prints the messages of one channel of an archive, one per line."""
+    parser = argparse.ArgumentParser(prog='bot.py read')
+    parser.add_argument('archive')
+    parser.add_argument('channel_id')
+    parser.add_argument('--after', type=datetime.fromisoformat)
+    parser.add_argument('--before', type=datetime.fromisoformat)
+    args = parser.parse_args(args)
+    with ArchiveReader(args.archive) as reader:
+        for message in reader.iter_messages(args.channel_id, args.after,
+                                            args.before):
+            print(json.dumps(message))
+
+
+def restore_snapshot_cli(args):
+    """Writes the files of a snapshot of the repository to a directory."""
+    parser = argparse.ArgumentParser(prog='bot.py restore')
+    parser.add_argument('guild_id')
+    parser.add_argument('snapshot', help='e.g. 2022-01-01_00.00.00')
+    parser.add_argument('path')
+    args = parser.parse_args(args)
+    load_dotenv()
+    manifest = _Repository(os.environ['REPOSITORY']).restore(
+        args.guild_id, args.snapshot, args.path)
+    print(f'Restored {len(manifest["files"])} files to {args.path}.')
+
+
+def verify_archive_cli(args):
+    """Checks the integrity of archives; exits with 1 if one is damaged."""
+    parser = argparse.ArgumentParser(prog='bot.py verify')
+    parser.add_argument('archives', nargs='+')
+    args = parser.parse_args(args)
+    damaged = False
+    for path in args.archives:
+        try:
+            problems, num_messages = verify_archive(path)
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            problems, num_messages = [str(e)], 0
+        if problems:
+            damaged = True
+            print(f'{path}: DAMAGED')
+            for problem in problems:
+                print(f'  {problem}')
+        else:
+            print(f'{path}: OK ({num_messages} messages)')
+    sys.exit(1 if damaged else 0)
+
+
+def diff_archives_cli(args):
+    """Prints the messages added, edited and deleted in each channel between
+    two archives."""
+    parser = argparse.ArgumentParser(prog='bot.py diff')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--ids',
+                        action='store_true',
+                        help='list the ids of the messages')
+    args = parser.parse_args(args)
+    try:
+        changes, (decoded, total) = diff_archives(args.old, args.new)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        print(f'Could not compare the archives: {e}', file=sys.stderr)
+        sys.exit(1)
+    for channel_id, change in changes.items():
+        counts = {k: len(v) for k, v in change.items()}
+        if not any(counts.values()):
+            continue
+        print(f'{channel_id}: ' +
+              ', '.join(f'{v} {k}' for k, v in counts.items()))
+        if args.ids:
+            for sign, kind in [('+', 'added'), ('~', 'edited'),
+                               ('-', 'deleted')]:
+                for message_id in change[kind]:
+                    print(f'  {sign} {message_id}')
+    print(f'Decoded {decoded} of {total} segments.')
+
+
+def expand_members_cli(archive_path):
+    """Prints the members of an archive in the verbose form."""
+    with zipfile.ZipFile(archive_path) as zf:
+        names = zf.namelist()
+        members_dicts, tables = load_members(lambda x: zf.read(x)
+                                             if x in names else None)
+    print(json.dumps(expand_members(members_dicts, tables)))
+
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['expand-members']:
+        expand_members_cli(sys.argv[2])
+    elif sys.argv[1:2] == ['read']:
+        read_messages_cli(sys.argv[2:])
+    elif sys.argv[1:2] == ['restore']:
+        restore_snapshot_cli(sys.argv[2:])
+    elif sys.argv[1:2] == ['verify']:
+        verify_archive_cli(sys.argv[2:])
+    elif sys.argv[1:2] == ['diff']:
+        diff_archives_cli(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,197 @@
+"""Fixtures that run the bot offline, on the fake guild of the benchmark."""
+
+import asyncio
+import http.server
+import json
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from discord.ext import commands
+
+_ROOT = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(_ROOT), str(_ROOT / 'benchmarks')]
+
+import bot  # noqa: E402
+from backup import _Context, _Guild, _RateLimiter  # noqa: E402
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    """A fresh `STATE_DIR`, with the archives uploaded to `uploads/`."""
+    monkeypatch.chdir(tmp_path)  # The bot writes `logs.log` to the cwd.
+    monkeypatch.setattr(sys, 'argv', ['bot.py'])
+    monkeypatch.setenv('STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 'local')
+    monkeypatch.setenv('UPLOAD_DIR', str(tmp_path / 'uploads'))
+    return tmp_path
+
+
+def make_guild(channels=1, messages=100, members=10):
+    return _Guild(channels, messages, members, _RateLimiter(0, 0))
+
+
+@pytest.fixture
+def run_backup(state_dir):
+    """Returns a function that starts the bot (without connecting it), runs
+    `!backup <args>` in a guild and waits for the backup job to finish."""
+
+    def run(guild, *args):
+        captured = {}
+        with mock.patch.object(
+                commands.Bot, 'run',
+                lambda self, token: captured.update(bot=self)):
+            bot.main()
+        ctx = _Context(guild)
+        sleep = asyncio.sleep
+
+        async def fast_sleep(delay, *args, **kwargs):
+            await sleep(0)
+
+        async def backup():
+            await captured['bot'].get_command('backup').callback(ctx, *args)
+            while len(asyncio.all_tasks()) > 1:
+                await sleep(0.01)
+            await captured['bot'].close()
+
+        # The fixed delays of the bot (e.g., before a backup starts) are
+        #   skipped.
+        with mock.patch('asyncio.sleep', fast_sleep):
+            asyncio.run(backup())
+        return ctx
+
+    return run
+
+
+class _S3Handler(http.server.BaseHTTPRequestHandler):
+    """The requests of minio that the bot makes: single and multipart
+    uploads, and downloads. Each request is logged, and the parts listed in
+    `server.failures` fail once with a 503."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _request(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        return (urllib.parse.unquote(url.path),
+                urllib.parse.parse_qs(url.query,
+                                      keep_blank_values=True), body)
+
+    def do_GET(self):
+        path, query, _ = self._request()
+        if 'location' in query:
+            return self._reply(
+                200, b'<LocationConstraint xmlns="http://s3.amazonaws.com/'
+                b'doc/2006-03-01/"></LocationConstraint>')
+        if path not in self.server.objects:
+            return self._reply(404, b'<Error><Code>NoSuchKey</Code></Error>')
+        self._reply(200, self.server.objects[path])
+
+    def do_PUT(self):
+        path, query, body = self._request()
+        if 'partNumber' in query:
+            part_number = int(query['partNumber'][0])
+            self.server.log.append(('part', part_number, len(body)))
+            if part_number in self.server.failures:
+                self.server.failures.remove(part_number)
+                return self._reply(503,
+                                   b'<Error><Code>SlowDown</Code></Error>')
+            self.server.parts[part_number] = body
+            return self._reply(200, headers={'ETag': f'"{part_number}"'})
+        self.server.log.append(('put', len(body)))
+        self.server.objects[path] = body
+        self._reply(200, headers={'ETag': '"0"'})
+
+    def do_POST(self):
+        path, query, _ = self._request()
+        bucket, key = path.lstrip('/').split('/', 1)
+        if 'uploads' in query:
+            self.server.parts.clear()
+            return self._reply(
+                200, f'<InitiateMultipartUploadResult><Bucket>{bucket}'
+                f'</Bucket><Key>{key}</Key><UploadId>1</UploadId>'
+                '</InitiateMultipartUploadResult>'.encode())
+        parts = self.server.parts
+        self.server.objects[path] = b''.join(parts[k] for k in sorted(parts))
+        self.server.log.append(('complete', len(parts)))
+        self._reply(
+            200, f'<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket>'
+            f'<Key>{key}</Key><ETag>"0"</ETag>'
+            '</CompleteMultipartUploadResult>'.encode())
+
+    def do_DELETE(self):
+        self._request()
+        self.server.log.append(('abort', ))
+        self._reply(204)
+
+
+@pytest.fixture
+def s3_server(monkeypatch):
+    """A local stand-in for an S3 server (e.g., MinIO), with a `data`
+    bucket."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _S3Handler)
+    server.objects, server.parts, server.log, server.failures = {}, {}, [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('S3_ENDPOINT', f'127.0.0.1:{server.server_port}')
+    monkeypatch.setenv('S3_SECURE', 'no')
+    monkeypatch.setenv('S3_ACCESS_KEY', 'access-key')
+    monkeypatch.setenv('S3_SECRET_KEY', 'secret-key')
+    monkeypatch.setenv('S3_BUCKET_NAME', 'data')
+    bot._get_s3_client.cache_clear()
+    yield server
+    server.shutdown()
+    server.server_close()
+    bot._get_s3_client.cache_clear()
+
+
+class _FileioHandler(http.server.BaseHTTPRequestHandler):
+    """The uploads of file.io. Each request is logged; the next status (and
+    delay) to respond with can be queued in `server.statuses` (and
+    `server.delays`)."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.headers['Content-Type'], body))
+        if self.server.delays:
+            time.sleep(self.server.delays.pop(0))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        reply = json.dumps({
+            'success': status == 200,
+            'link': f'https://file.io/{len(self.server.requests)}'
+        }).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+@pytest.fixture
+def fileio_server(monkeypatch):
+    """A local stand-in for file.io."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _FileioHandler)
+    server.requests, server.statuses, server.delays = [], [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('FILEIO_URL', f'http://127.0.0.1:{server.server_port}')
+    yield server
+    server.shutdown()
+    server.server_close()
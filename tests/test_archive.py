@@ -0,0 +1,70 @@
+import io
+import os
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+import bot
+
+
+class _Pipe:
+    """A file that can only be written to (like `_StreamPipe`)."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+@pytest.fixture(params=[1, 2], ids=['in-process', 'workers'])
+def workers(request, monkeypatch):
+    monkeypatch.setenv('WORKER_PROCESSES', str(request.param))
+    bot._num_worker_processes.cache_clear()
+    bot._get_worker_pool.cache_clear()
+    yield request.param
+    pool = bot._get_worker_pool()
+    if pool:
+        pool.shutdown()
+    bot._num_worker_processes.cache_clear()
+    bot._get_worker_pool.cache_clear()
+
+
+@pytest.mark.parametrize('compression',
+                         ['store', 'deflate:1', 'deflate', 'bzip2', 'lzma'])
+@pytest.mark.parametrize('seekable', [True, False])
+def test_archive_can_be_read_back(tmp_path, workers, compression, seekable):
+    # More than a few chunks, so that the workers compress the entry.
+    big = os.urandom(1024) * (3 * bot.COMPRESSION_CHUNK_SIZE // 1024 + 7)
+    (tmp_path / 'image.png').write_bytes(os.urandom(4096))
+    pipe = None if seekable else _Pipe()
+    writer = bot._ArchiveWriter(compression, fileobj=pipe)
+    writer.write_json('channels/général.json', {'messages': [1, 2]})
+    with writer.open_entry('big.bin') as f:
+        f.write(big)
+    writer.write_file('image.png', tmp_path / 'image.png', compress=False)
+    with writer.open_entry('empty') as f:
+        pass
+    result = writer.close()
+    data = bytes(pipe.data) if pipe else result.read()
+    (tmp_path / 'archive.zip').write_bytes(data)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [
+            'channels/général.json', 'big.bin', 'image.png', 'empty'
+        ]
+        assert zf.read('channels/général.json') == b'{"messages": [1, 2]}'
+        assert zf.read('big.bin') == big
+        assert zf.read('image.png') == (tmp_path / 'image.png').read_bytes()
+        assert zf.read('empty') == b''
+        assert zf.getinfo('image.png').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('big.bin').compress_type == bot.parse_compression(
+            compression)[0]
+    if shutil.which('unzip') and compression != 'lzma':
+        subprocess.run(['unzip', '-tq', str(tmp_path / 'archive.zip')],
+                       check=True,
+                       stdout=subprocess.DEVNULL)
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import threading
+
+import bot
+
+
+def _add(store, tmp_path, key, content):
+    tmp_file = tmp_path / f'{key.replace("/", "-")}.tmp'
+    tmp_file.write_bytes(content)
+    sha256 = hashlib.sha256(content).hexdigest()
+    store.add(key, tmp_file, sha256)
+    return sha256
+
+
+def _index_lines(state_dir):
+    with open(state_dir / 'state' / 'blobs' / 'index.ndjson') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_index_is_shared_and_only_grows_for_new_files(state_dir):
+    store = bot._BlobStore()
+    sha256 = _add(store, state_dir, 'attachment/1', b'image')
+    _add(store, state_dir, 'attachment/1', b'image')
+    # A store made later (e.g., by another job) sees the same index.
+    assert bot._BlobStore().lookup('attachment/1') == sha256
+    _add(bot._BlobStore(), state_dir, 'attachment/2', b'image')
+    assert [x['key'] for x in _index_lines(state_dir)
+            ] == ['attachment/1', 'attachment/2']
+
+
+def test_concurrent_adds_write_whole_lines(state_dir):
+    store = bot._BlobStore()
+    threads = [
+        threading.Thread(target=_add,
+                         args=(store, state_dir, f'sticker/{n}',
+                               str(n).encode())) for n in range(50)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(x['key'] for x in _index_lines(state_dir)) == sorted(
+        f'sticker/{n}' for n in range(50))
+
+
+def test_index_is_compacted_when_loaded(state_dir):
+    index_file = state_dir / 'state' / 'blobs' / 'index.ndjson'
+    index_file.parent.mkdir(parents=True)
+    index_file.write_text(''.join(
+        json.dumps({
+            'key': f'attachment/{n % 3}',
+            'sha256': f'{n:064x}'
+        }) + '\n' for n in range(9)))
+
+    store = bot._BlobStore()
+
+    assert _index_lines(state_dir) == [{
+        'key': f'attachment/{n % 3}',
+        'sha256': f'{n:064x}'
+    } for n in range(6, 9)]
+    assert store._index['attachment/0'] == f'{6:064x}'
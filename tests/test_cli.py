@@ -0,0 +1,117 @@
+import json
+import zipfile
+
+import pytest
+
+import bot
+from backup import _TextChannel
+from conftest import make_guild
+
+
+class _EditedChannel(_TextChannel):
+    """A channel where some messages were edited, and others deleted."""
+
+    def __init__(self, *args, edited=(), deleted=()):
+        super().__init__(*args)
+        self.edited = set(edited)
+        self.deleted = set(deleted)
+
+    async def history(self, *args, **kwargs):
+        async for message in super().history(*args, **kwargs):
+            if message.id in self.deleted:
+                continue
+            if message.id in self.edited:
+                message.content += ' (edited)'
+            yield message
+
+
+def _backup(state_dir, run_backup, guild, name):
+    # Renamed, so that the next backup (which may start in the same second)
+    #   does not replace it.
+    run_backup(guild, 'all')
+    [archive] = (state_dir / 'uploads').glob('*.zip')
+    return str(archive.rename(state_dir / name))
+
+
+def _rewrite(path, name, transform):
+    # Rewrites an entry of an archive, with a valid CRC-32.
+    with zipfile.ZipFile(path) as zf:
+        entries = [(x, zf.read(x.filename)) for x in zf.infolist()]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for info, data in entries:
+            zf.writestr(info,
+                        transform(data) if info.filename == name else data)
+
+
+def test_verify_reports_a_tampered_archive(state_dir, run_backup, monkeypatch,
+                                           capsys):
+    monkeypatch.setenv('EXPORT_FORMAT', 'ndjson')
+    path = _backup(state_dir, run_backup, make_guild(channels=2), 'a.zip')
+    capsys.readouterr()
+
+    with pytest.raises(SystemExit) as e:
+        bot.verify_archive_cli([path])
+    assert e.value.code == 0
+    assert capsys.readouterr().out == f'{path}: OK (200 messages)\n'
+
+    _rewrite(path, 'channels/2001.ndjson',
+             lambda data: data.replace(b'Message number 42,', b'Tampered,'))
+    with pytest.raises(SystemExit) as e:
+        bot.verify_archive_cli([path])
+    assert e.value.code == 1
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == f'{path}: DAMAGED'
+    assert any('2001' in x for x in out[1:])
+    assert not any('2000' in x for x in out[1:])
+
+
+def test_diff_lists_the_changed_messages(state_dir, run_backup, monkeypatch,
+                                         capsys):
+    monkeypatch.setenv('EXPORT_FORMAT', 'ndjson')
+    guild = make_guild(channels=2)
+    old = _backup(state_dir, run_backup, guild, 'old.zip')
+
+    channel = guild.text_channels[1]
+    edited, deleted = channel._message_id(10), channel._message_id(50)
+    added = [channel._message_id(n) for n in [100, 101]]
+    guild.text_channels[1] = _EditedChannel(channel.id,
+                                            channel.name,
+                                            guild,
+                                            102,
+                                            guild._limiter,
+                                            edited=[edited],
+                                            deleted=[deleted])
+    guild.channels = guild.text_channels
+    new = _backup(state_dir, run_backup, guild, 'new.zip')
+    capsys.readouterr()
+
+    bot.diff_archives_cli([old, new, '--ids'])
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == f'{channel.id}: 2 added, 1 edited, 1 deleted'
+    assert out[1:5] == [f'  + {added[0]}', f'  + {added[1]}',
+                        f'  ~ {edited}', f'  - {deleted}']
+    # The unchanged channel is not listed, nor decoded.
+    assert len(out) == 6
+    assert out[5].startswith('Decoded ')
+
+
+def test_diff_reports_archives_it_cannot_compare(state_dir, run_backup,
+                                                 monkeypatch, capsys):
+    monkeypatch.setenv('EXPORT_FORMAT', 'sqlite')
+    guild = make_guild(channels=1, messages=10)
+    sqlite = _backup(state_dir, run_backup, guild, 'sqlite.zip')
+    monkeypatch.setenv('EXPORT_FORMAT', 'ndjson')
+    ndjson = _backup(state_dir, run_backup, guild, 'ndjson.zip')
+    bare = str(state_dir / 'bare.zip')
+    with zipfile.ZipFile(bare, 'w') as zf:
+        zf.writestr('channels/2000.ndjson', json.dumps({'id': 1}) + '\n')
+    capsys.readouterr()
+
+    for args in [[sqlite, ndjson], [ndjson, bare],
+                 [ndjson, str(state_dir / 'missing.zip')]]:
+        with pytest.raises(SystemExit) as e:
+            bot.diff_archives_cli(args)
+        assert e.value.code == 1
+        captured = capsys.readouterr()
+        assert captured.out == ''
+        assert captured.err.startswith('Could not compare the archives: ')
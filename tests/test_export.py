@@ -0,0 +1,89 @@
+import json
+import tracemalloc
+import zipfile
+
+import discord
+
+import bot
+from backup import _TextChannel
+from conftest import make_guild
+
+
+def _archive(state_dir):
+    archives = list((state_dir / 'uploads').glob('*.zip'))
+    assert len(archives) == 1
+    return zipfile.ZipFile(archives[0])
+
+
+def test_ndjson_export_memory_is_bounded(state_dir, run_backup, monkeypatch):
+    monkeypatch.setenv('EXPORT_FORMAT', 'ndjson')
+    num_messages = 20000
+    guild = make_guild(channels=1, messages=num_messages)
+
+    tracemalloc.start()
+    try:
+        run_backup(guild, 'all')
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The messages are streamed from the channel to a spool, then to the
+    #   archive, so the memory does not grow with the size of the channel:
+    #   it stays a fraction of the channel's export (about 20 MiB here).
+    with _archive(state_dir) as zf:
+        export_size = zf.getinfo('channels/2000.ndjson').file_size
+        with zf.open('channels/2000.ndjson') as f:
+            ids = [json.loads(line)['id'] for line in f]
+    assert peak < 8 * 1024 * 1024
+    assert peak < export_size / 4
+    assert len(ids) == num_messages
+    assert ids == sorted(ids)
+
+
+class _BurstChannel(_TextChannel):
+    """A channel where messages are sent two at a time (in the same
+    millisecond)."""
+
+    def _message_id(self, n):
+        return self._first_id + (n // 2) * (600000 << 22) + n % 2
+
+
+def test_json_export_keeps_one_message_per_date(state_dir, run_backup,
+                                                monkeypatch):
+    monkeypatch.setenv('EXPORT_FORMAT', 'json')
+    guild = make_guild(channels=1)
+    channel = _BurstChannel(2000, 'burst', guild, 10, guild._limiter)
+    guild.text_channels = guild.channels = [channel]
+
+    run_backup(guild, 'all')
+
+    with _archive(state_dir) as zf:
+        name = next(x for x in zf.namelist() if x.endswith('.json')
+                    and x != 'digests.json')
+        document = json.loads(zf.read(name))
+    messages = document['channels']['2000']
+    # Like a dict keyed by date, in date order, of the oldest message of
+    #   each date.
+    assert [x['id'] for x in messages.values()
+            ] == [channel._message_id(n) for n in range(0, 10, 2)]
+    assert list(messages) == [
+        str(discord.utils.snowflake_time(channel._message_id(n)))
+        for n in range(0, 10, 2)
+    ]
+
+
+def test_digest_reads_the_message_id_of_each_line():
+    # A nested object with its own id and jump URL, after the message's.
+    line = json.dumps({
+        'id': 10,
+        'jump_url': 'https://discord.com/channels/1/2/10',
+        'stickers': [{
+            'id': 20,
+            'jump_url': 'https://discord.com/channels/1/2/20'
+        }]
+    }).encode('utf-8') + b'\n'
+    digest = bot._ChannelDigest()
+
+    digest.update(line)
+
+    assert digest.to_dict()['first_message_id'] == 10
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import discord
+
+import bot
+from conftest import make_guild
+
+DAY = 24 * 3600 * 1000 << 22
+
+
+def _message_ids():
+    # A channel that was quiet for nine days, then busy for one.
+    first = discord.utils.time_snowflake(discord.utils.utcnow()) - 10 * DAY
+    quiet = [first + n * (9 * DAY // 200) for n in range(200)]
+    busy = [first + 9 * DAY + n * (DAY // 3000) for n in range(3000)]
+    channel_id, last = first - 1, busy[-1]
+    # A message on the bound between the first two ranges.
+    bound = channel_id + (last + 1 - channel_id) // 4
+    return channel_id, sorted(set(quiet + busy + [bound]))
+
+
+def test_skewed_channel_is_split_and_merged_in_order(tmp_path):
+    channel_id, message_ids = _message_ids()
+    requests = []
+
+    async def iter_range(after, before):
+        requests.append((after, before))
+        ids = [
+            x for x in message_ids if x > after and (not before or x < before)
+        ]
+        for i in range(0, len(ids), 100):
+            await asyncio.sleep(0)  # A page of messages.
+            for message_id in ids[i:i + 100]:
+                yield message_id, f'{message_id}\n'.encode()
+
+    ranges = []
+    lines = []
+
+    async def on_range(history_range):
+        ranges.append((history_range.after, history_range.before))
+        with open(history_range.path, 'rb') as f:
+            lines.extend(f.read().splitlines())
+
+    history = bot._SlicedHistory(iter_range, channel_id, message_ids[-1], 4,
+                                 tmp_path)
+    asyncio.run(history.run(on_range))
+
+    # The busy day was split further than the first 4 ranges.
+    assert len(requests) > 4
+    # The ranges are contiguous, in order...
+    assert ranges[0][0] == channel_id and ranges[-1][1] is None
+    assert all(x[1] == y[0] + 1 for x, y in zip(ranges, ranges[1:]))
+    # ...so the messages have no gaps nor duplicates, in snowflake order.
+    assert [int(x) for x in lines] == message_ids
+
+
+def test_ranges_are_appended_off_the_event_loop(state_dir, run_backup,
+                                                 monkeypatch):
+    monkeypatch.setenv('CHANNEL_SLICES', '4')
+    monkeypatch.setenv('EXPORT_FORMAT', 'ndjson')
+    copyfileobj = bot.shutil.copyfileobj
+    loop_threads = []
+
+    def slow_copyfileobj(*args):
+        time.sleep(0.05)
+        loop_threads.append(asyncio._get_running_loop())
+        return copyfileobj(*args)
+
+    monkeypatch.setattr(bot.shutil, 'copyfileobj', slow_copyfileobj)
+    run_backup(make_guild(channels=1, messages=2000), 'all')
+
+    # The copies ran in threads, without a running event loop.
+    assert loop_threads and not any(loop_threads)
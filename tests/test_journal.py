@@ -0,0 +1,95 @@
+import io
+import json
+import sqlite3
+import time
+
+import pytest
+
+import bot
+
+
+def _message(message_id, content):
+    return {'id': message_id, 'content': content, 'edited_at': 'None'}
+
+
+def test_entries_are_written_off_the_caller(state_dir):
+    journal = bot._MessageJournal(1000)
+    journal.start([2000])
+    journal.append('create', 2000, 1, message=_message(1, 'a'))
+    journal.append('create', 2000, 2, message=_message(2, 'b'))
+    journal.append('edit', 2000, 1, data={'content': 'c'})
+    journal.append('delete', 2000, 2)
+    # `append` only queues the entries.
+    assert not list(journal.path.glob('*.ndjson'))
+
+    journal.flush()
+
+    spool = io.BytesIO()
+    assert journal.export_channel(2000, spool) == (2, 2)
+    messages = [json.loads(x) for x in spool.getvalue().splitlines()]
+    assert [x['content'] for x in messages] == ['c', 'b']
+    assert messages[0]['edit_history'] == [{
+        'content': 'a',
+        'edited_at': 'None'
+    }]
+    assert 'deleted_at' in messages[1]
+    journal.close()
+
+
+def test_writer_thread_flushes_the_queue(state_dir):
+    journal = bot._MessageJournal(1000)
+    journal.start([2000])
+    journal.append('create', 2000, 1, message=_message(1, 'a'))
+    deadline = time.time() + 5
+    # Within about a second, without any `flush`.
+    while True:
+        try:
+            if journal.export_channel(2000, io.BytesIO()) == (1, 1):
+                break
+        except sqlite3.OperationalError:  # The index is being created.
+            pass
+        assert time.time() < deadline
+        time.sleep(0.05)
+    journal.stop()
+
+
+class _FailingDb:
+    """An index whose next commit fails (e.g., the disk is full)."""
+
+    def __init__(self, db):
+        self._db = db
+        self.failures = 1
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def commit(self):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database or disk is full')
+        self._db.commit()
+
+
+def test_failed_batch_is_written_again(state_dir, monkeypatch):
+    monkeypatch.setenv('JOURNAL_SEGMENT_SIZE', '500')
+    journal = bot._MessageJournal(1000)
+    journal.start([2000])
+    journal.append('create', 2000, 1, message=_message(1, 'a'))
+    journal.flush()
+    journal._db = _FailingDb(journal._db)
+    for n in range(2, 20):
+        journal.append('create', 2000, n, message=_message(n, 'b'))
+
+    with pytest.raises(sqlite3.OperationalError):
+        journal.flush()
+    journal.flush()
+
+    assert journal.export_channel(2000, io.BytesIO()) == (19, 19)
+    lines = []
+    for path in sorted(journal.path.glob('*.ndjson')):
+        lines.extend(path.read_bytes().splitlines())
+    # The entries that the failed batch wrote were dropped before it was
+    #   written again.
+    assert [json.loads(x)['message_id'] for x in lines] == list(range(1, 20))
+    assert len(list(journal.path.glob('*.ndjson'))) > 2
+    journal.close()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+
+import bot
+from conftest import make_guild
+
+
+def _seed(guild):
+    cache = bot._MemberCache(guild.id)
+    cache.begin_seed()
+    tables = {'roles': {}, 'guilds': {}}
+    asyncio.run(
+        cache.seed(
+            {
+                str(x.id): bot.encode_member_compact(x, tables)
+                for x in guild.members
+            }, tables))
+    return cache
+
+
+def _log_lines(cache):
+    with open(cache.path / 'changes.ndjson', 'rb') as f:
+        return f.readlines()
+
+
+def test_role_changes_are_one_log_append(state_dir):
+    guild = make_guild(members=30)
+    cache = _seed(guild)
+    role = guild.roles[2]
+    with_role = [x for x in guild.members if role in x.roles]
+    assert with_role
+    assert cache.members_with_role(role.id) == [str(x.id) for x in with_role]
+
+    # The role is deleted: its members are updated at once.
+    for member in with_role:
+        member.roles.remove(role)
+    asyncio.run(
+        cache.update_many([
+            guild.members[int(x) - 500000]
+            for x in cache.members_with_role(role.id)
+        ]))
+    assert cache.members_with_role(role.id) == []
+    assert len(_log_lines(cache)) == 1
+
+    reloaded = bot._MemberCache(guild.id)
+    assert reloaded.members == cache.members
+    assert reloaded.members_with_role(role.id) == []
+    assert reloaded.members_with_role(guild.roles[1].id) == \
+        cache.members_with_role(guild.roles[1].id)
+
+
+def test_changes_are_logged_in_order(state_dir):
+    guild = make_guild(members=30)
+    cache = _seed(guild)
+    member = guild.members[1]
+
+    async def change():
+        batch = asyncio.ensure_future(cache.update_many(guild.members))
+        await asyncio.sleep(0)
+        # The batch is applied, and is being written in a thread.
+        member.display_name = 'Renamed'
+        await cache.update(member)
+        await batch
+
+    asyncio.run(change())
+    assert [len(json.loads(x).get('members', [])) for x in _log_lines(cache)
+            ] == [30, 0]
+    reloaded = bot._MemberCache(guild.id)
+    assert json.loads(
+        reloaded.members[str(member.id)])['display_name'] == 'Renamed'
+
+
+def test_writes_are_off_the_event_loop(state_dir, monkeypatch):
+    threads = set()
+    for name in ['_write_log', '_write_snapshot', '_encode_seed']:
+        write = getattr(bot._MemberCache, name)
+
+        def record(*args, write=write):
+            threads.add(threading.current_thread())
+            return write(*args)
+
+        if name == '_encode_seed':
+            record = staticmethod(record)
+        monkeypatch.setattr(bot._MemberCache, name, record)
+    guild = make_guild(members=30)
+
+    cache = _seed(guild)
+    asyncio.run(cache.update(guild.members[0]))
+    asyncio.run(cache.remove(guild.members[1].id))
+
+    assert threads and threading.main_thread() not in threads
+
+
+def test_snapshot_keeps_the_changes_made_meanwhile(state_dir):
+    guild = make_guild(members=30)
+    cache = _seed(guild)
+
+    async def change():
+        # More changes than the log is allowed to hold, so it is replaced by
+        #   a snapshot while the following changes are written.
+        for n in range(1200):
+            member = guild.members[n % 30]
+            member.display_name = f'Member {n}'
+            await asyncio.gather(cache.update(member),
+                                 cache.remove(guild.members[29].id))
+
+    asyncio.run(change())
+    assert len(_log_lines(cache)) < 1200
+    reloaded = bot._MemberCache(guild.id)
+    assert reloaded.members == cache.members
+    assert json.loads(reloaded.members[str(
+        guild.members[9].id)])['display_name'] == 'Member 1179'
+    assert str(guild.members[29].id) not in reloaded.members
@@ -0,0 +1,84 @@
+import json
+import threading
+
+import bot
+
+
+class _Job:
+    """The parts of a `_BackupJob` that a snapshot reads."""
+
+    def __init__(self, path, guild_id=1000):
+        self.path = path
+        self.guild_id = guild_id
+        self.channels = {}
+        path.mkdir(parents=True, exist_ok=True)
+        (path / 'guild.json').write_text(json.dumps({'id': guild_id}))
+
+    def has_json(self, name):
+        return False
+
+    def blobs(self):
+        return []
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_gc_does_not_run_during_a_snapshot(state_dir, monkeypatch):
+    repository = bot._Repository(str(state_dir / 'repository'))
+    job = _Job(state_dir / 'job')
+    writing, resume = threading.Event(), threading.Event()
+
+    def done_channels(job, waiter=None):
+        # The snapshot is in progress: its chunks are not in a manifest yet.
+        writing.set()
+        resume.wait(10)
+        return iter([])
+
+    monkeypatch.setattr(bot, '_done_channels', done_channels)
+    snapshot = _start(repository.write_snapshot, job, 'first')
+    assert writing.wait(10)
+
+    assert repository.gc(job.guild_id, 1) is None
+    resume.set()
+    snapshot.join(10)
+    assert repository.snapshots() == [('1000', 'first')]
+    assert len(repository.chunks()) == 1
+    assert repository.gc(job.guild_id, 1) == (0, 0, 0)
+
+
+def test_snapshot_waits_for_gc(state_dir):
+    repository = bot._Repository(str(state_dir / 'repository'))
+    job = _Job(state_dir / 'job')
+    repository.write_snapshot(job, 'first')
+    (job.path / 'guild.json').write_text(json.dumps({'id': 1000, 'v': 2}))
+    repository.write_snapshot(job, 'second')
+    deleting, resume = threading.Event(), threading.Event()
+    delete = repository.store.delete
+
+    def slow_delete(key):
+        deleting.set()
+        resume.wait(10)
+        delete(key)
+
+    repository.store.delete = slow_delete
+    gc = _start(repository.gc, job.guild_id, 1)
+    assert deleting.wait(10)
+    (job.path / 'guild.json').write_text(json.dumps({'id': 1000, 'v': 1}))
+    snapshot = _start(repository.write_snapshot, job, 'third')
+    snapshot.join(0.5)
+    # It would reuse the chunk of `first`, which `gc` is deleting.
+    assert snapshot.is_alive()
+    resume.set()
+    gc.join(10)
+    snapshot.join(10)
+    assert not snapshot.is_alive()
+    assert repository.snapshots() == [('1000', 'second'), ('1000', 'third')]
+    repository.restore(1000, 'third', job.path / 'restored')
+    assert json.loads((job.path / 'restored' / 'guild.json').read_text()) == {
+        'id': 1000,
+        'v': 1
+    }
@@ -0,0 +1,67 @@
+import os
+import threading
+
+import pytest
+
+import bot
+
+MiB = 1024 * 1024
+
+
+def _upload_stream(data, chunk_size=MiB):
+    """Uploads `data` to S3 through a `_StreamPipe`, written by another
+    thread like an archive is, and returns the link."""
+    pipe = bot._StreamPipe()
+
+    def write():
+        for i in range(0, len(data), chunk_size):
+            pipe.write(data[i:i + chunk_size])
+        pipe.close()
+
+    result = {}
+
+    def upload():
+        result['url'] = bot._Uploader.upload_s3(pipe, 'archive.zip')
+
+    threads = [
+        threading.Thread(target=write, daemon=True),
+        threading.Thread(target=upload, daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+        assert not thread.is_alive(), 'The upload is stuck.'
+    return result['url']
+
+
+@pytest.mark.parametrize('part_size', [None, 32 * MiB])
+def test_stream_larger_than_a_part(s3_server, monkeypatch, part_size):
+    if part_size:
+        monkeypatch.setenv('S3_PART_SIZE', str(part_size))
+    part_size = part_size or bot.S3_PART_SIZE
+    data = os.urandom(2 * part_size + MiB)
+
+    url = _upload_stream(data)
+
+    assert s3_server.objects['/data/archive.zip'] == data
+    # The parts may be uploaded concurrently.
+    assert sorted(s3_server.log[:-1]) == [('part', 1, part_size),
+                                          ('part', 2, part_size),
+                                          ('part', 3, MiB)]
+    assert s3_server.log[-1] == ('complete', 3)
+    assert '/data/archive.zip?' in url
+
+
+def test_failed_part_is_retried(s3_server, monkeypatch):
+    monkeypatch.setenv('S3_PART_SIZE', str(5 * MiB))
+    s3_server.failures.append(2)
+    data = os.urandom(12 * MiB)
+
+    _upload_stream(data, chunk_size=64 * 1024)
+
+    assert s3_server.objects['/data/archive.zip'] == data
+    assert [x for x in s3_server.log if x[:2] == ('part', 2)] == [
+        ('part', 2, 5 * MiB)
+    ] * 2
+    assert s3_server.log[-1] == ('complete', 3)
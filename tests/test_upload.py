@@ -0,0 +1,114 @@
+import asyncio
+import email.parser
+import email.policy
+import os
+from unittest import mock
+
+import discord
+import pytest
+
+import bot
+from conftest import make_guild
+
+
+def _uploaded_file(content_type, body):
+    # The file of a multipart/form-data request.
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    part, = message.iter_parts()
+    return part.get_content()
+
+
+def _text(message):
+    if isinstance(message, discord.Embed):
+        embed = message.to_dict()
+        return '\n'.join([embed.get('description', '')] +
+                         [x['value'] for x in embed.get('fields', [])])
+    return message
+
+
+def _publish(data, object_name='archive.zip'):
+    sleep = asyncio.sleep
+
+    async def fast_sleep(delay, *args, **kwargs):
+        await sleep(0)
+
+    async def publish():
+        uploader = bot._Uploader()
+        try:
+            return await uploader.publish(object_name,
+                                          lambda f: f.write(data))
+        finally:
+            await uploader.close()
+
+    # The backoff between the attempts is skipped.
+    with mock.patch('asyncio.sleep', fast_sleep):
+        return asyncio.run(publish())
+
+
+def test_backup_fans_out_to_all_destinations(state_dir, run_backup,
+                                             s3_server, fileio_server,
+                                             monkeypatch):
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 's3,fileio,local')
+
+    ctx = run_backup(make_guild(channels=2), 'all')
+
+    archive, = (state_dir / 'uploads').glob('*.zip')
+    data = archive.read_bytes()
+    assert s3_server.objects == {f'/data/{archive.name}': data}
+    (content_type, body), = fileio_server.requests
+    assert _uploaded_file(content_type, body) == data
+    report = '\n'.join(_text(x) for x in ctx.sent)
+    assert 'fileio: https://file.io/1' in report
+    assert f'local: {archive.resolve()}' in report
+    assert f'/data/{archive.name}?' in report
+
+
+def test_server_errors_are_retried(state_dir, fileio_server, monkeypatch):
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 'fileio')
+    fileio_server.statuses.extend([503, 502])
+    data = os.urandom(4096)
+
+    assert _publish(data) == 'https://file.io/3'
+    assert [_uploaded_file(*x) for x in fileio_server.requests] == [data] * 3
+
+
+def test_slow_responses_time_out(state_dir, fileio_server, monkeypatch):
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 'fileio')
+    monkeypatch.setenv('UPLOAD_TIMEOUT', '0.2')
+    fileio_server.delays.append(2)
+
+    assert _publish(b'data') == 'https://file.io/2'
+    assert len(fileio_server.requests) == 2
+
+
+def test_failed_destination_does_not_stop_the_others(state_dir,
+                                                     fileio_server,
+                                                     monkeypatch):
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 'fileio,local')
+    fileio_server.statuses.extend([500] * (bot._Uploader.RETRIES + 1))
+
+    links = _publish(b'data')
+
+    assert len(fileio_server.requests) == bot._Uploader.RETRIES + 1
+    local = state_dir / 'uploads' / 'archive.zip'
+    assert local.read_bytes() == b'data'
+    assert links == f'fileio: upload failed\nlocal: {local.resolve()}'
+
+
+def test_failed_upload_leaves_nothing_behind(state_dir, fileio_server,
+                                             monkeypatch):
+    monkeypatch.setenv('UPLOAD_DESTINATIONS', 'fileio')
+    fileio_server.statuses.extend([500] * (bot._Uploader.RETRIES + 1))
+    staged = []
+    mkstemp = bot.tempfile.mkstemp
+
+    def record_mkstemp(*args, **kwargs):
+        fd, path = mkstemp(*args, **kwargs)
+        staged.append(path)
+        return fd, path
+
+    with mock.patch.object(bot.tempfile, 'mkstemp', record_mkstemp):
+        with pytest.raises(RuntimeError, match='file.io responded with 500'):
+            _publish(b'data')
+    assert staged and not any(os.path.exists(x) for x in staged)